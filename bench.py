@@ -0,0 +1,519 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+from config import TAROT_RECENT_WINDOW
+from constants import ZODIAC_SIGNS
+
+DEFAULT_SIZES = (10_000, 100_000, 1_000_000)
+DEFAULT_DB_DIR = "bench_data"
+DEFAULT_TOLERANCE = 0.2
+
+# Доли пользователей в синтетической базе: сколько пользуются ботом каждый день,
+# сколько тянули карты Таро и какие у них подписки
+ACTIVE_SHARE = 0.6
+TAROT_SHARE = 0.4
+SUBSCRIPTIONS = (("free", 0.8), ("active", 0.1), ("inactive", 0.1))
+
+_INSERT_CHUNK = 50_000
+
+# Бюджет холодного импорта (мс) и пакеты, которые модуль не должен загружать.
+# Процессы рассылок и фоновых задач (шарды, outbox) обходятся без aiogram и планировщика;
+# main загружает aiogram (он нужен хэндлерам), но не базу, бота и контент.
+# Бюджеты — примерно в полтора раза выше замеров (медиана пяти запусков):
+# repo ~135 мс, outbox ~145, jobs ~135, broadcast_shards ~110, main ~2250.
+# Сравнивается медиана IMPORT_REPEAT запусков, и нарушением считается превышение
+# больше чем на IMPORT_TOLERANCE: единичный медленный запуск на загруженной машине
+# бюджет не нарушает. Проверяются тестом tests/test_import_time.py (помечен slow)
+IMPORT_BUDGETS = {
+    "repo": (200, ("aiogram", "apscheduler")),
+    "outbox": (210, ("aiogram", "apscheduler")),
+    "jobs": (200, ("aiogram", "apscheduler")),
+    "broadcast_shards": (170, ("aiogram", "apscheduler")),
+    "main": (3300, ("apscheduler",)),
+}
+IMPORT_REPEAT = 5
+IMPORT_TOLERANCE = 0.1
+
+
+def _timings(fn, iterations: int) -> dict:
+    samples = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        fn(i)
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    return {
+        "iterations": iterations,
+        "mean_us": statistics.fmean(samples) * 1e6,
+        "p50_us": samples[len(samples) // 2] * 1e6,
+        "p99_us": samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1e6,
+    }
+
+
+def bench_spreads(iterations: int = 5000) -> dict:
+    """
+    Задержка выборки и сборки текста для каждого расклада (без БД):
+    история пользователя — TAROT_RECENT_WINDOW недавних карт.
+    """
+    from tarot import SPREADS, DrawnCard, get_deck, render_spread, sample_cards
+
+    deck = get_deck()
+    recent = [card.card_id for card in random.sample(deck.cards, TAROT_RECENT_WINDOW)]
+    results = {}
+    for key, layout in SPREADS.items():
+        def run(_):
+            cards = sample_cards(deck, len(layout.positions), recent)
+            drawn = [DrawnCard(p, c, random.random() < 0.3) for p, c in zip(layout.positions, cards)]
+            render_spread(layout, drawn, "Вопрос без границ", "Лев")
+        results[f"spread.{key}"] = {"cards": len(layout.positions), **_timings(run, iterations)}
+    return results
+
+
+# --- Синтетические базы ---
+
+
+def _selection_sizes() -> dict[str, int]:
+    """
+    Размеры наборов, по которым ходят курсоры SelectionState (как в _compose_horoscope).
+    """
+    import content
+
+    return {
+        "pair": len(content.get("horoscope_themes")) * len(content.get("horoscope_styles")),
+        "intro": len(content.get("horoscope_intros")),
+        "symbol": len(content.get("horoscope_symbols")),
+        "ending": len(content.get("horoscope_endings")),
+    }
+
+
+def _chunks(rows, size: int = _INSERT_CHUNK):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def build_database(path: str, users: int, seed: int = 0):
+    """
+    Синтетическая astro_bot.db на users пользователей со схемой create_tables().
+    История хранится так, как её пишет бот сейчас: курсоры выбора контента
+    (users.selection_state), последние карты (tarot_draws) и кольца цитат (quote_cursors).
+    Все пользователи получали гороскоп не сегодня — каждый может запросить новый.
+    """
+    import db
+    from quote_index import load_quotes
+    from selection import _SLOT, DIMENSIONS
+    from tarot import get_deck, sync_tarot_cards
+
+    rng = random.Random(seed)
+    sizes = _selection_sizes()
+    card_ids = [card.card_id for card in get_deck().cards]
+    quotes_count = max(1, len(load_quotes()))
+    statuses, weights = zip(*SUBSCRIPTIONS)
+    yesterday = (date.today() - timedelta(days=1)).isoformat()
+    today = date.today().toordinal()
+    now = datetime.utcnow()
+
+    if os.path.exists(path):
+        os.remove(path)
+    db.close_all_connections()
+    db.DB_PATH = path
+    db.create_tables()
+    sync_tarot_cards()
+    db.close_all_connections()
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+
+    def user_rows():
+        for user_id in range(1, users + 1):
+            active = rng.random() < ACTIVE_SHARE
+            blob = None
+            if active:
+                blob = b"".join(
+                    _SLOT.pack(sizes[d], rng.randrange(3), rng.randrange(sizes[d])) for d in DIMENSIONS
+                )
+            yield (
+                user_id,
+                rng.choice(ZODIAC_SIGNS),
+                rng.choices(statuses, weights)[0],
+                yesterday if active else None,
+                blob,
+            )
+
+    def draw_rows():
+        for user_id in range(1, users + 1):
+            if rng.random() >= TAROT_SHARE:
+                continue
+            count = rng.randint(1, TAROT_RECENT_WINDOW)
+            for i, card_id in enumerate(rng.sample(card_ids, count)):
+                drawn_at = now - timedelta(days=count - i)
+                yield user_id, card_id, drawn_at.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+    def cursor_rows():
+        for user_id in range(1, users + 1):
+            if rng.random() >= ACTIVE_SHARE:
+                continue
+            recent = [[today - 1, rng.randrange(quotes_count)]]
+            yield user_id, rng.randrange(3), rng.randrange(quotes_count), json.dumps(recent)
+
+    statements = (
+        ("INSERT INTO users (user_id, sign, subscription_status, last_gen_date, selection_state)"
+         " VALUES (?, ?, ?, ?, ?)", user_rows()),
+        ("INSERT INTO tarot_draws (user_id, card_id, drawn_at) VALUES (?, ?, ?)", draw_rows()),
+        ("INSERT INTO quote_cursors (user_id, cycle, position, recent) VALUES (?, ?, ?, ?)", cursor_rows()),
+    )
+    for sql, rows in statements:
+        for chunk in _chunks(rows):
+            conn.executemany(sql, chunk)
+        conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+def prepare_database(db_dir: str, users: int, seed: int, rebuild: bool = False) -> str:
+    """
+    Шаблон базы строится один раз и переиспользуется; замеры идут на копии,
+    чтобы каждый прогон начинался с одного и того же состояния.
+    """
+    os.makedirs(db_dir, exist_ok=True)
+    template = os.path.join(db_dir, f"users_{users}_seed_{seed}.db")
+    if rebuild or not os.path.exists(template):
+        started = time.perf_counter()
+        build_database(template + ".tmp", users, seed)
+        os.replace(template + ".tmp", template)
+        print(f"База на {users} пользователей собрана за {time.perf_counter() - started:.1f} с", file=sys.stderr)
+
+    working = os.path.join(db_dir, f"run_{users}.db")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(working + suffix):
+            os.remove(working + suffix)
+    shutil.copyfile(template, working)
+    return working
+
+
+def _use_database(path: str):
+    """
+    Переключаем бота на другую базу: закрываем соединения, сбрасываем кэши,
+    привязанные к старой базе.
+    """
+    import db
+    import horoscope
+    import quote_index
+    from cache import profile_cache
+    from repo import repo
+
+    repo.stop()
+    db.close_all_connections()
+    db.DB_PATH = path
+    quote_index._index = None
+    horoscope._quotes_cache = None
+    profile_cache.clear()
+
+
+# --- Замеры на базе ---
+
+
+def bench_database(users: int, iterations: int, seed: int) -> dict:
+    """
+    Одиночные вызовы горячих путей на текущей базе. Каждая итерация — другой
+    пользователь: гороскоп выдаётся раз в день, а история карт у каждого своя.
+    """
+    import main
+    import tarot
+    from db import get_user_sign, save_selection_state
+    from horoscope import deterministic_horoscope, generate_horoscope
+    from quote_index import get_quote_index
+
+    rng = random.Random(seed)
+    ids = rng.sample(range(1, users + 1), min(iterations, users))
+    signs = [get_user_sign(user_id) or "Лев" for user_id in ids]
+    get_quote_index()  # загрузка цитат — однократная, не часть замера
+    n = len(ids)
+    blob = bytes(48)
+
+    results = {}
+    random.seed(seed)
+    results["horoscope.generate"] = _timings(lambda i: generate_horoscope(ids[i], signs[i]), n)
+    results["horoscope.deterministic"] = _timings(lambda i: deterministic_horoscope(ids[i], signs[i]), n)
+    random.seed(seed)
+    results["tarot.one_card"] = _timings(lambda i: main.generate_tarot(ids[i], "Любовь", signs[i]), n)
+    random.seed(seed)
+    results["tarot.three_cards"] = _timings(lambda i: tarot.generate_tarot(ids[i], "Любовь", signs[i]), n)
+    results["selection.save"] = _timings(lambda i: save_selection_state(ids[i], blob), n)
+    return results
+
+
+def bench_daily_broadcast(seed: int) -> dict:
+    """
+    Полная send_daily_horoscope на FakeBot без лимитов Telegram:
+    выборка получателей, пакетная генерация в потоке БД и отправка.
+    """
+    from fake_bot import FakeBot
+    from jobs import send_daily_horoscope
+    from repo import repo
+
+    async def run():
+        bot = FakeBot()
+        try:
+            return await send_daily_horoscope(bot, rate=1e9, per_chat_interval=0)
+        finally:
+            repo.stop()
+
+    random.seed(seed)
+    started = time.perf_counter()
+    stats = asyncio.run(run())
+    elapsed = time.perf_counter() - started
+    return {
+        "messages": stats.sent,
+        "failed": stats.failed,
+        "seconds": elapsed,
+        "messages_per_s": stats.sent / elapsed if elapsed else 0.0,
+        "per_message_us": elapsed / stats.sent * 1e6 if stats.sent else 0.0,
+    }
+
+
+def bench_sharded_broadcast(shards: int, latency: float) -> dict:
+    """
+    Шардированная рассылка на FakeBot (задержка latency на сообщение) без лимитов Telegram.
+    """
+    import functools
+
+    from fake_bot import FakeBot
+    from jobs import send_daily_horoscope
+    from repo import repo
+
+    async def run():
+        try:
+            return await send_daily_horoscope(
+                FakeBot(), shards=shards, bot_factory=functools.partial(FakeBot, latency=latency),
+                rate=1e9, per_chat_interval=0,
+            )
+        finally:
+            repo.stop()
+
+    started = time.perf_counter()
+    stats = asyncio.run(run())
+    elapsed = time.perf_counter() - started
+    return {
+        "shards": shards,
+        "messages": stats.sent,
+        "failed": stats.failed,
+        "seconds": elapsed,
+        "messages_per_s": stats.sent / elapsed if elapsed else 0.0,
+        "per_message_us": elapsed / stats.sent * 1e6 if stats.sent else 0.0,
+    }
+
+
+# --- Холодный старт ---
+
+
+def bench_import(module: str, repeat: int = IMPORT_REPEAT) -> dict:
+    """
+    Импорт module в новом интерпретаторе (python -X importtime) из пустого каталога:
+    время (медиана и лучшее из repeat запусков), загруженные пакеты верхнего уровня
+    и файлы, созданные при импорте — импорт не должен открывать базу или читать data/.
+    Если замер не удался, RuntimeError с причиной.
+    """
+    env = {**os.environ, "PYTHONPATH": os.path.dirname(os.path.abspath(__file__))}
+    samples, packages, created_files = [], set(), set()
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as cwd:
+            proc = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                cwd=cwd, env=env, capture_output=True, text=True,
+            )
+            created = sorted(os.listdir(cwd))
+        if proc.returncode:
+            errors = [line for line in proc.stderr.splitlines() if not line.startswith("import time:")]
+            raise RuntimeError(errors[-1] if errors else f"код {proc.returncode}")
+        cumulative = None
+        for line in proc.stderr.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            _, us, name = line.split("|")
+            if not us.strip().isdigit():
+                continue  # заголовок
+            packages.add(name.strip().split(".")[0])
+            if name.strip() == module and not name[1:].startswith(" "):
+                cumulative = int(us)
+        if cumulative is None:
+            # Модуль не попал в вывод -X importtime: его загрузил сам интерпретатор или имя неверное
+            raise RuntimeError(f"нет замера для {module} в выводе python -X importtime")
+        samples.append(cumulative / 1000)
+        created_files.update(created)
+    return {
+        "ms": statistics.median(samples),
+        "min_ms": min(samples),
+        "packages": sorted(packages),
+        "created_files": sorted(created_files),
+    }
+
+
+def check_imports(budgets: dict = IMPORT_BUDGETS) -> tuple[dict, list[str]]:
+    """
+    Замеры холодного импорта и нарушения бюджета IMPORT_BUDGETS.
+    """
+    results, violations = {}, []
+    for module, (budget_ms, forbidden) in budgets.items():
+        try:
+            result = bench_import(module)
+        except RuntimeError as exc:
+            violations.append(f"{module}: импорт упал: {exc}")
+            continue
+        results[f"import.{module}"] = {
+            "ms": result["ms"], "min_ms": result["min_ms"], "budget_ms": budget_ms,
+            "created_files": result["created_files"],
+        }
+        if result["ms"] > budget_ms * (1 + IMPORT_TOLERANCE):
+            violations.append(f"{module}: импорт {result['ms']:.0f} мс (медиана), бюджет {budget_ms} мс")
+        loaded = sorted(set(forbidden) & set(result["packages"]))
+        if loaded:
+            violations.append(f"{module}: при импорте загружены {', '.join(loaded)}")
+        if result["created_files"]:
+            violations.append(f"{module}: при импорте созданы файлы {', '.join(result['created_files'])}")
+    return results, violations
+
+
+def run_suite(
+    sizes, iterations: int, seed: int, db_dir: str, rebuild: bool, broadcast: bool,
+    shard_counts=(), fake_latency: float = 0.0,
+) -> dict:
+    results = bench_spreads(iterations)
+    for users in sizes:
+        _use_database(prepare_database(db_dir, users, seed, rebuild))
+        for name, result in bench_database(users, iterations, seed).items():
+            results[f"{name}@{users}"] = result
+        if broadcast:
+            _use_database(prepare_database(db_dir, users, seed))
+            results[f"broadcast.daily@{users}"] = bench_daily_broadcast(seed)
+        for shards in shard_counts:
+            _use_database(prepare_database(db_dir, users, seed))
+            result = bench_sharded_broadcast(shards, fake_latency)
+            single = results.get(f"broadcast.sharded_1@{users}")
+            if single:
+                result["speedup"] = result["messages_per_s"] / single["messages_per_s"]
+            results[f"broadcast.sharded_{shards}@{users}"] = result
+    return results
+
+
+# --- Сравнение с эталоном ---
+
+
+def _score(result: dict) -> float | None:
+    """
+    Главная метрика замера: медиана одного вызова или время на одно сообщение рассылки.
+    """
+    for key in ("p50_us", "per_message_us"):
+        if key in result:
+            return result[key]
+    return None
+
+
+def compare(baseline: dict, current: dict, tolerance: float) -> list[str]:
+    """
+    Замеры, которые стали медленнее эталона больше чем на tolerance (0.2 = на 20%).
+    Замеры, которых нет в одном из прогонов, не сравниваются.
+    """
+    regressions = []
+    for name, result in current.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        before, after = _score(old), _score(result)
+        if not before or after is None:
+            continue
+        if after > before * (1 + tolerance):
+            regressions.append(f"{name}: {before:.1f} → {after:.1f} мкс (+{(after / before - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки горячих путей бота")
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument(
+        "--users", type=lambda s: [int(x) for x in s.split(",")], default=list(DEFAULT_SIZES),
+        help="размеры синтетических баз через запятую (по умолчанию 10000,100000,1000000)",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--db-dir", default=DEFAULT_DB_DIR, help="где хранить синтетические базы")
+    parser.add_argument("--rebuild", action="store_true", help="пересобрать базы, даже если они уже есть")
+    parser.add_argument("--no-broadcast", action="store_true", help="не запускать полную рассылку")
+    parser.add_argument(
+        "--shards", type=lambda s: [int(x) for x in s.split(",")], default=[],
+        help="шардированная рассылка: числа процессов через запятую, например 1,2,4,8",
+    )
+    parser.add_argument(
+        "--fake-latency", type=float, default=0.0, help="задержка FakeBot на сообщение в шардированной рассылке"
+    )
+    parser.add_argument("--output", help="записать результаты в файл (JSON)")
+    parser.add_argument("--baseline", help="JSON прошлого прогона: упасть, если что-то стало медленнее")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument(
+        "--imports", action="store_true",
+        help="только проверить холодный импорт модулей по бюджету IMPORT_BUDGETS (код 1 при нарушении)",
+    )
+    args = parser.parse_args()
+
+    if args.imports:
+        results, violations = check_imports()
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        if violations:
+            print("Бюджет холодного старта нарушен:", file=sys.stderr)
+            for line in violations:
+                print(f"  {line}", file=sys.stderr)
+            sys.exit(1)
+        print("Холодный импорт в бюджете", file=sys.stderr)
+        return
+
+    report = {
+        "meta": {
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "iterations": args.iterations,
+            "seed": args.seed,
+        },
+        "results": run_suite(
+            args.users, args.iterations, args.seed, args.db_dir, args.rebuild, not args.no_broadcast,
+            args.shards, args.fake_latency,
+        ),
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    print(output)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(baseline.get("results", baseline), report["results"], args.tolerance)
+        if regressions:
+            print(f"Замедление больше {args.tolerance:.0%}:", file=sys.stderr)
+            for line in regressions:
+                print(f"  {line}", file=sys.stderr)
+            sys.exit(1)
+        print(f"Регрессий нет (допуск {args.tolerance:.0%})", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, AsyncIterable, Awaitable, Callable, Iterable
+
+from metrics import BROADCAST_MESSAGES, BROADCAST_SEND_RATE, BROADCAST_RETRIES, BROADCAST_SECONDS
+from config import (
+    BROADCAST_CONCURRENCY,
+    BROADCAST_MAX_RETRIES,
+    BROADCAST_PER_CHAT_INTERVAL,
+    BROADCAST_RATE,
+    BROADCAST_UNDELIVERABLE_BATCH,
+)
+
+if TYPE_CHECKING:
+    from aiogram import Bot
+
+logger = logging.getLogger(__name__)
+
+# Отправитель: (chat_id, text) -> awaitable. Позволяет подменить Bot в тестах и бенчмарках.
+Sender = Callable[[int, str], Awaitable]
+Messages = Iterable[tuple[int, str]] | AsyncIterable[tuple[int, str]]
+# Вызывается после окончательного результата по сообщению:
+# (chat_id, отправлено ли, ошибка постоянная — повторять бессмысленно)
+ResultCallback = Callable[[int, bool, bool], Awaitable]
+# Получает пачку недоставляемых получателей: [(chat_id, причина), ...]
+UndeliverableCallback = Callable[[list[tuple[int, str]]], Awaitable]
+
+# Классы ошибок отправки
+FLOOD = "flood"  # flood control: ждём retry_after и притормаживаем всю рассылку
+TRANSIENT = "transient"  # сеть, 5xx: повторяем с паузой
+PERMANENT = "permanent"  # получатель недоступен: не повторяем и исключаем из рассылок
+OTHER = "other"  # прочие ошибки: не повторяем, но получателя не исключаем
+
+# Тексты ошибок Bot API, после которых получатель больше не доступен, и причина для delivery_status
+_UNDELIVERABLE = (
+    ("deactivated", "deactivated"),
+    ("bot was blocked", "blocked"),
+    ("bot was kicked", "blocked"),
+    ("chat not found", "not_found"),
+    ("user not found", "not_found"),
+    ("peer_id_invalid", "not_found"),
+)
+
+
+def classify_error(error: Exception) -> tuple[str, str | None]:
+    """
+    Класс ошибки отправки и, для постоянных, причина: blocked, deactivated или not_found.
+    """
+    # Импорт здесь: процессы, которые рассылают через FakeBot, не загружают aiogram
+    from aiogram.exceptions import (
+        TelegramBadRequest,
+        TelegramForbiddenError,
+        TelegramNetworkError,
+        TelegramNotFound,
+        TelegramRetryAfter,
+        TelegramServerError,
+    )
+
+    if isinstance(error, TelegramRetryAfter):
+        return FLOOD, None
+    if isinstance(error, (TelegramNetworkError, TelegramServerError)):
+        return TRANSIENT, None
+    if isinstance(error, (TelegramForbiddenError, TelegramBadRequest, TelegramNotFound)):
+        message = error.message.lower()
+        for needle, reason in _UNDELIVERABLE:
+            if needle in message:
+                return PERMANENT, reason
+        if isinstance(error, TelegramForbiddenError):
+            # Любой 403 при отправке в личку означает, что писать пользователю нельзя
+            return PERMANENT, "blocked"
+    return OTHER, None
+
+
+class TokenBucket:
+    """
+    Глобальный лимит отправки: rate токенов в секунду, не больше capacity про запас.
+    По умолчанию запаса нет — сообщения идут равномерно, без всплесков.
+    parent — вышестоящий лимит (например, общий на бота): токен нужен от обоих.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None, parent: "TokenBucket | None" = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else 1.0
+        self.parent = parent
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def pause(self, seconds: float):
+        """
+        Flood control от Telegram касается всего бота — останавливаем всех отправителей.
+        """
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0
+        self._updated = max(self._updated, self._paused_until)
+        if self.parent is not None:
+            self.parent.pause(seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    break
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+        if self.parent is not None:
+            await self.parent.acquire()
+
+
+# Лимит Telegram на весь бот: рассылки, идущие одновременно, делят его между собой
+telegram_bucket = TokenBucket(BROADCAST_RATE)
+
+
+@dataclass
+class BroadcastStats:
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    retries: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+    finished_at: float | None = None
+
+    @property
+    def elapsed(self) -> float:
+        end = self.finished_at if self.finished_at is not None else time.monotonic()
+        return end - self.started_at
+
+    @property
+    def rate(self) -> float:
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+
+def bot_sender(bot: "Bot") -> Sender:
+    async def send(chat_id: int, text: str):
+        return await bot.send_message(chat_id=chat_id, text=text)
+    return send
+
+
+class Broadcaster:
+    """
+    Рассылка с ограниченной конкурентностью, общим token bucket (~30 сообщений/с
+    у Telegram), лимитом на один чат и повторами:
+    - TelegramRetryAfter — ждём retry_after и притормаживаем всю рассылку;
+    - сетевые и 5xx ошибки — экспоненциальная пауза с jitter;
+    - остальные ошибки не повторяем; если получатель недоступен (бот заблокирован,
+      аккаунт удалён, чат не найден — см. classify_error), он пачками по
+      BROADCAST_UNDELIVERABLE_BATCH передаётся в on_undeliverable.
+    """
+
+    def __init__(
+        self,
+        sender: Sender,
+        name: str = "broadcast",
+        rate: float = BROADCAST_RATE,
+        concurrency: int = BROADCAST_CONCURRENCY,
+        per_chat_interval: float = BROADCAST_PER_CHAT_INTERVAL,
+        max_retries: int = BROADCAST_MAX_RETRIES,
+        bucket: TokenBucket | None = None,
+        on_result: ResultCallback | None = None,
+        on_undeliverable: UndeliverableCallback | None = None,
+    ):
+        self.sender = sender
+        self.on_result = on_result
+        self.on_undeliverable = on_undeliverable
+        self._undeliverable: list[tuple[int, str]] = []
+        self.name = name
+        self.concurrency = concurrency
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self.bucket = bucket or TokenBucket(rate)
+        # Только чаты, которым ещё рано писать снова; прошедшие записи чистит _prune_chats
+        self._chat_next_at: dict[int, float] = {}
+        self._chats_pruned_at = 0.0
+
+    def _prune_chats(self, now: float):
+        """
+        Раз в per_chat_interval выбрасываем чаты, для которых пауза уже прошла:
+        словарь держит только чаты последнего интервала, а не всех получателей.
+        """
+        if now - self._chats_pruned_at < self.per_chat_interval:
+            return
+        self._chats_pruned_at = now
+        self._chat_next_at = {chat_id: at for chat_id, at in self._chat_next_at.items() if at > now}
+
+    async def _wait_for_chat(self, chat_id: int):
+        now = time.monotonic()
+        self._prune_chats(now)
+        next_at = self._chat_next_at.get(chat_id, 0.0)
+        self._chat_next_at[chat_id] = max(now, next_at) + self.per_chat_interval
+        if next_at > now:
+            await asyncio.sleep(next_at - now)
+
+    async def send(self, chat_id: int, text: str, stats: BroadcastStats) -> tuple[bool, str | None]:
+        """
+        Отправляем с повторами. Возвращаем (отправлено ли, причина, если получатель недоступен).
+        """
+        attempt = 0
+        while True:
+            await self._wait_for_chat(chat_id)
+            await self.bucket.acquire()
+            try:
+                await self.sender(chat_id, text)
+                stats.sent += 1
+                BROADCAST_MESSAGES.inc(job=self.name, result="sent")
+                return True, None
+            except Exception as e:
+                kind, undeliverable = classify_error(e)
+                if kind == FLOOD:
+                    delay = e.retry_after + random.uniform(0, 1)
+                    reason = "retry_after"
+                    self.bucket.pause(delay)
+                elif kind == TRANSIENT:
+                    delay = (2 ** attempt) * random.uniform(0.5, 1.5)
+                    reason = "transient"
+                    logger.debug("Временная ошибка отправки в %s: %s", chat_id, e)
+                else:
+                    # Повторять бессмысленно
+                    logger.debug("Не удалось отправить сообщение в %s: %s", chat_id, e)
+                    stats.failed += 1
+                    BROADCAST_MESSAGES.inc(job=self.name, result="undeliverable" if undeliverable else "failed")
+                    return False, undeliverable
+
+            attempt += 1
+            if attempt > self.max_retries:
+                stats.failed += 1
+                BROADCAST_MESSAGES.inc(job=self.name, result="failed")
+                return False, None
+            stats.retries += 1
+            BROADCAST_RETRIES.inc(job=self.name, reason=reason)
+            await asyncio.sleep(delay)
+
+    async def _add_undeliverable(self, chat_id: int, reason: str):
+        self._undeliverable.append((chat_id, reason))
+        if len(self._undeliverable) >= BROADCAST_UNDELIVERABLE_BATCH:
+            await self._flush_undeliverable()
+
+    async def _flush_undeliverable(self):
+        batch, self._undeliverable = self._undeliverable, []
+        if not batch or self.on_undeliverable is None:
+            return
+        try:
+            await self.on_undeliverable(batch)
+        except Exception:
+            # Не страшно: в следующий раз ошибка повторится и получатель запишется снова
+            logger.exception("Не удалось записать недоставляемых получателей (%d)", len(batch))
+
+    async def run(self, messages: Messages, stats: BroadcastStats | None = None) -> BroadcastStats:
+        """
+        stats можно передать снаружи, чтобы следить за прогрессом во время рассылки.
+        """
+        stats = stats or BroadcastStats()
+        # Очередь ограничена — генерация текстов не убегает далеко вперёд отправки
+        pending: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def worker():
+            while True:
+                item = await pending.get()
+                if item is None:
+                    return
+                ok, undeliverable = await self.send(*item, stats)
+                if undeliverable is not None:
+                    await self._add_undeliverable(item[0], undeliverable)
+                if self.on_result is not None:
+                    await self.on_result(item[0], ok, undeliverable is not None)
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            if hasattr(messages, "__aiter__"):
+                async for item in messages:
+                    stats.total += 1
+                    await pending.put(item)
+            else:
+                for item in messages:
+                    stats.total += 1
+                    await pending.put(item)
+            for _ in workers:
+                await pending.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            await self._flush_undeliverable()
+        stats.finished_at = time.monotonic()
+        self._chat_next_at.clear()
+        BROADCAST_SEND_RATE.set(stats.rate, job=self.name)
+        BROADCAST_SECONDS.set(stats.elapsed, job=self.name)
+        return stats
+
+
+async def broadcast(messages: Messages, sender: Sender, name: str = "broadcast", **kwargs) -> BroadcastStats:
+    """
+    Разослать сообщения (chat_id, text) через sender и вернуть статистику.
+    name — имя рассылки для логов и метрик.
+    """
+    stats = await Broadcaster(sender, name=name, **kwargs).run(messages)
+    logger.info(
+        "Рассылка %s завершена: %d из %d отправлено, %d ошибок, %d повторов, %.1f сообщений/с",
+        name, stats.sent, stats.total, stats.failed, stats.retries, stats.rate,
+    )
+    return stats
@@ -0,0 +1,297 @@
+import asyncio
+import functools
+import logging
+import multiprocessing as mp
+import queue
+import time
+import traceback
+from typing import TYPE_CHECKING, Callable
+
+import db
+from broadcast import BroadcastStats, TokenBucket, bot_sender, telegram_bucket
+from storage import MemoryBackend, get_backend
+from config import BROADCAST_RATE, BROADCAST_SHARDS, BROADCAST_PROGRESS_INTERVAL
+from metrics import BROADCAST_MESSAGES, BROADCAST_RETRIES, BROADCAST_SECONDS, BROADCAST_SEND_RATE
+
+if TYPE_CHECKING:
+    from aiogram import Bot
+
+logger = logging.getLogger(__name__)
+
+# Создаёт отправителя в процессе шарда: объект с async send_message(chat_id, text)
+BotFactory = Callable[[], object]
+
+
+class SharedTokenBucket:
+    """
+    Token bucket, общий для нескольких процессов: состояние в разделяемой памяти
+    под межпроцессной блокировкой. Интерфейс тот же, что у broadcast.TokenBucket,
+    поэтому его можно передать в Broadcaster(bucket=...).
+    time.monotonic() общий для всех процессов машины.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0, context=None):
+        context = context or mp.get_context("spawn")
+        self.rate = rate
+        self.capacity = capacity
+        self._lock = context.Lock()
+        self._tokens = context.Value("d", capacity, lock=False)
+        self._updated = context.Value("d", time.monotonic(), lock=False)
+        self._paused_until = context.Value("d", 0.0, lock=False)
+        # Внутри процесса за токеном стоит одна корутина, остальные ждут своей очереди
+        self._local_lock: asyncio.Lock | None = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_local_lock"] = None
+        return state
+
+    def pause(self, seconds: float):
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until.value = max(self._paused_until.value, now + seconds)
+            self._tokens.value = 0
+            self._updated.value = max(self._updated.value, self._paused_until.value)
+
+    def _try_acquire(self) -> float:
+        """
+        Берём токен; возвращаем 0, если получилось, иначе — сколько подождать.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until.value:
+                return self._paused_until.value - now
+            elapsed = max(0.0, now - self._updated.value)
+            tokens = min(self.capacity, self._tokens.value + elapsed * self.rate)
+            self._updated.value = max(self._updated.value, now)
+            if tokens >= 1:
+                self._tokens.value = tokens - 1
+                return 0.0
+            self._tokens.value = tokens
+            return (1 - tokens) / self.rate
+
+    async def acquire(self):
+        if self._local_lock is None:
+            self._local_lock = asyncio.Lock()
+        async with self._local_lock:
+            while True:
+                delay = self._try_acquire()
+                if not delay:
+                    return
+                await asyncio.sleep(delay)
+
+
+def shard_of(user_id: int, shards: int) -> int:
+    return user_id % shards
+
+
+def telegram_bot(token: str) -> "Bot":
+    from aiogram import Bot
+
+    return Bot(token=token)
+
+
+_shared_bucket: SharedTokenBucket | None = None
+
+
+def share_telegram_bucket(context=None) -> SharedTokenBucket:
+    """
+    Делаем общий лимит бота межпроцессным: broadcast.telegram_bucket берёт токены
+    ещё и из SharedTokenBucket, который получают процессы-шарды. Вызывается
+    в процессе бота до запуска шардов; повторный вызов возвращает тот же лимит.
+    """
+    global _shared_bucket
+    if _shared_bucket is None:
+        _shared_bucket = SharedTokenBucket(telegram_bucket.rate, context=context or mp.get_context("spawn"))
+        telegram_bucket.parent = _shared_bucket
+    return _shared_bucket
+
+
+# --- Процесс шарда ---
+
+
+_RETRY_REASONS = ("retry_after", "transient")
+
+
+def _stats_dict(stats: BroadcastStats, name: str) -> dict:
+    return {
+        "total": stats.total,
+        "sent": stats.sent,
+        "failed": stats.failed,
+        "retries": {reason: BROADCAST_RETRIES.value(job=name, reason=reason) for reason in _RETRY_REASONS},
+    }
+
+
+async def _run_shard(shard: int, shards: int, campaign: str, plan: dict, progress, bot_factory: BotFactory):
+    # Импорт здесь: у каждого процесса свой поток БД
+    from jobs import fill_horoscope_outbox
+    from outbox import run_campaign
+    from repo import repo
+
+    bot = bot_factory()
+    stats = BroadcastStats()
+    name = plan["name"]
+
+    async def report():
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            progress.put(("progress", shard, _stats_dict(stats, name)))
+
+    reporter = asyncio.create_task(report())
+    try:
+        producer = None
+        if plan["generate"]:
+            pages = repo.iter_users_with_sign(
+                shard=(shard, shards), not_in_campaign=campaign, timezone=plan["timezone"]
+            )
+            producer = asyncio.create_task(
+                fill_horoscope_outbox(campaign, pages, rate=plan["pace"], mark_generated=False)
+            )
+        # Шард отправляет любые сообщения кампании, не только свои: outbox_claim раздаёт их без пересечений
+        bucket = TokenBucket(plan["rate"], parent=plan["parent"])
+        await run_campaign(
+            campaign, bot_sender(bot), name=name, producer=producer, stats=stats, bucket=bucket, **plan["options"]
+        )
+    finally:
+        reporter.cancel()
+        repo.stop()
+        session = getattr(bot, "session", None)
+        if session is not None:
+            await session.close()
+    return stats
+
+
+def _shard_main(shard: int, shards: int, campaign: str, plan: dict, progress, bot_factory: BotFactory, db_path: str):
+    # Шард работает с той же базой, что и координатор
+    db.DB_PATH = db_path
+    try:
+        stats = asyncio.run(_run_shard(shard, shards, campaign, plan, progress, bot_factory))
+        progress.put(("done", shard, _stats_dict(stats, plan["name"])))
+    except BaseException:
+        progress.put(("error", shard, traceback.format_exc()))
+
+
+# --- Координатор ---
+
+
+def _coordinate(
+    campaign: str, bot_factory: BotFactory, shards: int, plan: dict, context
+) -> tuple[BroadcastStats, bool]:
+    """
+    Запускаем шарды и ждём их, собирая прогресс. Возвращаем сложенную статистику
+    и признак того, что все шарды отработали без ошибок.
+    """
+    name = plan["name"]
+    progress = context.Queue()
+    merged = BroadcastStats()
+    per_shard = {shard: {"total": 0, "sent": 0, "failed": 0, "retries": {}} for shard in range(shards)}
+    errors = []
+
+    processes = [
+        context.Process(
+            target=_shard_main,
+            args=(shard, shards, campaign, plan, progress, bot_factory, db.DB_PATH),
+            name=f"{name}-shard-{shard}",
+        )
+        for shard in range(shards)
+    ]
+    for process in processes:
+        process.start()
+
+    running = set(range(shards))
+    while running:
+        try:
+            kind, shard, payload = progress.get(timeout=BROADCAST_PROGRESS_INTERVAL)
+        except queue.Empty:
+            for shard, process in enumerate(processes):
+                if shard in running and not process.is_alive():
+                    errors.append((shard, f"процесс завершился с кодом {process.exitcode}"))
+                    running.discard(shard)
+            continue
+        if kind == "error":
+            errors.append((shard, payload))
+            running.discard(shard)
+            continue
+        per_shard[shard] = payload
+        if kind == "done":
+            running.discard(shard)
+        sent = sum(item["sent"] for item in per_shard.values())
+        logger.info(
+            "%s: отправлено %d (%.0f/с), шардов в работе: %d",
+            campaign, sent, sent / merged.elapsed if merged.elapsed else 0.0, len(running),
+        )
+    for process in processes:
+        process.join()
+
+    for item in per_shard.values():
+        merged.total += item["total"]
+        merged.sent += item["sent"]
+        merged.failed += item["failed"]
+        merged.retries += sum(item["retries"].values())
+    merged.finished_at = time.monotonic()
+
+    # Метрики процессов-шардов остаются в них — переносим итог в метрики координатора
+    BROADCAST_MESSAGES.inc(merged.sent, job=name, result="sent")
+    BROADCAST_MESSAGES.inc(merged.failed, job=name, result="failed")
+    for reason in _RETRY_REASONS:
+        retries = sum(item["retries"].get(reason, 0) for item in per_shard.values())
+        if retries:
+            BROADCAST_RETRIES.inc(retries, job=name, reason=reason)
+    BROADCAST_SEND_RATE.set(merged.rate, job=name)
+    BROADCAST_SECONDS.set(merged.elapsed, job=name)
+
+    for shard, error in errors:
+        logger.error("%s: шард %d упал:\n%s", campaign, shard, error)
+    logger.info(
+        "Рассылка %s (%d шардов): отправлено %d из %d, ошибок %d, повторов %d, %.1f с (%.1f сообщений/с)",
+        campaign, shards, merged.sent, merged.total, merged.failed, merged.retries, merged.elapsed, merged.rate,
+    )
+    return merged, not errors
+
+
+async def run_sharded_campaign(
+    campaign: str,
+    bot_factory: BotFactory,
+    shards: int = BROADCAST_SHARDS,
+    rate: float = BROADCAST_RATE,
+    timezone: str | None = None,
+    generate: bool = True,
+    pace: float | None = None,
+    shared_limit: bool = True,
+    name: str = "daily_horoscope",
+    **options,
+) -> BroadcastStats:
+    """
+    Ежедневная рассылка кампании campaign в shards процессах. Каждый шард генерирует
+    гороскопы своей части получателей (user_id % shards, темп генерации — pace на все
+    шарды) прямо в outbox и отправляет сообщения кампании как ещё один отправитель
+    outbox.run_campaign: аренда сообщений исключает дубли, а упавшую рассылку
+    продолжит resume_broadcasts. Кампания отмечается сгенерированной, когда все
+    шарды закончили без ошибок.
+
+    Темп rate делится поровну между шардами; поверх него — общий лимит бота
+    (share_telegram_bucket) или, при shared_limit=False (бенчмарки), отдельный
+    SharedTokenBucket(rate) только на эти шарды. bot_factory создаёт Bot в процессе шарда.
+    """
+    from repo import repo
+
+    if isinstance(get_backend(db.DB_PATH), MemoryBackend):
+        raise ValueError("База в памяти не видна процессам-шардам — нужна база в файле")
+    context = mp.get_context("spawn")
+    parent = share_telegram_bucket(context) if shared_limit else SharedTokenBucket(rate, context=context)
+    plan = {
+        "name": name,
+        "timezone": timezone,
+        "generate": generate,
+        "pace": pace / shards if pace else None,
+        "rate": rate / shards,
+        "parent": parent,
+        "options": options,
+    }
+    loop = asyncio.get_running_loop()
+    stats, complete = await loop.run_in_executor(
+        None, functools.partial(_coordinate, campaign, bot_factory, shards, plan, context)
+    )
+    if generate and complete:
+        await repo.outbox_mark_generated(campaign)
+    return stats
@@ -0,0 +1,70 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+from config import PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL
+
+class LRUCache:
+    """
+    Потокобезопасный LRU-кэш с ограничением по размеру и времени жизни записи.
+    Считает попадания и промахи.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires_at, value = item
+                if expires_at > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
+
+
+class Profile(NamedTuple):
+    sign: str | None
+    subscription_status: str | None
+
+
+# Знак и статус подписки пользователя: меняются редко, а читаются почти в каждом хэндлере
+profile_cache = LRUCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
@@ -6,5 +6,100 @@ PAYMENT_PROVIDER_TOKEN = "YOUR_PAYMENT_PROVIDER_TOKEN"  # токен прова
 # Часовой пояс для планировщика (МСК)
 TIMEZONE = "Europe/Moscow"
 
-# Путь к SQLite базе данных
-DATABASE_URL = "sqlite:///astro_bot.db"  # Путь к файлу базы данных
\ No newline at end of file
+# Подключение к базе: sqlite:///путь — SQLite в файле, memory:// — в памяти процесса (см. storage.py)
+DATABASE_URL = "sqlite:///astro_bot.db"  # Путь к файлу базы данных
+
+# Рассылки: общий лимит Telegram (~30 сообщений/с), лимит на один чат и повторы
+BROADCAST_RATE = 30
+BROADCAST_CONCURRENCY = 30
+BROADCAST_PER_CHAT_INTERVAL = 1.0  # секунд между сообщениями в один чат
+BROADCAST_MAX_RETRIES = 3
+# Недоставляемые получатели (заблокировали бота, удалили аккаунт) записываются пачками по столько
+BROADCAST_UNDELIVERABLE_BATCH = 100
+
+# Сколько последних вытянутых карт Таро помнить, чтобы не повторять их в раскладах
+TAROT_RECENT_WINDOW = 12
+
+# Сколько гороскопов генерировать за один проход (одна транзакция) при рассылке;
+# получатели рассылок читаются из БД страницами того же размера
+HOROSCOPE_BATCH_SIZE = 500
+
+# Цитата дня не повторяется для пользователя в течение стольких дней
+QUOTE_REPEAT_DAYS = 2
+
+# Курсоры цитат в памяти процесса: максимум записей и время жизни записи (секунд).
+# Время жизни меньше суток: гороскоп выдаётся не чаще раза в сутки, поэтому следующий
+# выбор после рассылки в другом процессе (основной и обработчики webhook) читает курсор из БД
+QUOTE_CURSOR_CACHE_SIZE = 100_000
+QUOTE_CURSOR_CACHE_TTL = 12 * 3600
+
+# Контент (data/*.json, data/content.pack) перечитывается, если его файлы изменились:
+# проверка — не чаще раза в столько секунд в каждом процессе (0 — только при перезапуске)
+CONTENT_RELOAD_INTERVAL = 60
+
+# Кэш профилей (знак, статус подписки): максимум записей и время жизни записи (секунд)
+PROFILE_CACHE_SIZE = 100_000
+PROFILE_CACHE_TTL = 300
+
+# Метрики: Prometheus-эндпоинт /metrics (METRICS_PORT = None — выключить)
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+# Как часто (секунд) процессы-обработчики webhook передают свои метрики основному процессу
+METRICS_PUSH_INTERVAL = 5
+# Telegram id администраторов — им доступна команда /stats
+ADMIN_IDS: list[int] = []
+
+# Режим получения апдейтов: "polling" или "webhook" (переопределяется флагом --mode)
+BOT_MODE = "polling"
+# Webhook: публичный URL для setWebhook (пусто — не регистрировать автоматически),
+# адрес и путь локального сервера, секрет из заголовка X-Telegram-Bot-Api-Secret-Token.
+# Секрет обязателен: без него режим webhook не запускается
+WEBHOOK_URL = ""
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = ""
+# Процессы-обработчики (0 — по числу ядер), очередь апдейтов и одновременно
+# обрабатываемые апдейты в каждом процессе
+WEBHOOK_WORKERS = 0
+WEBHOOK_QUEUE_SIZE = 10_000
+WEBHOOK_WORKER_CONCURRENCY = 256
+
+# Ежедневная рассылка в нескольких процессах (1 — в процессе бота; шарды — отправители
+# одной кампании outbox под общим лимитом бота, см. broadcast_shards.py)
+# и как часто шарды сообщают о прогрессе (секунд)
+BROADCAST_SHARDS = 1
+BROADCAST_PROGRESS_INTERVAL = 5.0
+
+# Outbox рассылок: сколько сообщений забирать за раз, через сколько секунд
+# считать забранное, но не отмеченное сообщение потерянным, число попыток,
+# пауза перед повтором и сколько дней хранить кампании
+OUTBOX_CLAIM_BATCH = 200
+OUTBOX_LEASE = 300
+OUTBOX_MAX_ATTEMPTS = 3
+OUTBOX_RETRY_DELAY = 600
+OUTBOX_KEEP_DAYS = 7
+
+# Ежедневный гороскоп приходит в DAILY_HOROSCOPE_HOUR:00 по местному времени пользователя;
+# рассылка по каждому часовому поясу растягивается на DAILY_SPREAD_WINDOW секунд
+DAILY_HOROSCOPE_HOUR = 8
+DAILY_SPREAD_WINDOW = 1800
+
+# Детерминированный гороскоп: текст дня — функция (user_id, знак, дата, версия контента),
+# без записей в БД; HOROSCOPE_SEED — секретный ключ хэша (смена ключа меняет все тексты)
+HOROSCOPE_DETERMINISTIC = False
+HOROSCOPE_SEED = "change-me"
+
+# Отложенная запись состояния пользователей (см. writebehind.py): изменения копятся
+# в памяти и сбрасываются в БД раз в WRITE_BEHIND_INTERVAL_MS мс или при накоплении
+# WRITE_BEHIND_MAX_RECORDS записей. WRITE_BEHIND_JOURNAL — путь журнала, который
+# переживает падение процесса (пусто — без журнала), WRITE_BEHIND_FSYNC — fsync каждой записи журнала
+WRITE_BEHIND = False
+WRITE_BEHIND_INTERVAL_MS = 200
+WRITE_BEHIND_MAX_RECORDS = 1000
+WRITE_BEHIND_JOURNAL = ""
+WRITE_BEHIND_FSYNC = False
+
+# Миграции схемы (см. migrations.py) применяются при старте; False — только проверка,
+# миграции запускаются отдельным шагом: python migrations.py
+MIGRATE_ON_STARTUP = True
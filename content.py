@@ -0,0 +1,337 @@
+"""
+Текстовый контент бота (data/*.json).
+
+Для продакшена data/ компилируется в один бинарный пакет:
+
+    python content.py build
+
+Пакет открывается через mmap, строки декодируются лениво при обращении,
+поэтому старт не зависит от объёма контента, а несколько процессов делят
+одни и те же страницы через кэш ОС. Если пакета нет или он старее исходных
+JSON (режим разработки), контент читается прямо из JSON.
+
+Формат пакета:
+    MAGIC (8 байт) | длина каталога (uint32) | sha256(каталог + данные) (32 байта)
+    | версия исходников (32 байта) | каталог (JSON) | данные
+Версия исходников — sha256 JSON-файлов, из которых собран пакет: content.version()
+одинакова при чтении пакета и JSON, сборка пакета её не меняет.
+Работающий бот замечает изменение файлов контента (новый пакет или JSON) не позже
+чем через CONTENT_RELOAD_INTERVAL секунд и перечитывает их; вместе с версией
+пересобираются и производные кэши (колода Таро, цитаты детерминированного режима).
+Каталог описывает дерево: словари хранят ключи, строки и списки строк —
+смещения в области данных. Список строк — массив пар (смещение, длина) uint32.
+"""
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from collections.abc import Mapping, Sequence
+
+from config import CONTENT_RELOAD_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = "data"
+PACK_PATH = os.path.join(DATA_DIR, "content.pack")
+SOURCES = [
+    "horoscope_intros",
+    "horoscope_themes",
+    "horoscope_styles",
+    "horoscope_symbols",
+    "horoscope_endings",
+    "quotes",
+    "tarot_interpretations",
+]
+
+MAGIC = b"ASTROPK\x02"
+_HEADER = struct.Struct("<8sI32s32s")
+_SPAN = struct.Struct("<II")
+
+
+class ContentPackError(Exception):
+    pass
+
+
+# --- Сборка ---
+
+
+class _PackWriter:
+    def __init__(self):
+        self.data = bytearray()
+
+    def _string(self, value: str) -> tuple[int, int]:
+        raw = value.encode("utf-8")
+        offset = len(self.data)
+        self.data += raw
+        return offset, len(raw)
+
+    def node(self, value):
+        if isinstance(value, str):
+            offset, length = self._string(value)
+            return {"t": "s", "o": offset, "n": length}
+        if isinstance(value, list) and all(isinstance(item, str) for item in value):
+            spans = [self._string(item) for item in value]
+            offset = len(self.data)
+            for span in spans:
+                self.data += _SPAN.pack(*span)
+            return {"t": "l", "o": offset, "c": len(spans)}
+        if isinstance(value, dict):
+            return {"t": "d", "k": {key: self.node(item) for key, item in value.items()}}
+        # Прочие значения (числа, смешанные списки) храним прямо в каталоге
+        return {"t": "v", "v": value}
+
+
+def build_pack(data_dir: str = DATA_DIR, out_path: str = PACK_PATH) -> str:
+    """
+    Собираем пакет из JSON-файлов data_dir. Возвращаем версию контента.
+    """
+    writer = _PackWriter()
+    sources, version = _load_json(data_dir)
+    tables = {name: writer.node(value) for name, value in sources.items()}
+
+    directory = json.dumps({"tables": tables}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    checksum = hashlib.sha256(directory + writer.data).digest()
+
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, len(directory), checksum, bytes.fromhex(version)))
+        f.write(directory)
+        f.write(writer.data)
+    os.replace(tmp_path, out_path)
+    return version
+
+
+# --- Чтение ---
+
+
+class _PackList(Sequence):
+    __slots__ = ("_pack", "_offset", "_count")
+
+    def __init__(self, pack: "ContentPack", offset: int, count: int):
+        self._pack = pack
+        self._offset = offset
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        offset, length = _SPAN.unpack_from(self._pack.mm, self._pack.data_start + self._offset + index * _SPAN.size)
+        return self._pack.string(offset, length)
+
+
+class _PackDict(Mapping):
+    __slots__ = ("_pack", "_nodes", "_cache")
+
+    def __init__(self, pack: "ContentPack", nodes: dict):
+        self._pack = pack
+        self._nodes = nodes
+        self._cache = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._cache[key]
+        except KeyError:
+            value = self._cache[key] = self._pack.resolve(self._nodes[key])
+            return value
+
+    def __iter__(self):
+        return iter(self._nodes)
+
+    def __len__(self):
+        return len(self._nodes)
+
+
+class ContentPack:
+    """
+    Пакет контента, открытый через mmap. Значения резолвятся лениво.
+    """
+
+    def __init__(self, path: str = PACK_PATH, verify: bool = False):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < _HEADER.size:
+            raise ContentPackError(f"{path}: файл повреждён")
+        magic, directory_len, checksum, version = _HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ContentPackError(f"{path}: неизвестный формат")
+        self.checksum = checksum.hex()
+        self.version = version.hex()
+        self.data_start = _HEADER.size + directory_len
+        if verify and hashlib.sha256(self.mm[_HEADER.size:]).digest() != checksum:
+            raise ContentPackError(f"{path}: контрольная сумма не совпадает")
+        directory = json.loads(self.mm[_HEADER.size:self.data_start].decode("utf-8"))
+        self.tables = {name: self.resolve(node) for name, node in directory["tables"].items()}
+
+    def string(self, offset: int, length: int) -> str:
+        start = self.data_start + offset
+        return self.mm[start:start + length].decode("utf-8")
+
+    def resolve(self, node: dict):
+        kind = node["t"]
+        if kind == "s":
+            return self.string(node["o"], node["n"])
+        if kind == "l":
+            return _PackList(self, node["o"], node["c"])
+        if kind == "d":
+            return _PackDict(self, node["k"])
+        return node["v"]
+
+
+def _load_json(data_dir: str) -> tuple[dict, str]:
+    tables = {}
+    digest = hashlib.sha256()
+    for name in SOURCES:
+        with open(os.path.join(data_dir, f"{name}.json"), "rb") as f:
+            raw = f.read()
+        digest.update(raw)
+        tables[name] = json.loads(raw.decode("utf-8"))
+    return tables, digest.hexdigest()
+
+
+def _pack_is_fresh(pack_path: str, data_dir: str) -> bool:
+    if not os.path.exists(pack_path):
+        return False
+    pack_mtime = os.path.getmtime(pack_path)
+    return all(
+        os.path.getmtime(os.path.join(data_dir, f"{name}.json")) <= pack_mtime
+        for name in SOURCES
+        if os.path.exists(os.path.join(data_dir, f"{name}.json"))
+    )
+
+
+class Content:
+    """
+    Точка доступа к контенту: пакет, если он есть и свежий, иначе JSON.
+    Раз в check_interval секунд сверяет время изменения и размер файлов контента
+    и, если они изменились, перечитывает контент.
+    """
+
+    def __init__(self, data_dir: str = DATA_DIR, pack_path: str = PACK_PATH, check_interval: float = CONTENT_RELOAD_INTERVAL):
+        self.data_dir = data_dir
+        self.pack_path = pack_path
+        self.check_interval = check_interval
+        self._tables: dict | None = None
+        self._version: str | None = None
+        self._stamp: tuple | None = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _files_stamp(self) -> tuple:
+        stamp = []
+        for path in (self.pack_path, *(os.path.join(self.data_dir, f"{name}.json") for name in SOURCES)):
+            try:
+                st = os.stat(path)
+            except OSError:
+                stamp.append(None)
+            else:
+                stamp.append((st.st_mtime_ns, st.st_size))
+        return tuple(stamp)
+
+    def _read(self) -> tuple[dict, str]:
+        if _pack_is_fresh(self.pack_path, self.data_dir):
+            try:
+                pack = ContentPack(self.pack_path)
+            except ContentPackError as e:
+                logger.warning("%s — читаем JSON. Пересоберите: python content.py build", e)
+            else:
+                return pack.tables, pack.version
+        elif os.path.exists(self.pack_path):
+            logger.warning("%s старее data/*.json — читаем JSON. Пересоберите: python content.py build", self.pack_path)
+        return _load_json(self.data_dir)
+
+    def _load(self):
+        with self._lock:
+            if self._tables is not None:
+                return
+            # Отметку снимаем до чтения: изменение во время чтения заметит следующая проверка
+            self._stamp = self._files_stamp()
+            self._checked_at = time.monotonic()
+            self._tables, self._version = self._read()
+
+    def _refresh(self):
+        if not self.check_interval or time.monotonic() - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+            stamp = self._files_stamp()
+            if stamp == self._stamp:
+                return
+            # Пока читаем новое, остальные потоки продолжают работать со старым контентом
+            try:
+                tables, version = self._read()
+            except (OSError, ValueError):
+                # Файлы ещё дописываются — остаёмся на старом контенте до следующей проверки
+                logger.exception("Не удалось перечитать контент")
+                return
+            self._stamp = stamp
+            if version != self._version:
+                logger.info("Контент изменился (версия %s) — перечитан", version[:12])
+            self._tables, self._version = tables, version
+
+    def get(self, name: str):
+        if self._tables is None:
+            self._load()
+        else:
+            self._refresh()
+        return self._tables[name]
+
+    def version(self) -> str:
+        """
+        Версия контента (контрольная сумма): меняется, когда меняются данные.
+        """
+        if self._tables is None:
+            self._load()
+        else:
+            self._refresh()
+        return self._version
+
+    def reload(self):
+        """
+        Перечитать контент сейчас, не дожидаясь проверки файлов.
+        """
+        with self._lock:
+            self._checked_at = time.monotonic()
+            self._stamp = self._files_stamp()
+            self._tables, self._version = self._read()
+
+
+content = Content()
+
+
+def get(name: str):
+    return content.get(name)
+
+
+def version() -> str:
+    return content.version()
+
+
+def reload():
+    content.reload()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["build"]:
+        print(f"{PACK_PATH}: {build_pack()}")
+    elif sys.argv[1:] == ["verify"]:
+        ContentPack(PACK_PATH, verify=True)
+        print(f"{PACK_PATH}: OK")
+    else:
+        print("Использование: python content.py build|verify")
+        sys.exit(2)
@@ -1,286 +1,791 @@
 import sqlite3
 import json
-from config import DATABASE_URL
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from config import DATABASE_URL, MIGRATE_ON_STARTUP, TAROT_RECENT_WINDOW, TIMEZONE, WRITE_BEHIND
+from cache import Profile, profile_cache
+from metrics import db_timed
+from storage import get_backend
+from writebehind import QUOTE_CURSOR, USER_FIELDS, write_behind
+
+# База: URL (sqlite:///файл, memory://) или путь к файлу SQLite, по нему storage.py выбирает подключение.
+# Бенчмарки и шарды подменяют его до первого подключения
+DB_PATH = DATABASE_URL
+
+
+class _ThreadState(threading.local):
+    """
+    Состояние подключения, принадлежащее одному потоку:
+    само подключение, глубина вложенности transaction()
+    и действия, которые нужно выполнить при откате или после commit.
+    """
+    conn = None
+    depth = 0
+
+    def __init__(self):
+        self.on_rollback = []
+        self.on_commit = []
+
+
+_state = _ThreadState()
+_all_connections: set[sqlite3.Connection] = set()
+_all_connections_lock = threading.Lock()
+
+
+def _connect() -> sqlite3.Connection:
+    return get_backend(DB_PATH).connect()
 
 
 def get_db_connection():
     """
-    Возвращаем подключение к SQLite базе данных.
+    Возвращаем долгоживущее подключение к SQLite, принадлежащее текущему потоку.
+    Подключение открывается один раз на поток и переиспользуется, закрывать его не нужно.
     Если база не существует, она будет создана.
     """
-    conn = sqlite3.connect("astro_bot.db")  # SQLite база данных
-    conn.row_factory = sqlite3.Row  # Для удобства работы с результатами запросов (как с dict)
+    conn = _state.conn
+    if conn is None:
+        conn = _connect()
+        _state.conn = conn
+        with _all_connections_lock:
+            _all_connections.add(conn)
     return conn
 
 
-def create_tables():
+@contextmanager
+def transaction():
     """
-    Функция для создания таблиц, если они ещё не существуют.
+    Контекст транзакции. Вложенные вызовы (например, хелперы внутри одного
+    действия пользователя) не коммитят сами — commit делается один раз
+    при выходе из самого внешнего контекста, при ошибке — rollback.
     """
     conn = get_db_connection()
-    cur = conn.cursor()
-
-    # Создание таблицы пользователей
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        user_id BIGINT PRIMARY KEY,
-        sign TEXT,
-        birth_data DATE,
-        subscription_status TEXT DEFAULT 'free',
-        last_gen_date TIMESTAMP,
-        used_phrases TEXT DEFAULT '[]',  -- JSON-строка
-        tarot_history TEXT DEFAULT '[]'  -- JSON-строка
-    );
-    """)
-
-    # Создание таблицы цитат (для гороскопов)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS quotes (
-        quote_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        text TEXT NOT NULL,
-        last_used TIMESTAMP
-    );
-    """)
-
-    # Создание таблицы карт Таро
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS tarot_cards (
-        card_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        meaning TEXT NOT NULL
-    );
-    """)
-
-    # Создание таблицы истории цитат пользователя
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS user_quote_history (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        quote TEXT,
-        used_at DATETIME DEFAULT CURRENT_TIMESTAMP
-    );
-    """)
-
-    conn.commit()
-    cur.close()
+    _state.depth += 1
+    try:
+        yield conn
+    except BaseException:
+        _state.depth -= 1
+        if _state.depth == 0:
+            conn.rollback()
+            hooks, _state.on_rollback = _state.on_rollback, []
+            _state.on_commit = []
+            # Отменяем в обратном порядке: более поздние действия опираются на ранние
+            for hook in reversed(hooks):
+                hook()
+        raise
+    else:
+        _state.depth -= 1
+        if _state.depth == 0:
+            conn.commit()
+            _state.on_rollback = []
+            hooks, _state.on_commit = _state.on_commit, []
+            for hook in hooks:
+                hook()
+
+
+def on_rollback(hook):
+    """
+    Выполнить hook(), если текущая транзакция будет откачена
+    (например, чтобы сбросить кэш, обновлённый внутри неё).
+    """
+    _state.on_rollback.append(hook)
+
+
+def on_commit(hook):
+    """
+    Выполнить hook() после commit текущей транзакции.
+    """
+    _state.on_commit.append(hook)
+
+
+def close_db_connection():
+    """
+    Закрываем подключение текущего потока (например, при завершении рабочего потока).
+    """
+    conn = _state.conn
+    if conn is None:
+        return
+    _state.conn = None
+    _state.depth = 0
+    with _all_connections_lock:
+        _all_connections.discard(conn)
     conn.close()
 
+
+def close_all_connections():
+    """
+    Закрываем все открытые подключения (при остановке бота).
+    """
+    with _all_connections_lock:
+        connections = list(_all_connections)
+        _all_connections.clear()
+    for conn in connections:
+        try:
+            conn.close()
+        except sqlite3.ProgrammingError:
+            # Подключение принадлежит другому потоку — оно закроется вместе с ним
+            pass
+    _state.conn = None
+    _state.depth = 0
+
+
+@db_timed
+def create_tables():
+    """
+    Создаём или обновляем схему базы: применяем миграции (см. migrations.py).
+    Если MIGRATE_ON_STARTUP выключен, только проверяем, что схема актуальна —
+    миграции тогда запускаются отдельным шагом: python migrations.py.
+    """
+    import migrations
+
+    if MIGRATE_ON_STARTUP:
+        migrations.migrate()
+    else:
+        pending = migrations.pending_migrations()
+        if pending:
+            raise RuntimeError(
+                f"Схема базы устарела, не применены миграции {[version for version, _ in pending]}: "
+                "запустите python migrations.py"
+            )
+
     print("Таблицы созданы или уже существуют.")
 
 
-def ensure_user(user_id: int):
+def _add_column_if_missing(cur, table: str, column: str, declaration: str):
+    columns = {row[1] for row in cur.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+
+@db_timed
+def ensure_user(user_id: int, reactivate: bool = False):
     """
     Создаём запись пользователя, если её ещё нет.
+    reactivate — пользователь снова написал боту (/start): возвращаем его в рассылки.
+    """
+    with transaction() as conn:
+        cur = conn.execute(
+            """
+            INSERT OR IGNORE INTO users (user_id, subscription_status)
+            VALUES (?, 'free')
+            """,
+            (user_id,),
+        )
+        if cur.rowcount:
+            profile_cache.invalidate(user_id)
+        elif reactivate:
+            conn.execute(
+                "UPDATE users SET delivery_status = NULL WHERE user_id = ? AND delivery_status IS NOT NULL",
+                (user_id,),
+            )
+
+
+def _refresh_profile(conn, user_id: int):
+    """
+    Write-through: после изменения кладём в кэш актуальный профиль.
+    """
+    row = conn.execute(
+        "SELECT sign, subscription_status FROM users WHERE user_id = ?",
+        (user_id,),
+    ).fetchone()
+    profile_cache.set(user_id, Profile(row["sign"], row["subscription_status"]) if row else Profile(None, None))
+    on_rollback(lambda: profile_cache.invalidate(user_id))
+
+
+def get_user_profile(user_id: int) -> Profile:
+    """
+    Знак и статус подписки пользователя — из кэша, при промахе одним запросом из БД.
+    Для несуществующего пользователя возвращается Profile(None, None).
+    """
+    profile = profile_cache.get(user_id)
+    if profile is not None:
+        return profile
+    return load_user_profile(user_id)
+
+
+@db_timed
+def load_user_profile(user_id: int) -> Profile:
+    """
+    Читаем профиль из БД (минуя проверку кэша) и кладём его в кэш.
     """
     conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT OR IGNORE INTO users (user_id, subscription_status, used_phrases, tarot_history)
-        VALUES (?, 'free', '[]', '[]')
-        """,
+    row = conn.execute(
+        "SELECT sign, subscription_status FROM users WHERE user_id = ?",
         (user_id,),
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+    ).fetchone()
+    profile = Profile(row["sign"], row["subscription_status"]) if row else Profile(None, None)
+    profile_cache.set(user_id, profile)
+    return profile
 
 
+@db_timed
 def set_user_sign(user_id: int, sign: str):
     """
     Устанавливаем знак зодиака для пользователя.
     """
-    ensure_user(user_id)
+    with transaction() as conn:
+        ensure_user(user_id)
+        conn.execute(
+            """
+            UPDATE users
+            SET sign = ?
+            WHERE user_id = ?
+            """,
+            (sign, user_id),
+        )
+        _refresh_profile(conn, user_id)
+
+
+@db_timed
+def set_user_timezone(user_id: int, timezone: str):
+    """
+    Сохраняем часовой пояс пользователя (имя из базы IANA, например Asia/Novosibirsk).
+    """
+    with transaction() as conn:
+        ensure_user(user_id)
+        conn.execute("UPDATE users SET timezone = ? WHERE user_id = ?", (timezone, user_id))
+
+
+@db_timed
+def get_user_timezone(user_id: int) -> str:
     conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        UPDATE users
-        SET sign = ?
-        WHERE user_id = ?
-        """,
-        (sign, user_id),
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+    row = conn.execute("SELECT timezone FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    return (row["timezone"] if row else None) or TIMEZONE
+
+
+@db_timed
+def get_timezones() -> list[str]:
+    """
+    Часовые пояса, в которых есть пользователи (всегда включая TIMEZONE по умолчанию).
+    """
+    conn = get_db_connection()
+    rows = conn.execute("SELECT DISTINCT timezone FROM users WHERE timezone IS NOT NULL").fetchall()
+    return sorted({TIMEZONE, *(row["timezone"] for row in rows)})
 
 
 def get_user_sign(user_id: int) -> str | None:
     """
     Получаем знак зодиака пользователя.
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT sign FROM users WHERE user_id = ?", (user_id,))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
-    if row:
-        return row["sign"]
-    return None
+    return get_user_profile(user_id).sign
 
 
+@db_timed
 def update_subscription(user_id: int, status: str):
     """
     Обновляем статус подписки пользователя.
     """
-    ensure_user(user_id)
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "UPDATE users SET subscription_status = ? WHERE user_id = ?",
-        (status, user_id),
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+    with transaction() as conn:
+        ensure_user(user_id)
+        conn.execute(
+            "UPDATE users SET subscription_status = ? WHERE user_id = ?",
+            (status, user_id),
+        )
+        _refresh_profile(conn, user_id)
 
 
 def get_subscription_status(user_id: int) -> str | None:
     """
     Получаем статус подписки пользователя.
     """
+    return get_user_profile(user_id).subscription_status
+
+
+def _users_with_sign_where(
+    subscription_status: str | None,
+    shard: tuple[int, int] | None,
+    not_in_campaign: str | None,
+    timezone: str | None,
+) -> tuple[list[str], list]:
+    conditions = ["sign IS NOT NULL", "delivery_status IS NULL"]
+    params = []
+    if timezone is not None:
+        if timezone == TIMEZONE:
+            # Пользователи без пояса относятся к поясу по умолчанию. Не OR: так страница
+            # читается по idx_users_recipients в порядке user_id, без сортировки всего пояса
+            conditions.append("COALESCE(timezone, ?) = ?")
+            params.extend((timezone, timezone))
+        else:
+            conditions.append("timezone = ?")
+            params.append(timezone)
+    if not_in_campaign is not None:
+        conditions.append(
+            "NOT EXISTS (SELECT 1 FROM outbox WHERE outbox.campaign = ? AND outbox.user_id = users.user_id)"
+        )
+        params.append(not_in_campaign)
+    if subscription_status is not None:
+        conditions.append("subscription_status = ?")
+        params.append(subscription_status)
+    if shard is not None:
+        index, count = shard
+        conditions.append("user_id % ? = ?")
+        params.extend((count, index))
+    return conditions, params
+
+
+@db_timed
+def get_users_with_sign(
+    subscription_status: str | None = None,
+    shard: tuple[int, int] | None = None,
+    not_in_campaign: str | None = None,
+    timezone: str | None = None,
+    after_user_id: int | None = None,
+    limit: int | None = None,
+) -> list[tuple[int, str]]:
+    """
+    Получаем (user_id, sign) всех пользователей с выбранным знаком,
+    кроме недоставляемых (см. mark_undeliverable),
+    при необходимости — только с заданным статусом подписки.
+    shard=(номер, всего) — только пользователи шарда: user_id % всего == номер.
+    not_in_campaign — только те, кого ещё нет в outbox этой кампании.
+    timezone — только пользователи этого часового пояса.
+    after_user_id и limit — страница по возрастанию user_id (см. Repository.iter_users_with_sign).
+    """
+    conditions, params = _users_with_sign_where(subscription_status, shard, not_in_campaign, timezone)
+    return [(row["user_id"], row["sign"]) for row in _page(
+        f"SELECT user_id, sign FROM users WHERE {' AND '.join(conditions)}", params, after_user_id, limit
+    )]
+
+
+@db_timed
+def count_users_with_sign(
+    subscription_status: str | None = None,
+    shard: tuple[int, int] | None = None,
+    not_in_campaign: str | None = None,
+    timezone: str | None = None,
+) -> int:
+    """
+    Сколько пользователей вернёт get_users_with_sign с теми же условиями.
+    """
+    conditions, params = _users_with_sign_where(subscription_status, shard, not_in_campaign, timezone)
     conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT subscription_status FROM users WHERE user_id = ?",
-        (user_id,),
-    )
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
-    if row:
-        return row["subscription_status"]
-    return None
+    return conn.execute(f"SELECT COUNT(*) FROM users WHERE {' AND '.join(conditions)}", params).fetchone()[0]
 
 
-# --- Фразы для контроля уникальности ---
+@db_timed
+def get_users_by_subscription(status: str, after_user_id: int | None = None, limit: int | None = None) -> list[int]:
+    """
+    Получаем id пользователей с заданным статусом подписки, кроме недоставляемых
+    (after_user_id и limit — страница, как в get_users_with_sign).
+    """
+    return [row["user_id"] for row in _page(
+        "SELECT user_id FROM users WHERE subscription_status = ? AND delivery_status IS NULL",
+        [status], after_user_id, limit,
+    )]
 
 
-def get_used_phrases(user_id: int) -> list[str]:
+@db_timed
+def mark_undeliverable(recipients: list[tuple[int, str]]):
     """
-    Получаем использованные фразы пользователя для уникальности.
+    Получатели, которым сообщения больше не доходят: [(user_id, причина), ...].
+    Исключаются из рассылок, пока снова не напишут боту (ensure_user с reactivate).
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT used_phrases FROM users WHERE user_id = ?", (user_id,))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
-    if not row or row["used_phrases"] is None:
-        return []
-    try:
-        return json.loads(row["used_phrases"])
-    except (json.JSONDecodeError, TypeError):
-        return []
+    with transaction() as conn:
+        if WRITE_BEHIND:
+            # Отложенный /start не должен потом затереть более свежую ошибку доставки
+            flush_write_behind()
+        conn.executemany(
+            "UPDATE users SET delivery_status = ?, delivery_failures = delivery_failures + 1 WHERE user_id = ?",
+            [(reason, user_id) for user_id, reason in recipients],
+        )
 
 
-def save_user_phrase(user_id: int, phrase_key: str):
+def _page(query: str, params: list, after_user_id: int | None, limit: int | None) -> list:
     """
-    phrase_key — любая строка, по которой мы будем отслеживать повторы (например, theme|style|hash).
+    Keyset-пагинация: следующая страница начинается после последнего user_id
+    предыдущей, поэтому чтение страницы не зависит от того, сколько их уже прочитано.
     """
-    ensure_user(user_id)
-    phrases = get_used_phrases(user_id)
-    if phrase_key not in phrases:
-        phrases.append(phrase_key)
-    json_phrases = json.dumps(phrases)
+    if after_user_id is not None:
+        query += " AND user_id > ?"
+        params = [*params, after_user_id]
+    if limit is not None:
+        query += " ORDER BY user_id LIMIT ?"
+        params = [*params, limit]
+    return get_db_connection().execute(query, params).fetchall()
+
+
+# --- Состояние выбора контента (см. selection.py) ---
 
+
+@db_timed
+def get_selection_state(user_id: int) -> bytes | None:
+    """
+    Получаем курсоры неповторяющегося выбора контента (BLOB).
+    """
+    if WRITE_BEHIND:
+        pending, state = write_behind.user_field(user_id, "selection_state")
+        if pending:
+            return state
     conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "UPDATE users SET used_phrases = ? WHERE user_id = ?",
-        (json_phrases, user_id),
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+    row = conn.execute("SELECT selection_state FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    if not row:
+        return None
+    return row["selection_state"]
+
+
+@db_timed
+def save_selection_state(user_id: int, state: bytes):
+    """
+    Сохраняем курсоры неповторяющегося выбора контента.
+    """
+    if WRITE_BEHIND:
+        defer_user_update(user_id, selection_state=state)
+        return
+    with transaction() as conn:
+        ensure_user(user_id)
+        conn.execute(
+            "UPDATE users SET selection_state = ? WHERE user_id = ?",
+            (state, user_id),
+        )
 
 
 # --- Таро-история ---
 
 
-def get_tarot_history(user_id: int) -> list[str]:
+# Метка времени с миллисекундами — чтобы порядок раскладов внутри одной секунды сохранялся
+_NOW_MS = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+
+@db_timed
+def get_recent_tarot_card_ids(user_id: int, window: int = TAROT_RECENT_WINDOW) -> list[int]:
     """
-    Получаем историю раскладов Таро для пользователя.
+    Получаем id карт из последних window вытянутых пользователем (самые свежие — первыми).
     """
+    pending = write_behind.recent_card_ids(user_id) if WRITE_BEHIND else []
+    if len(pending) >= window:
+        return pending[:window]
     conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT tarot_history FROM users WHERE user_id = ?", (user_id,))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
-    if not row or row["tarot_history"] is None:
-        return []
-    try:
-        return json.loads(row["tarot_history"])
-    except (json.JSONDecodeError, TypeError):
-        return []
+    rows = conn.execute(
+        """
+        SELECT card_id FROM tarot_draws
+        WHERE user_id = ?
+        ORDER BY drawn_at DESC
+        LIMIT ?
+        """,
+        (user_id, window - len(pending)),
+    ).fetchall()
+    return pending + [row["card_id"] for row in rows]
 
 
-def save_tarot_history(user_id: int, card_names: list[str]):
+@db_timed
+def save_tarot_draws(user_id: int, card_ids: list[int], window: int = TAROT_RECENT_WINDOW):
     """
-    card_names — список имён карт (строки).
+    Записываем вытянутые карты и удаляем всё, что старше окна window:
+    история пользователя не растёт бесконечно.
     """
-    ensure_user(user_id)
-    history = get_tarot_history(user_id)
-    history.append(card_names)
-    json_history = json.dumps(history)
+    if WRITE_BEHIND:
+        drawn_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+        with transaction():
+            on_rollback(write_behind.add_draws(user_id, card_ids, drawn_at, window))
+        return
+    with transaction() as conn:
+        drawn_at = conn.execute(f"SELECT {_NOW_MS}").fetchone()[0]
+        conn.executemany(
+            "INSERT INTO tarot_draws (user_id, card_id, drawn_at) VALUES (?, ?, ?)",
+            [(user_id, card_id, drawn_at) for card_id in card_ids],
+        )
+        conn.execute(_PRUNE_TAROT_DRAWS, (user_id, user_id, window - 1))
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "UPDATE users SET tarot_history = ? WHERE user_id = ?",
-        (json_history, user_id),
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+
+_PRUNE_TAROT_DRAWS = """
+    DELETE FROM tarot_draws
+    WHERE user_id = ?
+      AND drawn_at < (
+          SELECT drawn_at FROM tarot_draws
+          WHERE user_id = ?
+          ORDER BY drawn_at DESC
+          LIMIT 1 OFFSET ?
+      )
+"""
+
+
+@db_timed
+def migrate_tarot_history(window: int = TAROT_RECENT_WINDOW) -> int:
+    """
+    Миграция 4 (см. migrations.py, вызывается после sync_tarot_cards):
+    переносим JSON из users.tarot_history в tarot_draws
+    (только последние window карт) и очищаем старую колонку.
+    Имена карт сопоставляются с tarot_cards, неизвестные пропускаются.
+    Возвращает число перенесённых пользователей.
+    """
+    with transaction() as conn:
+        rows = conn.execute(
+            """
+            SELECT user_id, tarot_history FROM users
+            WHERE tarot_history IS NOT NULL AND tarot_history NOT IN ('', '[]')
+            """
+        ).fetchall()
+        if not rows:
+            return 0
+
+        card_ids = {row["name"]: row["card_id"] for row in conn.execute("SELECT card_id, name FROM tarot_cards")}
+        base = datetime.utcnow()
+        draws = []
+        for row in rows:
+            try:
+                history = json.loads(row["tarot_history"])
+            except (json.JSONDecodeError, TypeError):
+                history = []
+            # Раньше сохранялся список раскладов (списков имён), поддерживаем и плоский список
+            names = []
+            for item in history:
+                names.extend(item if isinstance(item, list) else [item])
+            ids = [card_ids[name] for name in names if name in card_ids][-window:]
+            for i, card_id in enumerate(ids):
+                drawn_at = base - timedelta(milliseconds=len(ids) - i)
+                draws.append((row["user_id"], card_id, drawn_at.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]))
+
+        conn.executemany(
+            "INSERT INTO tarot_draws (user_id, card_id, drawn_at) VALUES (?, ?, ?)",
+            draws,
+        )
+        conn.executemany(
+            "UPDATE users SET tarot_history = '[]' WHERE user_id = ?",
+            [(row["user_id"],) for row in rows],
+        )
+    return len(rows)
 
 
-# --- История цитат ---
+# --- Отложенная запись (см. writebehind.py) ---
 
 
-def _get_unique_quote_for_user(user_id: int) -> str:
+def defer_user_update(user_id: int, **fields):
     """
-    Возвращает уникальную цитату, которую пользователь не видел за последние 2 дня.
+    Отложенно записываем поля пользователя; при откате текущей транзакции изменение отменяется.
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    # Получаем цитаты, которые пользователь **не видел за последние 2 дня**
-    cur.execute("""
-        SELECT quote FROM quotes 
-        WHERE quote NOT IN (
-            SELECT quote FROM user_quote_history 
-            WHERE user_id = ? AND used_at > datetime('now', '-2 days')
+    with transaction():
+        on_rollback(write_behind.update_user(user_id, **fields))
+
+
+@db_timed
+def flush_write_behind() -> int:
+    """
+    Записываем накопленные изменения одной транзакцией. Если транзакция
+    откатится, изменения вернутся в очередь. Возвращает число записей.
+    """
+    pending = write_behind.take()
+    if not pending:
+        return 0
+    with transaction() as conn:
+        on_rollback(lambda: write_behind.restore(pending))
+        on_commit(write_behind.committed)
+
+        by_fields: dict[tuple, list] = {}
+        for user_id, fields in pending.users.items():
+            columns = tuple(field for field in USER_FIELDS if field in fields)
+            by_fields.setdefault(columns, []).append((user_id, *(fields[column] for column in columns)))
+        for columns, rows in by_fields.items():
+            if not columns:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO users (user_id, subscription_status) VALUES (?, 'free')",
+                    rows,
+                )
+                continue
+            conn.executemany(
+                f"""
+                INSERT INTO users (user_id, subscription_status, {", ".join(columns)})
+                VALUES (?, 'free', {", ".join("?" * len(columns))})
+                ON CONFLICT(user_id) DO UPDATE SET {", ".join(f"{column} = excluded.{column}" for column in columns)}
+                """,
+                rows,
+            )
+        conn.executemany(
+            "INSERT OR REPLACE INTO quote_cursors (user_id, cycle, position, recent) VALUES (?, ?, ?, ?)",
+            [
+                (user_id, *_quote_cursor_row(fields[QUOTE_CURSOR]))
+                for user_id, fields in pending.users.items()
+                if QUOTE_CURSOR in fields
+            ],
         )
-        ORDER BY RANDOM() LIMIT 1
-    """, (user_id,))
-
-    result = cur.fetchone()
-    if result:
-        quote = result["quote"]
-        # Записываем, что пользователь получил эту цитату
-        cur.execute(
-            "INSERT INTO user_quote_history (user_id, quote, used_at) VALUES (?, ?, datetime('now'))",
-            (user_id, quote)
+
+        conn.executemany(
+            "INSERT INTO tarot_draws (user_id, card_id, drawn_at) VALUES (?, ?, ?)",
+            [
+                (user_id, card_id, drawn_at)
+                for user_id, entries in pending.draws.items()
+                for card_ids, drawn_at, _ in entries
+                for card_id in card_ids
+            ],
         )
-        conn.commit()
-    else:
-        # Если все цитаты были — сбросим историю
-        cur.execute("DELETE FROM user_quote_history WHERE user_id = ?", (user_id,))
-        conn.commit()
-        # И снова получим случайную
-        cur.execute("SELECT quote FROM quotes ORDER BY RANDOM() LIMIT 1")
-        result = cur.fetchone()
-        quote = result["quote"] if result else "Вселенная молчит... Но слушай внимательно."
-        cur.execute(
-            "INSERT INTO user_quote_history (user_id, quote, used_at) VALUES (?, ?, datetime('now'))",
-            (user_id, quote)
+        conn.executemany(
+            _PRUNE_TAROT_DRAWS,
+            [(user_id, user_id, min(entry[2] for entry in entries) - 1) for user_id, entries in pending.draws.items()],
         )
-        conn.commit()
+    return len(pending)
 
-    cur.close()
-    conn.close()
-    return quote
+
+def _quote_cursor_row(value: str) -> tuple[int, int, str]:
+    cycle, position, recent = json.loads(value)
+    return cycle, position, json.dumps(recent)
+
+
+def recover_write_behind() -> int:
+    """
+    При старте: записываем в БД изменения из журналов процессов, упавших до сброса.
+    """
+    recovered = write_behind.recover()
+    if recovered:
+        flush_write_behind()
+    return recovered
+
+
+# --- Outbox рассылок ---
+
+
+@db_timed
+def outbox_add(campaign: str, messages: list[tuple[int, str]]) -> int:
+    """
+    Кладём сообщения (user_id, text) в outbox кампании. Получатели, которые
+    там уже есть, пропускаются — повторный вызов ничего не дублирует.
+    Возвращает число добавленных строк.
+    """
+    now = time.time()
+    with transaction() as conn:
+        before = conn.total_changes
+        conn.executemany(
+            "INSERT OR IGNORE INTO outbox (campaign, user_id, text, created_at) VALUES (?, ?, ?, ?)",
+            [(campaign, user_id, text, now) for user_id, text in messages],
+        )
+        return conn.total_changes - before
+
+
+@db_timed
+def outbox_claim(campaign: str, limit: int, lease: float) -> list[tuple[int, str]]:
+    """
+    Забираем до limit сообщений, готовых к отправке: ожидающие, у которых подошло
+    время попытки, и «зависшие» в sending дольше lease секунд (процесс упал,
+    не успев отметить результат). Забранные строки получают статус sending —
+    другой отправитель их не возьмёт, пока не истечёт lease.
+    """
+    now = time.time()
+    with transaction() as conn:
+        rows = conn.execute(
+            """
+            UPDATE outbox SET status = 'sending', attempts = attempts + 1, next_attempt_at = ?
+            WHERE id IN (
+                SELECT id FROM outbox
+                WHERE campaign = ?
+                  AND status IN ('pending', 'sending')
+                  AND next_attempt_at <= ?
+                ORDER BY next_attempt_at
+                LIMIT ?
+            )
+            RETURNING user_id, text
+            """,
+            (now + lease, campaign, now, limit),
+        ).fetchall()
+    return [(row["user_id"], row["text"]) for row in rows]
+
+
+@db_timed
+def outbox_extend_lease(campaign: str, user_ids: list[int], lease: float):
+    """
+    Продлеваем аренду забранных сообщений, которые ещё ждут отправки
+    (в очереди рассылки, на паузе retry_after): ещё lease секунд их никто не заберёт.
+    """
+    until = time.time() + lease
+    with transaction() as conn:
+        conn.executemany(
+            "UPDATE outbox SET next_attempt_at = ? WHERE campaign = ? AND user_id = ? AND status = 'sending'",
+            [(until, campaign, user_id) for user_id in user_ids],
+        )
+
+
+@db_timed
+def outbox_mark_sent(campaign: str, user_id: int):
+    """
+    Отмечаем сообщение отправленным. Повторная отметка ничего не меняет.
+    """
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE outbox SET status = 'sent', sent_at = ? WHERE campaign = ? AND user_id = ? AND status != 'sent'",
+            (time.time(), campaign, user_id),
+        )
+
+
+@db_timed
+def outbox_mark_failed(campaign: str, user_id: int, max_attempts: int, retry_delay: float):
+    """
+    Неудачная отправка: пока попытки не исчерпаны — вернуть в очередь
+    через retry_delay секунд, иначе — окончательно failed.
+    """
+    with transaction() as conn:
+        conn.execute(
+            """
+            UPDATE outbox
+            SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                next_attempt_at = ?
+            WHERE campaign = ? AND user_id = ? AND status = 'sending'
+            """,
+            (max_attempts, time.time() + retry_delay, campaign, user_id),
+        )
+
+
+@db_timed
+def outbox_progress(campaign: str) -> dict[str, int]:
+    """
+    Число сообщений кампании по статусам.
+    """
+    conn = get_db_connection()
+    rows = conn.execute(
+        "SELECT status, COUNT(*) AS n FROM outbox WHERE campaign = ? GROUP BY status", (campaign,)
+    ).fetchall()
+    return {row["status"]: row["n"] for row in rows}
+
+
+@db_timed
+def outbox_next_attempt_in(campaign: str) -> float | None:
+    """
+    Через сколько секунд появится следующее сообщение для отправки;
+    None — неотправленных сообщений в кампании не осталось.
+    """
+    conn = get_db_connection()
+    row = conn.execute(
+        "SELECT MIN(next_attempt_at) AS at FROM outbox WHERE campaign = ? AND status IN ('pending', 'sending')",
+        (campaign,),
+    ).fetchone()
+    if row["at"] is None:
+        return None
+    return max(0.0, row["at"] - time.time())
+
+
+@db_timed
+def outbox_mark_generated(campaign: str):
+    """
+    Генерация кампании закончена: все её получатели уже в outbox.
+    """
+    with transaction() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO outbox_campaigns (campaign, generated_at) VALUES (?, ?)", (campaign, time.time())
+        )
+
+
+@db_timed
+def outbox_is_generated(campaign: str) -> bool:
+    conn = get_db_connection()
+    return conn.execute("SELECT 1 FROM outbox_campaigns WHERE campaign = ?", (campaign,)).fetchone() is not None
+
+
+@db_timed
+def outbox_unfinished_campaigns() -> list[str]:
+    """
+    Кампании, в которых остались неотправленные сообщения.
+    """
+    conn = get_db_connection()
+    rows = conn.execute(
+        "SELECT DISTINCT campaign FROM outbox WHERE status IN ('pending', 'sending') ORDER BY campaign"
+    ).fetchall()
+    return [row["campaign"] for row in rows]
+
+
+@db_timed
+def outbox_prune(keep_days: int) -> int:
+    """
+    Удаляем строки кампаний старше keep_days дней.
+    """
+    cutoff = time.time() - keep_days * 86400
+    with transaction() as conn:
+        cur = conn.execute("DELETE FROM outbox WHERE created_at < ?", (cutoff,))
+        conn.execute("DELETE FROM outbox_campaigns WHERE generated_at < ?", (cutoff,))
+        return cur.rowcount
@@ -0,0 +1,48 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+
+
+@dataclass
+class SentMessage:
+    chat_id: int
+    text: str
+    at: float
+
+
+@dataclass
+class FakeBot:
+    """
+    Локальная замена aiogram.Bot для тестов и бенчмарков рассылок.
+    Ничего не отправляет — только записывает, кому и когда было отправлено сообщение.
+
+    latency — имитация задержки сети на одно сообщение (секунды);
+    errors — исключения, которые нужно бросить для chat_id (по одному на попытку).
+    """
+    latency: float = 0.0
+    errors: dict[int, list[Exception]] = field(default_factory=dict)
+    sent: list[SentMessage] = field(default_factory=list)
+    attempts: int = 0
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        self.attempts += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        pending = self.errors.get(chat_id)
+        if pending:
+            raise pending.pop(0)
+        self.sent.append(SentMessage(chat_id=chat_id, text=text, at=time.monotonic()))
+        return True
+
+    def max_rate(self, window: float = 1.0) -> int:
+        """
+        Максимальное число сообщений, отправленных за любое окно длиной window секунд.
+        """
+        times = sorted(m.at for m in self.sent)
+        best = 0
+        start = 0
+        for end, t in enumerate(times):
+            while t - times[start] > window:
+                start += 1
+            best = max(best, end - start + 1)
+        return best
@@ -1,146 +1,109 @@
+import hashlib
 import random
-import json
-from datetime import datetime, timedelta
-from db import get_db_connection, get_used_phrases, save_user_phrase
-
-
-# Загрузка данных из JSON-файлов
-def load_data(filename):
-    with open(f"data/{filename}", "r", encoding="utf-8") as f:
-        return json.load(f)
-
-
-# Загрузка всех данных
-INTROS = load_data("horoscope_intros.json")
-THEMES = list(load_data("horoscope_themes.json").keys())
-THEME_LINES = load_data("horoscope_themes.json")
-STYLES = list(load_data("horoscope_styles.json").keys())
-STYLE_LINES = load_data("horoscope_styles.json")
-SYMBOLS = load_data("horoscope_symbols.json")
-ENDINGS = load_data("horoscope_endings.json")
-QUOTES = load_data("quotes.json")
+import content
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from zoneinfo import ZoneInfo
+from config import HOROSCOPE_DETERMINISTIC, HOROSCOPE_SEED, TIMEZONE, WRITE_BEHIND
+from db import (
+    get_db_connection, transaction, get_selection_state, save_selection_state, outbox_add,
+    defer_user_update, flush_write_behind,
+)
+from permutation import make_key
+from quote_index import DEFAULT_QUOTE, get_quote_index, load_quotes
+from selection import DaySelection, SelectionState
+from writebehind import write_behind
 
 
 def _get_unique_quote_for_user(user_id: int) -> str:
     """
-    Берём случайную цитату, которая не использовалась последние 2 дня.
-    Если нет — возвращаем случайную.
+    Цитата, которую пользователь не видел последние 2 дня (см. quote_index.py).
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT quote_id, text
-        FROM quotes
-        WHERE last_used IS NULL
-           OR last_used < datetime('now', '-2 days')
-        ORDER BY RANDOM()
-        LIMIT 1
-        """
-    )
-    row = cur.fetchone()
-    if not row:
-        cur.close()
-        conn.close()
-        return random.choice(QUOTES)
-
-    quote_id, text = row
-    # обновляем last_used
-    cur.execute(
-        "UPDATE quotes SET last_used = datetime('now') WHERE quote_id = ?",
-        (quote_id,)
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
-    return text
+    return get_quote_index().draw(user_id)
 
 
 def can_generate_horoscope(user_id: int) -> bool:
     """
     Проверяем, прошёл ли 1 день с последнего запроса.
     """
+    if WRITE_BEHIND:
+        pending, last_gen_date = write_behind.user_field(user_id, "last_gen_date")
+        if pending:
+            return _can_generate(last_gen_date)
     conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
+    row = conn.execute(
         "SELECT last_gen_date FROM users WHERE user_id = ?",
         (user_id,)
-    )
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
+    ).fetchone()
 
-    if not row or not row["last_gen_date"]:
+    return _can_generate(row["last_gen_date"] if row else None)
+
+
+def _can_generate(last_gen_date: str | None) -> bool:
+    if not last_gen_date:
         return True  # Первый запрос — разрешён
 
-    last_gen = datetime.fromisoformat(row["last_gen_date"])
+    last_gen = datetime.fromisoformat(last_gen_date)
     now = datetime.now()
     if now - last_gen >= timedelta(days=1):
         return True
     return False
 
 
+def _generated_on(last_gen_date: str | None, timezone: str) -> date | None:
+    """
+    Местная дата (в поясе timezone) последней генерации; last_gen_date — в UTC, как datetime('now').
+    """
+    if not last_gen_date:
+        return None
+    last_gen = datetime.fromisoformat(last_gen_date).replace(tzinfo=dt_timezone.utc)
+    return last_gen.astimezone(ZoneInfo(timezone)).date()
+
+
 def update_last_gen_date(user_id: int):
     """
     Обновляем дату последнего запроса.
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "UPDATE users SET last_gen_date = datetime('now') WHERE user_id = ?",
-        (user_id,)
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+    if WRITE_BEHIND:
+        # Тот же формат, что у datetime('now')
+        defer_user_update(user_id, last_gen_date=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))
+        return
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE users SET last_gen_date = datetime('now') WHERE user_id = ?",
+            (user_id,)
+        )
 
 
-def generate_horoscope(user_id: int, sign: str) -> str:
+ALREADY_GENERATED_TEXT = "🌙 Ты уже получил сегодняшний гороскоп. Приходи завтра — звёзды подготовят новый."
+
+
+def _compose_horoscope(sign: str, selection, quote_source, rng=random) -> str:
     """
-    Генерация уникального гороскопа с рандомизацией:
-    - интро
-    - тема
-    - стиль
-    - символ дня
-    - цитата
-    - финал
+    Собираем текст. Пара тема|стиль, интро, символ и финал берутся из курсоров
+    пользователя (без повторов в пределах круга), строки темы и стиля — случайно
+    (через rng). quote_source вызывается в одном и том же месте — одиночный
+    и пакетный путь дают одинаковые тексты.
     """
-    if not can_generate_horoscope(user_id):
-        return "🌙 Ты уже получил сегодняшний гороскоп. Приходи завтра — звёзды подготовят новый."
-
-    used = set(get_used_phrases(user_id))
-
-    # Пытаемся найти комбинацию, которой ещё не было
-    attempts = 0
-    max_attempts = 10
-    theme = None
-    style = None
-
-    while attempts < max_attempts:
-        candidate_theme = random.choice(THEMES)
-        candidate_style = random.choice(STYLES)
-        key = f"{candidate_theme}|{candidate_style}"
-        if key not in used:
-            theme = candidate_theme
-            style = candidate_style
-            save_user_phrase(user_id, key)
-            break
-        attempts += 1
-
-    # если всё уже использовали — всё равно выбираем что-то, но без сохранения
-    if theme is None or style is None:
-        theme = random.choice(THEMES)
-        style = random.choice(STYLES)
-
-    # Собираем текст
-    intro = random.choice(INTROS).format(sign=sign)
-    theme_line = random.choice(THEME_LINES[theme])
-    style_line = random.choice(STYLE_LINES[style])
-    symbol = random.choice(SYMBOLS)
-    quote = _get_unique_quote_for_user(user_id)
-    ending = random.choice(ENDINGS)
-
-    text = "\n".join([
+    themes = content.get("horoscope_themes")
+    styles = content.get("horoscope_styles")
+    theme_names = list(themes)
+    style_names = list(styles)
+    intros = content.get("horoscope_intros")
+    symbols = content.get("horoscope_symbols")
+    endings = content.get("horoscope_endings")
+
+    pair = selection.next("pair", len(theme_names) * len(style_names))
+    theme = theme_names[pair // len(style_names)]
+    style = style_names[pair % len(style_names)]
+
+    intro = intros[selection.next("intro", len(intros))].format(sign=sign)
+    theme_line = rng.choice(themes[theme])
+    style_line = rng.choice(styles[style])
+    symbol = symbols[selection.next("symbol", len(symbols))]
+    quote = quote_source()
+    ending = endings[selection.next("ending", len(endings))]
+
+    return "\n".join([
         intro,
         theme_line,
         style_line,
@@ -151,7 +114,184 @@ def generate_horoscope(user_id: int, sign: str) -> str:
         ending
     ])
 
-    # Обновляем дату последнего запроса
-    update_last_gen_date(user_id)
 
-    return text
\ No newline at end of file
+# Ключ хэша для детерминированного режима (blake2b принимает ключ до 64 байт)
+_SEED_KEY = hashlib.blake2b(HOROSCOPE_SEED.encode("utf-8"), digest_size=32).digest()
+
+# Цитаты детерминированного режима: (версия контента, версия контента и цитат, цитаты)
+_quotes_cache: tuple[str, str, list[str]] | None = None
+
+
+def load_day_quotes():
+    """
+    Читаем цитаты для детерминированного режима. Это запрос к БД — вызывается
+    в потоке БД: при старте (main) или из Repository.generate_horoscope.
+    В версию входит контрольная сумма цитат: правка таблицы quotes меняет
+    тексты так же, как смена контента.
+    """
+    global _quotes_cache
+    content_version = content.version()
+    quotes = load_quotes()
+    digest = hashlib.blake2b(content_version.encode("utf-8"), digest_size=8)
+    for quote in quotes:
+        digest.update(quote.encode("utf-8") + b"\0")
+    _quotes_cache = (content_version, f"{content_version}|{digest.hexdigest()}", quotes)
+
+
+def day_quotes_loaded() -> bool:
+    """
+    Цитаты загружены и контент с тех пор не менялся.
+    """
+    return _quotes_cache is not None and _quotes_cache[0] == content.version()
+
+
+def deterministic_horoscope(user_id: int, sign: str, day: date | None = None) -> str:
+    """
+    Гороскоп дня как чистая функция (user_id, знак, дата, версия контента и цитат):
+    ничего не пишет в БД, любой процесс получит тот же текст. Цитаты читаются
+    из БД один раз (load_day_quotes), если их ещё не загрузили.
+    Интро, пара тема|стиль, символ, цитата и финал — из перестановок по номеру
+    дня (без повторов в пределах круга), строки темы и стиля — из генератора,
+    засеянного ключевым хэшем тех же четырёх значений.
+    """
+    day = day or date.today()
+    if not day_quotes_loaded():
+        load_day_quotes()
+    _, version, quotes = _quotes_cache
+    digest = hashlib.blake2b(
+        make_key(user_id, sign, day.isoformat(), version), key=_SEED_KEY, digest_size=8
+    ).digest()
+    rng = random.Random(int.from_bytes(digest, "little"))
+    selection = DaySelection(user_id, day.toordinal(), salt=f"{_SEED_KEY.hex()}|{version}")
+
+    def quote_source():
+        if not quotes:
+            return DEFAULT_QUOTE
+        return quotes[selection.next("quote", len(quotes))]
+
+    return _compose_horoscope(sign, selection, quote_source, rng)
+
+
+def generate_horoscope(user_id: int, sign: str) -> str:
+    """
+    Генерация уникального гороскопа с рандомизацией:
+    - интро
+    - тема
+    - стиль
+    - символ дня
+    - цитата
+    - финал
+    """
+    if HOROSCOPE_DETERMINISTIC:
+        # Текст дня вычисляется заново при каждом запросе — записывать нечего
+        return deterministic_horoscope(user_id, sign)
+
+    # Все записи одного запроса коммитятся одной транзакцией
+    with transaction():
+        if not can_generate_horoscope(user_id):
+            return ALREADY_GENERATED_TEXT
+
+        selection = SelectionState.from_blob(user_id, get_selection_state(user_id))
+        text = _compose_horoscope(sign, selection, lambda: _get_unique_quote_for_user(user_id))
+        save_selection_state(user_id, selection.to_blob())
+
+        # Обновляем дату последнего запроса
+        update_last_gen_date(user_id)
+
+        return text
+
+
+# Ограничение SQLite на число параметров в одном запросе
+_MAX_SQL_PARAMS = 900
+
+
+def generate_horoscopes(
+    batch: list[tuple[int, str]], day: date | None = None, timezone: str = TIMEZONE
+) -> list[str]:
+    """
+    Пакетная генерация для рассылок: batch — список (user_id, sign).
+    Состояние всех пользователей читается одним запросом, тексты собираются
+    в памяти, все изменения записываются одной транзакцией через executemany.
+    Результат — те же тексты, что дал бы generate_horoscope для каждого по очереди.
+    day — местная дата рассылки в поясе timezone: тогда гороскоп получает каждый,
+    у кого его ещё не было в эту дату. Сутки с прошлой генерации тут не годятся:
+    время рассылки от дня ко дню сдвигается, и вчерашний получатель иначе
+    пропустил бы сегодняшнюю.
+    """
+    if not batch:
+        return []
+    if HOROSCOPE_DETERMINISTIC:
+        return [deterministic_horoscope(user_id, sign) for user_id, sign in batch]
+
+    with transaction() as conn:
+        if WRITE_BEHIND:
+            # Пакет пишет напрямую — сначала сбрасываем отложенное, иначе оно потом перезапишет новое
+            flush_write_behind()
+        user_ids = list(dict.fromkeys(user_id for user_id, _ in batch))
+        state = {}
+        for i in range(0, len(user_ids), _MAX_SQL_PARAMS):
+            chunk = user_ids[i:i + _MAX_SQL_PARAMS]
+            placeholders = ",".join("?" * len(chunk))
+            for row in conn.execute(
+                f"SELECT user_id, last_gen_date, selection_state FROM users WHERE user_id IN ({placeholders})",
+                chunk,
+            ):
+                state[row["user_id"]] = {
+                    "last_gen_date": row["last_gen_date"],
+                    "selection": SelectionState.from_blob(row["user_id"], row["selection_state"]),
+                }
+
+        now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        eligible = []
+        for user_id, _ in batch:
+            user = state.setdefault(user_id, {"last_gen_date": None, "selection": SelectionState(user_id)})
+            if day is None:
+                eligible.append(_can_generate(user["last_gen_date"]))
+            else:
+                eligible.append((_generated_on(user["last_gen_date"], timezone) or date.min) < day)
+            if eligible[-1]:
+                user["last_gen_date"] = now
+        # Курсоры цитат всей пачки — одним чтением и одной записью
+        quotes = get_quote_index().draw_many(
+            user_id for (user_id, _), ok in zip(batch, eligible) if ok
+        )
+
+        texts = []
+        generated = {}
+        for (user_id, sign), ok in zip(batch, eligible):
+            if not ok:
+                texts.append(ALREADY_GENERATED_TEXT)
+                continue
+            user = state[user_id]
+            texts.append(_compose_horoscope(sign, user["selection"], lambda: quotes[user_id]))
+            generated[user_id] = user["selection"]
+
+        # save_selection_state создаёт пользователя, если его ещё нет
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (user_id, subscription_status) VALUES (?, 'free')",
+            [(user_id,) for user_id in generated],
+        )
+        conn.executemany(
+            "UPDATE users SET selection_state = ?, last_gen_date = datetime('now') WHERE user_id = ?",
+            [(selection.to_blob(), user_id) for user_id, selection in generated.items()],
+        )
+
+    return texts
+
+
+def generate_horoscopes_to_outbox(
+    campaign: str, batch: list[tuple[int, str]], day: date | None = None, timezone: str = TIMEZONE
+) -> int:
+    """
+    Генерируем гороскопы пачки и кладём их в outbox кампании одной транзакцией:
+    либо у пользователя есть и обновлённая дата генерации, и сообщение в outbox,
+    либо ни того, ни другого. Кто в местную дату day (по умолчанию — сегодня
+    в поясе timezone) уже получил гороскоп сам, командой /horoscope, пропускается —
+    «гороскоп уже был» рассылкой не отправляется.
+    """
+    day = day or datetime.now(ZoneInfo(timezone)).date()
+    with transaction():
+        texts = generate_horoscopes(batch, day, timezone)
+        return outbox_add(campaign, [
+            (user_id, text) for (user_id, _), text in zip(batch, texts) if text != ALREADY_GENERATED_TEXT
+        ])
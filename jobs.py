@@ -1,49 +1,233 @@
-from aiogram import Bot
-from config import TIMEZONE
-from db import get_db_connection
-from horoscope import generate_horoscope
+import asyncio
+import functools
+import logging
+from datetime import date, datetime, time
+from typing import TYPE_CHECKING
+from zoneinfo import ZoneInfo
+from config import (
+    TIMEZONE,
+    OUTBOX_KEEP_DAYS,
+    BROADCAST_RATE,
+    BROADCAST_SHARDS,
+    DAILY_HOROSCOPE_HOUR,
+    DAILY_SPREAD_WINDOW,
+)
+from broadcast import TokenBucket, bot_sender, telegram_bucket
+from outbox import campaign_id, parse_campaign, run_campaign
+from repo import repo
 
+if TYPE_CHECKING:
+    from aiogram import Bot
 
-async def send_daily_horoscope(bot: Bot):
+logger = logging.getLogger(__name__)
+
+REMINDER_TEXT = (
+    "🔔 Напоминание: твоя премиум-подписка сейчас не активна. "
+    "Хочешь вернуться к уникальным раскладам и расширенным гороскопам?"
+)
+
+
+async def horoscope_messages(pages):
+    """
+    Генерируем гороскопы пачками по мере отправки, а не все заранее.
+    pages — страницы получателей (user_id, sign), например repo.iter_users_with_sign():
+    следующая читается, когда отправка дошла до конца предыдущей.
+    """
+    async for batch in pages:
+        texts = await repo.generate_horoscopes(batch)
+        for (user_id, _), text in zip(batch, texts):
+            yield user_id, text
+
+
+async def fill_horoscope_outbox(campaign: str, pages, rate: float | None = None, mark_generated: bool = True):
     """
-    Ежедневная рассылка гороскопов всем пользователям, у которых выбран знак.
+    Генерируем гороскопы пачками прямо в outbox кампании. pages — страницы тех,
+    кого там ещё нет (после перезапуска генерация продолжается, а не начинается заново).
+    rate — темп отправки: генерация идёт примерно на пачку впереди неё,
+    а не нагружает базу всем поясом сразу. В конце кампания отмечается
+    сгенерированной — больше получателей в неё не добавляется (mark_generated=False —
+    отметит вызывающий: шарды генерируют каждый свою часть, см. broadcast_shards.py).
+    Гороскоп получают все, у кого его ещё не было в местную дату кампании.
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT user_id, sign FROM users WHERE sign IS NOT NULL")
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
+    kind, day = parse_campaign(campaign)
+    timezone = kind.partition("@")[2] or TIMEZONE
+    async for batch in pages:
+        await repo.generate_horoscopes_to_outbox(campaign, batch, day, timezone)
+        if rate:
+            await asyncio.sleep(len(batch) / rate)
+    if mark_generated:
+        await repo.outbox_mark_generated(campaign)
+
+
+def local_today(timezone: str) -> date:
+    return datetime.now(ZoneInfo(timezone)).date()
 
-    for user_id, sign in rows:
-        text = generate_horoscope(user_id, sign)
+
+def daily_campaign(timezone: str | None = None) -> str:
+    """
+    Кампания ежедневного гороскопа: для пояса — по местной дате пояса.
+    """
+    if timezone is None:
+        return campaign_id("daily_horoscope")
+    return campaign_id(f"daily_horoscope@{timezone}", local_today(timezone))
+
+
+def remaining_spread(timezone: str, day: date, now: float | None = None) -> float:
+    """
+    Сколько секунд осталось от окна ежедневной рассылки дня day в поясе timezone:
+    окно начинается в DAILY_HOROSCOPE_HOUR:00 по местному времени и длится DAILY_SPREAD_WINDOW.
+    now — unix-время (по умолчанию текущее).
+    """
+    start = datetime.combine(day, time(DAILY_HOROSCOPE_HOUR), ZoneInfo(timezone)).timestamp()
+    now = datetime.now().timestamp() if now is None else now
+    return min(DAILY_SPREAD_WINDOW, max(0.0, start + DAILY_SPREAD_WINDOW - now))
+
+
+def spread_rate(recipients: int, spread: float) -> float:
+    """
+    Темп, при котором recipients сообщений уйдут за spread секунд, но не быстрее лимита Telegram.
+    """
+    return min(BROADCAST_RATE, max(1.0, recipients / spread))
+
+
+async def send_daily_horoscope(
+    bot: "Bot",
+    timezone: str | None = None,
+    spread: float = 0,
+    shards: int = BROADCAST_SHARDS,
+    bot_factory=None,
+    **broadcast_options,
+):
+    """
+    Ежедневная рассылка гороскопов пользователям с выбранным знаком:
+    всем или только часового пояса timezone.
+    Идёт через outbox: генерация и отправка работают параллельно, а повторный
+    запуск в тот же день продолжает рассылку без дублей. Если генерация уже
+    закончена, он только досылает неотправленное: зарегистрировавшиеся после
+    утренней рассылки её не получают.
+    spread — растянуть рассылку на столько секунд (общий лимит бота при этом соблюдается).
+    shards > 1 — генерировать и отправлять в нескольких процессах (broadcast_shards.py);
+    bot_factory создаёт бота в процессе шарда (по умолчанию — Bot с токеном bot).
+    broadcast_options передаются в Broadcaster (лимиты меняют бенчмарки).
+    """
+    campaign = daily_campaign(timezone)
+    await repo.outbox_prune(OUTBOX_KEEP_DAYS)
+    generated = await repo.outbox_is_generated(campaign)
+
+    rate = None
+    if spread > 0:
+        progress = await repo.outbox_progress(campaign)
+        remaining = 0 if generated else await repo.count_users_with_sign(not_in_campaign=campaign, timezone=timezone)
+        unsent = remaining + progress.get("pending", 0) + progress.get("sending", 0)
+        rate = spread_rate(unsent, spread)
+
+    if shards > 1:
+        from broadcast_shards import run_sharded_campaign, telegram_bot
+
+        # Без spread, как и в одном процессе, лимит задаёт rate из broadcast_options, а не общий лимит бота
+        shared_limit = rate is not None
+        return await run_sharded_campaign(
+            campaign,
+            bot_factory or functools.partial(telegram_bot, bot.token),
+            shards,
+            rate=rate or broadcast_options.pop("rate", BROADCAST_RATE),
+            timezone=timezone,
+            generate=not generated,
+            pace=rate,
+            shared_limit=shared_limit,
+            **broadcast_options,
+        )
+
+    if rate is not None:
+        broadcast_options.setdefault("bucket", TokenBucket(rate, parent=telegram_bucket))
+    producer = None
+    if not generated:
+        pages = repo.iter_users_with_sign(not_in_campaign=campaign, timezone=timezone)
+        producer = asyncio.create_task(fill_horoscope_outbox(campaign, pages, rate=rate))
+    return await run_campaign(
+        campaign, bot_sender(bot), name="daily_horoscope", producer=producer, **broadcast_options
+    )
+
+
+async def sync_daily_jobs(scheduler, bot: "Bot"):
+    """
+    По одной задаче ежедневной рассылки на каждый часовой пояс пользователей:
+    в DAILY_HOROSCOPE_HOUR:00 по местному времени, растянутая на DAILY_SPREAD_WINDOW.
+    Вызывается при старте и периодически — чтобы подхватить новые пояса.
+    """
+    # Импорт здесь: процессам, которые только рассылают, планировщик не нужен
+    from apscheduler.triggers.cron import CronTrigger
+
+    wanted = {f"daily_horoscope@{timezone}": timezone for timezone in await repo.get_timezones()}
+    for scheduled in scheduler.get_jobs():
+        if scheduled.id.startswith("daily_horoscope@") and scheduled.id not in wanted:
+            scheduled.remove()
+    for job_id, timezone in wanted.items():
+        if scheduler.get_job(job_id) is not None:
+            continue
         try:
-            await bot.send_message(chat_id=user_id, text=text)
+            trigger = CronTrigger(hour=DAILY_HOROSCOPE_HOUR, minute=0, second=0, timezone=timezone)
         except Exception:
-            # Например, пользователь заблокировал бота — просто пропускаем
+            logger.exception("Не удалось запланировать рассылку для пояса %s", timezone)
             continue
+        scheduler.add_job(
+            send_daily_horoscope,
+            trigger=trigger,
+            id=job_id,
+            kwargs={"bot": bot, "timezone": timezone, "spread": DAILY_SPREAD_WINDOW},
+        )
 
 
-async def send_subscription_reminder(bot: Bot):
+async def send_subscription_reminder(bot: "Bot"):
     """
     Пример напоминаний неактивным пользователям.
     Можно расширить логикой по датам.
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT user_id FROM users WHERE subscription_status = 'inactive'"
+    campaign = campaign_id("subscription_reminder")
+
+    async def fill():
+        async for user_ids in repo.iter_users_by_subscription("inactive"):
+            await repo.outbox_add(campaign, [(user_id, REMINDER_TEXT) for user_id in user_ids])
+
+    return await run_campaign(
+        campaign, bot_sender(bot), name="subscription_reminder", producer=asyncio.create_task(fill()),
+        bucket=telegram_bucket,
     )
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
 
-    for (user_id,) in rows:
-        try:
-            await bot.send_message(
-                chat_id=user_id,
-                text="🔔 Напоминание: твоя премиум-подписка сейчас не активна. "
-                     "Хочешь вернуться к уникальным раскладам и расширенным гороскопам?",
-            )
-        except Exception:
+
+async def resume_broadcasts(bot: "Bot"):
+    """
+    При старте: доделываем сегодняшние (по местной дате пояса) рассылки,
+    прерванные падением или перезапуском. Вчерашние гороскопы не досылаем — они устарели.
+    Рассылки продолжаются одновременно (общий лимит бота они делят), ежедневная —
+    в пределах того, что осталось от её исходного окна, а после окна — без растягивания.
+    """
+    campaigns = await repo.outbox_unfinished_campaigns()
+    # Генерация могла оборваться, когда всё уже сгенерированное было отправлено.
+    # Законченную кампанию не трогаем: иначе её получили бы те, кто пришёл после рассылки
+    for timezone in await repo.get_timezones():
+        daily = daily_campaign(timezone)
+        if daily in campaigns or await repo.outbox_is_generated(daily):
             continue
+        if await repo.outbox_progress(daily):
+            campaigns.append(daily)
+
+    resumed = []
+    for campaign in campaigns:
+        kind, day = parse_campaign(campaign)
+        base, _, timezone = kind.partition("@")
+        if day != local_today(timezone or TIMEZONE):
+            continue
+        if base == "daily_horoscope":
+            spread = remaining_spread(timezone or TIMEZONE, day)
+            logger.info("Продолжаем прерванную рассылку %s, осталось окна %.0f с", campaign, spread)
+            resumed.append((campaign, send_daily_horoscope(bot, timezone=timezone or None, spread=spread)))
+        else:
+            logger.info("Продолжаем прерванную рассылку %s", campaign)
+            resumed.append((campaign, run_campaign(campaign, bot_sender(bot), name=base, bucket=telegram_bucket)))
+
+    results = await asyncio.gather(*(coro for _, coro in resumed), return_exceptions=True)
+    for (campaign, _), result in zip(resumed, results):
+        # Одна упавшая рассылка не останавливает остальные; её продолжит следующий запуск
+        if isinstance(result, BaseException):
+            logger.error("Не удалось продолжить рассылку %s", campaign, exc_info=result)
@@ -0,0 +1,282 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime
+
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Update
+
+from constants import ZODIAC_SIGNS
+
+# Доли событий от уже зарегистрированных пользователей
+DEFAULT_MIX = {
+    "horoscope": 0.40,
+    "tarot": 0.25,
+    "profile": 0.15,
+    "sign": 0.08,
+    "start": 0.07,
+    "payment": 0.05,
+}
+
+_SIGN_BUTTONS = {
+    "Овен": "♈", "Телец": "♉", "Близнецы": "♊", "Рак": "♋", "Лев": "♌", "Дева": "♍",
+    "Весы": "♎", "Скорпион": "♏", "Стрелец": "♐", "Козерог": "♑", "Водолей": "♒", "Рыбы": "♓",
+}
+
+
+class StubSession(BaseSession):
+    """
+    Сессия Bot API без сети: каждый запрос «выполняется» за latency секунд
+    и возвращает True. Считает вызовы по методам.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: dict[str, int] = {}
+
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+class UpdateFactory:
+    """
+    Синтетические апдейты от users пользователей. Новый пользователь сначала
+    отправляет /start и выбирает знак, дальше события берутся из mix.
+    """
+
+    def __init__(self, users: int, mix: dict[str, float] = DEFAULT_MIX, seed: int = 0, first_user_id: int = 10**9):
+        self.users = users
+        self.first_user_id = first_user_id
+        self.rng = random.Random(seed)
+        self.kinds, self.weights = zip(*mix.items())
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._onboarding: dict[int, list[str]] = {}
+        self._registered: set[int] = set()
+
+    def next(self) -> tuple[str, Update]:
+        user_id = self.first_user_id + self.rng.randrange(self.users)
+        if user_id not in self._registered:
+            steps = self._onboarding.setdefault(user_id, ["start", "sign"])
+            kind = steps.pop(0)
+            if not steps:
+                del self._onboarding[user_id]
+                self._registered.add(user_id)
+        else:
+            kind = self.rng.choices(self.kinds, self.weights)[0]
+        return kind, self._build(kind, user_id)
+
+    def _build(self, kind: str, user_id: int) -> Update:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(datetime.now().timestamp()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Load"},
+        }
+        if kind == "start":
+            message["text"] = "/start"
+        elif kind == "sign":
+            sign = self.rng.choice(ZODIAC_SIGNS)
+            message["text"] = f"{_SIGN_BUTTONS[sign]} {sign}"
+        elif kind == "horoscope":
+            message["text"] = "🔮 Гороскоп на сегодня"
+        elif kind == "tarot":
+            message["text"] = "🃏 Расклад Таро"
+        elif kind == "profile":
+            message["text"] = "👤 Профиль"
+        elif kind == "payment":
+            message["successful_payment"] = {
+                "currency": "XTR",
+                "total_amount": 300,
+                "invoice_payload": "premium_subscription",
+                "telegram_payment_charge_id": f"load-{message['message_id']}",
+                "provider_payment_charge_id": f"load-{message['message_id']}",
+            }
+        else:
+            raise ValueError(f"Неизвестный тип события: {kind}")
+        return Update.model_validate({"update_id": next(self._update_ids), "message": message})
+
+
+def _percentile(samples: list[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def _db_snapshot() -> tuple[int, float, int, float]:
+    from metrics import DB_BATCH_SIZE, DB_QUEUE_WAIT_SECONDS
+
+    waits = DB_QUEUE_WAIT_SECONDS.items()
+    batches = DB_BATCH_SIZE.items()
+    return (
+        sum(count for _, count, _ in waits),
+        sum(total for _, _, total in waits),
+        sum(count for _, count, _ in batches),
+        sum(total for _, _, total in batches),
+    )
+
+
+async def run_stage(dp, bot, factory: UpdateFactory, rate: float, duration: float, concurrency: int) -> dict:
+    """
+    Один этап нагрузки. rate > 0 — открытая модель: апдейты приходят пуассоновским
+    потоком с интенсивностью rate в секунду, независимо от того, успевает ли бот
+    (задержка считается от момента прихода, поэтому перегрузка видна как рост p99).
+    rate = 0 — замкнутая модель: concurrency «клиентов» шлют апдейты без пауз,
+    получается предельная пропускная способность.
+    """
+    latencies: list[float] = []
+    kinds: dict[str, int] = {}
+    errors = 0
+    db_before = _db_snapshot()
+
+    async def process(kind: str, update: Update, arrived: float):
+        nonlocal errors
+        try:
+            await dp.feed_update(bot, update)
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter() - arrived)
+        kinds[kind] = kinds.get(kind, 0) + 1
+
+    started = time.perf_counter()
+    deadline = started + duration
+    if rate > 0:
+        rng = random.Random(factory.rng.random())
+        tasks = set()
+        arrival = started
+        while True:
+            arrival += rng.expovariate(rate)
+            if arrival >= deadline:
+                break
+            delay = arrival - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            kind, update = factory.next()
+            task = asyncio.create_task(process(kind, update, arrival))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+    else:
+        async def client():
+            while time.perf_counter() < deadline:
+                kind, update = factory.next()
+                await process(kind, update, time.perf_counter())
+
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    waits, wait_total, batches, batch_total = (
+        after - before for after, before in zip(_db_snapshot(), db_before)
+    )
+    latencies.sort()
+    return {
+        "offered_rate": rate or None,
+        "updates": len(latencies),
+        "errors": errors,
+        "seconds": elapsed,
+        "updates_per_s": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            "mean": statistics.fmean(latencies) * 1000 if latencies else 0.0,
+            "p50": _percentile(latencies, 0.5) * 1000,
+            "p99": _percentile(latencies, 0.99) * 1000,
+            "max": latencies[-1] * 1000 if latencies else 0.0,
+        },
+        "db": {
+            "requests": waits,
+            "queue_wait_ms_mean": wait_total / waits * 1000 if waits else 0.0,
+            "batches": batches,
+            "batch_size_mean": batch_total / batches if batches else 0.0,
+        },
+        "mix": kinds,
+    }
+
+
+async def run(args) -> dict:
+    import db
+    import main
+
+    db.DB_PATH = args.db
+    logging.getLogger("aiogram").setLevel(logging.WARNING)
+
+    bot, dp = main.create_app()
+    session = StubSession(args.api_latency)
+    bot.session = session
+    factory = UpdateFactory(args.users, seed=args.seed)
+    stages = []
+    try:
+        for rate in args.rates:
+            stage = await run_stage(dp, bot, factory, rate, args.duration, args.concurrency)
+            stages.append(stage)
+            print(
+                f"rate={rate or 'max'}: {stage['updates_per_s']:.0f} апдейтов/с, "
+                f"p50={stage['latency_ms']['p50']:.1f} мс, p99={stage['latency_ms']['p99']:.1f} мс, "
+                f"ожидание БД {stage['db']['queue_wait_ms_mean']:.2f} мс",
+                file=sys.stderr,
+            )
+    finally:
+        main.repo.stop()
+    return {
+        "meta": {
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "users": args.users,
+            "duration": args.duration,
+            "api_latency": args.api_latency,
+            "seed": args.seed,
+        },
+        "stages": stages,
+        "bot_api_calls": session.calls,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Нагрузочный тест Dispatcher из main.py на синтетических апдейтах, без Telegram"
+    )
+    parser.add_argument("--users", type=int, default=10_000, help="число симулируемых пользователей")
+    parser.add_argument(
+        "--rates", type=lambda s: [float(x) for x in s.split(",")], default=[0.0],
+        help="интенсивности этапов, апдейтов/с, через запятую; 0 — максимум (замкнутая модель)",
+    )
+    parser.add_argument("--duration", type=float, default=10.0, help="длительность этапа, секунд")
+    parser.add_argument("--concurrency", type=int, default=64, help="клиентов в замкнутой модели")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="имитация задержки Bot API, секунд")
+    parser.add_argument("--db", default="loadgen.db", help="отдельная база для прогона: путь или memory://")
+    parser.add_argument("--fresh", action="store_true", help="удалить базу перед прогоном")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="записать результаты в файл (JSON)")
+    args = parser.parse_args()
+
+    if args.fresh:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(args.db + suffix):
+                os.remove(args.db + suffix)
+
+    report = asyncio.run(run(args))
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,63 @@
+import argparse
 import logging
 import asyncio
 import random
-import json
-import os
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
 from aiogram.types import LabeledPrice, PreCheckoutQuery, Message, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
-from config import API_TOKEN, PAYMENT_PROVIDER_TOKEN, TIMEZONE
-from db import create_tables, ensure_user, set_user_sign, get_user_sign, update_subscription, get_subscription_status
-from horoscope import generate_horoscope
-# from tarot import generate_tarot  # Убираем импорт
-from jobs import send_daily_horoscope, send_subscription_reminder
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
-
-# Инициализация бота и диспетчера
-bot = Bot(token=API_TOKEN)
+from config import API_TOKEN, PAYMENT_PROVIDER_TOKEN, TIMEZONE, ADMIN_IDS, METRICS_HOST, METRICS_PORT, BOT_MODE
+from config import BROADCAST_SHARDS, DAILY_HOROSCOPE_HOUR, HOROSCOPE_DETERMINISTIC, WRITE_BEHIND
+from db import create_tables, recover_write_behind
+from horoscope import load_day_quotes
+from repo import repo
+from tarot import draw_spread, sync_tarot_cards
+from jobs import send_subscription_reminder, resume_broadcasts, sync_daily_jobs
+import metrics
+from middlewares import HandlerMetricsMiddleware
+
+# Диспетчер с хэндлерами. Бот и база готовятся при запуске (см. create_app), а не при импорте:
+# процессы-обработчики webhook и нагрузочные прогоны импортируют main без полного старта
 dp = Dispatcher()
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.pre_checkout_query.middleware(HandlerMetricsMiddleware())
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Проверяем, если база данных и таблицы не созданы — создаём их
-create_tables()
+_bot: Bot | None = None
+_storage_ready = False
+
+
+def get_bot() -> Bot:
+    """
+    Бот процесса: создаётся при первом обращении.
+    """
+    global _bot
+    if _bot is None:
+        _bot = Bot(token=API_TOKEN)
+    return _bot
+
+
+def setup_storage():
+    """
+    Готовим базу: миграции схемы и колода Таро в tarot_cards. Один раз на процесс;
+    процессам-обработчикам webhook это не нужно — базу уже подготовил основной процесс.
+    """
+    global _storage_ready
+    if not _storage_ready:
+        create_tables()
+        sync_tarot_cards()
+        _storage_ready = True
+
+
+def create_app() -> tuple[Bot, Dispatcher]:
+    """
+    Запуск приложения: база, бот и диспетчер.
+    """
+    setup_storage()
+    return get_bot(), dp
+
 
 # Стили для текстов (для уникальности)
 STYLES = [
@@ -51,61 +84,19 @@ SIGN_PROMPTS = [
     "Звёзды хотят с тобой поговорить. Под каким ты знаком?"
 ]
 
-# Карты Таро
-TAROT_CARDS = [
-    "Шут", "Маг", "Верховная Жрица", "Императрица", "Император", "Иерофант", "Влюбленные", "Колесница", "Сила", "Повешенный", "Смерть", "Умеренность", "Дьявол", "Башня", "Звезда", "Луна", "Солнце", "Суд", "Мир",
-    "2 Жезлов", "3 Жезлов", "4 Жезлов", "5 Жезлов", "6 Жезлов", "7 Жезлов", "8 Жезлов", "9 Жезлов", "10 Жезлов", "Валет Жезлов", "Рыцарь Жезлов", "Дама Жезлов", "Король Жезлов",
-    "2 Кубков", "3 Кубков", "4 Кубков", "5 Кубков", "6 Кубков", "7 Кубков", "8 Кубков", "9 Кубков", "10 Кубков", "Валет Кубков", "Рыцарь Кубков", "Дама Кубков", "Король Кубков",
-    "2 Мечей", "3 Мечей", "4 Мечей", "5 Мечей", "6 Мечей", "7 Мечей", "8 Мечей", "9 Мечей", "10 Мечей", "Валет Мечей", "Рыцарь Мечей", "Дама Мечей", "Король Мечей",
-    "2 Пентаклей", "3 Пентаклей", "4 Пентаклей", "5 Пентаклей", "6 Пентаклей", "7 Пентаклей", "8 Пентаклей", "9 Пентаклей", "10 Пентаклей", "Валет Пентаклей", "Рыцарь Пентаклей", "Дама Пентаклей", "Король Пентаклей"
-]
-
-# --- НОВЫЙ КОД ДЛЯ ТАРО ---
-
-# Загрузка интерпретаций из JSON-файла
-def load_tarot_interpretations():
-    """Загружает интерпретации карт Таро из JSON-файла в папке data."""
-    json_path = os.path.join('data', 'tarot_interpretations.json')
-    try:
-        with open(json_path, 'r', encoding='utf-8') as file:
-            interpretations = json.load(file)
-        print(f"Интерпретации Таро загружены из {json_path}") # Лог для проверки
-        return interpretations
-    except FileNotFoundError:
-        print(f"Файл {json_path} не найден!")
-        return {}
-    except json.JSONDecodeError:
-        print(f"Ошибка при чтении файла {json_path}!")
-        return {}
-
-TAROT_INTERPRETATIONS = load_tarot_interpretations()
-
-def get_tarot_card():
-    """Выбирает случайную карту из списка."""
-    if not TAROT_CARDS:
-        return None
-    return random.choice(TAROT_CARDS)
-
-def get_tarot_interpretation(card_name, topic):
+# Карты Таро: колода собирается один раз (см. tarot.Deck)
+def get_tarot_interpretation(card, topic, reversed_=False):
     """
     Формирует текст интерпретации для одной карты, привязывая к теме.
     """
-    if not TAROT_INTERPRETATIONS or not card_name or card_name not in TAROT_INTERPRETATIONS:
-        return f"Интерпретация для карты '{card_name}' недоступна."
-
-    card_data = TAROT_INTERPRETATIONS[card_name]
-    # Простой пример: выбираем светлое или теневое значение
-    aspect = random.choice(["light", "shadow"])
-    interpretation_text = card_data.get(aspect, "Интерпретация отсутствует.")
-
-    # Формируем общий текст с привязкой к теме
-    prompt_templates = [
-        f"Твоя карта по теме '{topic}': **{card_name}**.\n\nЗначение: {interpretation_text}",
-        f"Для вопроса '{topic}' выпала карта: **{card_name}**.\n\nЕё толкование: {interpretation_text}",
-        f"Карта Таро: **{card_name}**.\n\nВ контексте '{topic}': {interpretation_text}",
-    ]
+    if card is None:
+        return "Интерпретация карты недоступна."
 
-    return random.choice(prompt_templates)
+    # Прямая карта — светлое значение, перевёрнутая — теневое
+    aspect = "shadow" if reversed_ else "light"
+    # Имя и толкование уже подставлены в шаблоны при сборке колоды — остаётся тема
+    before, after = random.choice(card.one_card_parts[aspect])
+    return f"{before}{topic}{after}"
 
 def generate_tarot(user_id, topic, sign=None):
     """
@@ -114,12 +105,12 @@ def generate_tarot(user_id, topic, sign=None):
     if not topic:
         topic = "Вопрос без границ"
 
-    # Выбираем 1 карту
-    drawn_card = get_tarot_card()
-    if not drawn_card:
+    # Выбираем 1 карту (без недавно выпадавших) и записываем её в историю
+    drawn = draw_spread(user_id, "one")
+    if not drawn:
         return "Ошибка при выборе карты."
 
-    interpretation = get_tarot_interpretation(drawn_card, topic)
+    interpretation = get_tarot_interpretation(drawn[0].card, topic, drawn[0].reversed)
 
     # Пример добавления общей вводной
     introduction = random.choice([
@@ -167,8 +158,9 @@ def build_main_menu():
 @dp.message(Command("start"))
 async def cmd_start(message: Message):
     user_id = message.from_user.id
-    # Создаём запись пользователя в базе данных, если ещё нет
-    ensure_user(user_id)
+    # Создаём запись пользователя в базе данных, если ещё нет; если он был
+    # исключён из рассылок (блокировал бота), снова начинаем ему писать
+    await repo.ensure_user(user_id, reactivate=True)
 
     await message.answer(
         get_welcome_message(),
@@ -181,7 +173,7 @@ async def cmd_start(message: Message):
 async def cmd_set_sign(message: Message):
     sign = message.text.split(" ", 1)[1]  # Убираем эмодзи
     user_id = message.from_user.id
-    set_user_sign(user_id, sign)
+    await repo.set_user_sign(user_id, sign)
     await message.answer(f"✅ Записал: твой знак — {sign}.\n\nТеперь ты можешь получить:\n🔮 Гороскоп командой /horoscope\n🃏 Расклад Таро — /tarot", reply_markup=build_main_menu())
 
 # Хэндлер для команды /horoscope
@@ -189,14 +181,14 @@ async def cmd_set_sign(message: Message):
 @dp.message(lambda m: m.text == "🔮 Гороскоп на сегодня")
 async def cmd_horoscope(message: Message):
     user_id = message.from_user.id
-    sign = get_user_sign(user_id)
+    sign = await repo.get_user_sign(user_id)
     if not sign:
         await message.answer(
             "Сначала выбери свой знак зодиака, чтобы я мог говорить с тобой точнее:",
             reply_markup=build_zodiac_keyboard(),
         )
         return
-    text = generate_horoscope(user_id, sign)
+    text = await repo.generate_horoscope(user_id, sign)
     await message.answer(text)
 
 # Хэндлер для команды /tarot
@@ -204,9 +196,25 @@ async def cmd_horoscope(message: Message):
 @dp.message(lambda m: m.text == "🃏 Расклад Таро")
 async def cmd_tarot(message: Message):
     user_id = message.from_user.id
-    sign = get_user_sign(user_id)
+    sign = await repo.get_user_sign(user_id)
     topic = "Вопрос без границ"  # можно потом сделать выбор через кнопки
-    text = generate_tarot(user_id, topic, sign=sign) # Теперь вызывает функцию из main.py
+    if await repo.get_subscription_status(user_id) == "active":
+        # Премиум — расклад из трёх карт
+        text = await repo.generate_spread(user_id, topic, "three", sign=sign)
+    else:
+        text = await repo.run(generate_tarot, user_id, topic, sign=sign)
+    await message.answer(text or "Сегодня карты молчат. Попробуй чуть позже. 🃏")
+
+# Хэндлер для команды /celtic — Кельтский крест для подписчиков
+@dp.message(Command("celtic"))
+async def cmd_celtic_cross(message: Message):
+    user_id = message.from_user.id
+    if await repo.get_subscription_status(user_id) != "active":
+        await message.answer("🔒 Кельтский крест из 10 карт доступен с премиум-подпиской. Подробнее — /subscribe")
+        return
+    sign = await repo.get_user_sign(user_id)
+    topic = "Вопрос без границ"
+    text = await repo.generate_spread(user_id, topic, "celtic_cross", sign=sign)
     await message.answer(text or "Сегодня карты молчат. Попробуй чуть позже. 🃏")
 
 # Хэндлер для команды /subscribe
@@ -242,8 +250,9 @@ async def cmd_pay(message: Message):
 @dp.message(lambda m: m.text == "👤 Профиль")
 async def cmd_profile(message: Message):
     user_id = message.from_user.id
-    sign = get_user_sign(user_id)
-    sub_status = get_subscription_status(user_id) or "free"
+    profile = await repo.get_user_profile(user_id)
+    sign = profile.sign
+    sub_status = profile.subscription_status or "free"
     await message.answer(
         f"👤 Твой профиль:\n"
         f"• Знак: {sign or 'не выбран'}\n"
@@ -251,38 +260,106 @@ async def cmd_profile(message: Message):
         f"Если хочешь изменить знак — просто напиши его снова."
     )
 
+# Хэндлер для /timezone — часовой пояс для утренней рассылки
+@dp.message(Command("timezone"))
+async def cmd_timezone(message: Message):
+    user_id = message.from_user.id
+    parts = (message.text or "").split(maxsplit=1)
+    if len(parts) < 2:
+        current = await repo.get_user_timezone(user_id)
+        await message.answer(
+            f"🕗 Твой часовой пояс: {current}. Гороскоп приходит в {DAILY_HOROSCOPE_HOUR}:00 по этому времени.\n\n"
+            f"Чтобы изменить, напиши, например: /timezone Asia/Novosibirsk"
+        )
+        return
+    timezone = parts[1].strip()
+    try:
+        ZoneInfo(timezone)
+    except (ZoneInfoNotFoundError, ValueError):
+        await message.answer("Не знаю такого часового пояса. Пример: /timezone Europe/Berlin")
+        return
+    await repo.set_user_timezone(user_id, timezone)
+    await message.answer(
+        f"✅ Записал: {timezone}. Утренний гороскоп будет приходить в {DAILY_HOROSCOPE_HOUR}:00 по твоему времени."
+    )
+
+# Хэндлер для /stats — только для администраторов (в режиме webhook отвечает
+# основной процесс со сводкой по всем обработчикам, см. webhook.stats_request)
+@dp.message(Command("stats"))
+async def cmd_stats(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    await message.answer(metrics.summary())
+
 # Хэндлер для pre_checkout_query
 @dp.pre_checkout_query()
 async def process_pre_checkout(pre_checkout_q: PreCheckoutQuery):
-    await bot.answer_pre_checkout_query(pre_checkout_q.id, ok=True)
+    await pre_checkout_q.answer(ok=True)
 
 # Хэндлер для успешной оплаты
 @dp.message(lambda message: message.successful_payment is not None)
 async def successful_payment_handler(message: Message):
     user_id = message.from_user.id
-    update_subscription(user_id, "active")
+    await repo.update_subscription(user_id, "active")
     await message.answer(
         "✨ Спасибо за доверие!\nТвоя премиум-подписка активирована. Теперь ты — в эпицентре магии и текста."
     )
 
 # Планировщики задач
-async def main():
+async def main(mode: str = BOT_MODE):
+    # Импорт здесь: процессам-обработчикам webhook, которые импортируют main, планировщик не нужен
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+    from apscheduler.triggers.cron import CronTrigger
+
     logging.basicConfig(level=logging.INFO)
-    # Планировщик для ежедневных гороскопов
+    bot, _ = create_app()
+    if WRITE_BEHIND:
+        # Изменения, не записанные прошлым запуском (если включён журнал)
+        recovered = await repo.run(recover_write_behind)
+        if recovered:
+            logger.info("Восстановлено из журнала отложенной записи: %d", recovered)
+    if HOROSCOPE_DETERMINISTIC:
+        # Цитаты детерминированных гороскопов читаем в потоке БД до первых апдейтов
+        await repo.run(load_day_quotes)
+    if BROADCAST_SHARDS > 1:
+        # Шарды рассылок — другие процессы: общий лимит бота делаем межпроцессным до их запуска
+        from broadcast_shards import share_telegram_bucket
+
+        share_telegram_bucket()
+    # Планировщик для ежедневных гороскопов: отдельная задача на каждый часовой пояс.
+    # Все они идут через outbox и общий лимит бота (broadcast.telegram_bucket)
     scheduler = AsyncIOScheduler(timezone=TIMEZONE)
-    scheduler.add_job(
-        send_daily_horoscope,
-        trigger=CronTrigger(hour=8, minute=0, second=0, timezone=TIMEZONE),
-        kwargs={"bot": bot},
-    )
+    await sync_daily_jobs(scheduler, bot)
+    # Новые пояса пользователей подхватываем раз в полчаса
+    scheduler.add_job(sync_daily_jobs, trigger="interval", minutes=30, args=[scheduler, bot])
     scheduler.add_job(
         send_subscription_reminder,
         trigger=CronTrigger(day_of_week="mon", hour=9, minute=0, timezone=TIMEZONE),
         kwargs={"bot": bot},
     )
     scheduler.start()
+    # Рассылки, прерванные прошлым запуском, доделываем в фоне
+    resume_task = asyncio.create_task(resume_broadcasts(bot))
 
-    await dp.start_polling(bot)
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = await metrics.start_http_server(METRICS_HOST, METRICS_PORT)
+
+    try:
+        if mode == "webhook":
+            # Апдейты принимает HTTP-сервер и раздаёт их процессам-обработчикам (см. webhook.py)
+            from webhook import run_webhook
+            await run_webhook(bot)
+        else:
+            await dp.start_polling(bot)
+    finally:
+        resume_task.cancel()
+        scheduler.shutdown(wait=False)
+        if metrics_server is not None:
+            metrics_server.close()
+        repo.stop()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Астро-бот")
+    parser.add_argument("--mode", choices=("polling", "webhook"), default=BOT_MODE)
+    asyncio.run(main(parser.parse_args().mode))
\ No newline at end of file
@@ -0,0 +1,351 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+from cache import profile_cache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple, float] = {}
+        # Значения других процессов (см. Registry.update_remote): источник -> dump()
+        self._remote: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        """
+        Значение в этом процессе (без других процессов).
+        """
+        return self._values.get(tuple(labels.get(name, "") for name in self.labelnames), 0)
+
+    def dump(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+    def set_remote(self, source: str, values: dict):
+        with self._lock:
+            self._remote[source] = values
+
+    def items(self) -> list[tuple[tuple, float]]:
+        """
+        Значения по всем сериям, сложенные по процессам.
+        """
+        with self._lock:
+            values = dict(self._values)
+            remote = list(self._remote.values())
+        for other in remote:
+            for key, value in other.items():
+                values[key] = values.get(key, 0) + value
+        return list(values.items())
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in self.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # ключ меток -> [счётчики по бакетам (+Inf последним), сумма, количество]
+        self._values: dict[tuple, list] = {}
+        self._remote: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def dump(self) -> dict:
+        with self._lock:
+            return {key: [list(state[0]), state[1], state[2]] for key, state in self._values.items()}
+
+    def set_remote(self, source: str, values: dict):
+        with self._lock:
+            self._remote[source] = values
+
+    def _merged(self) -> dict:
+        # Свои серии и серии других процессов: бакеты, суммы и количества складываются
+        merged = self.dump()
+        with self._lock:
+            remote = list(self._remote.values())
+        for other in remote:
+            for key, (counts, total, count) in other.items():
+                state = merged.get(key)
+                if state is None:
+                    merged[key] = [list(counts), total, count]
+                    continue
+                state[0] = [a + b for a, b in zip(state[0], counts)]
+                state[1] += total
+                state[2] += count
+        return merged
+
+    def items(self) -> list[tuple[tuple, int, float]]:
+        """
+        (метки, количество, сумма) по всем сериям, сложенные по процессам.
+        """
+        return [(key, state[2], state[1]) for key, state in self._merged().items()]
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in self._merged().items():
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float("inf")), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_labels", "_started")
+
+    def __init__(self, histogram: Histogram, labels: dict):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._started, **self._labels)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        """
+        fn() вызывается перед выдачей метрик — обновить значения, которые
+        удобнее прочитать по требованию (размер кэша, очереди и т.п.).
+        """
+        self._collectors.append(fn)
+        return fn
+
+    def collect(self):
+        for fn in self._collectors:
+            try:
+                fn()
+            except Exception:
+                logger.exception("Ошибка в сборщике метрик")
+
+    def snapshot(self) -> dict[str, dict]:
+        """
+        Значения метрик этого процесса — для передачи в процесс, который их экспортирует.
+        """
+        self.collect()
+        return {metric.name: metric.dump() for metric in self._metrics}
+
+    def update_remote(self, source: str, snapshot: dict[str, dict]):
+        """
+        Последний снимок метрик другого процесса (source — его имя). В /metrics
+        и /stats значения всех процессов складываются.
+        """
+        for metric in self._metrics:
+            if metric.name in snapshot:
+                metric.set_remote(source, snapshot[metric.name])
+
+    def render(self) -> str:
+        self.collect()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+HANDLER_SECONDS = registry.register(Histogram(
+    "astro_handler_seconds", "Время обработки апдейта хэндлером", ("handler",),
+))
+HANDLER_ERRORS = registry.register(Counter(
+    "astro_handler_errors_total", "Исключения в хэндлерах", ("handler",),
+))
+DB_SECONDS = registry.register(Histogram(
+    "astro_db_seconds", "Время выполнения функций db.py", ("function",),
+))
+DB_QUEUE_WAIT_SECONDS = registry.register(Histogram(
+    "astro_db_queue_wait_seconds", "Ожидание запроса в очереди потока БД",
+))
+DB_BATCH_SIZE = registry.register(Histogram(
+    "astro_db_batch_size", "Число запросов в одной транзакции потока БД",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+))
+BROADCAST_MESSAGES = registry.register(Counter(
+    "astro_broadcast_messages_total", "Сообщения рассылок по результату", ("job", "result"),
+))
+BROADCAST_RETRIES = registry.register(Counter(
+    "astro_broadcast_retries_total", "Повторы отправки в рассылках", ("job", "reason"),
+))
+BROADCAST_SEND_RATE = registry.register(Gauge(
+    "astro_broadcast_rate", "Средняя скорость последней рассылки, сообщений/с", ("job",),
+))
+BROADCAST_SECONDS = registry.register(Gauge(
+    "astro_broadcast_duration_seconds", "Длительность последней рассылки", ("job",),
+))
+PROFILE_CACHE = registry.register(Gauge(
+    "astro_profile_cache", "Кэш профилей: размер, попадания и промахи", ("stat",),
+))
+
+
+@registry.collector
+def _collect_profile_cache():
+    # Долю попаданий не экспортируем: её нельзя сложить по процессам, а из hits и misses она считается
+    stats = profile_cache.stats()
+    for stat in ("size", "hits", "misses"):
+        PROFILE_CACHE.set(stats[stat], stat=stat)
+
+
+def timed(histogram: Histogram, label: str):
+    """
+    Декоратор: время каждого вызова функции попадает в histogram с меткой label.
+    """
+    labelname = histogram.labelnames[0]
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, **{labelname: label})
+        return wrapper
+
+    return decorator
+
+
+def db_timed(fn):
+    """
+    Таймер для функций db.py: метка — имя функции.
+    """
+    return timed(DB_SECONDS, fn.__name__)(fn)
+
+
+def summary() -> str:
+    """
+    Короткая сводка для команды /stats.
+    """
+    registry.collect()  # обновить значения сборщиков
+    lines = ["📊 Хэндлеры (вызовы, среднее время):"]
+    for (handler,), count, total in sorted(HANDLER_SECONDS.items(), key=lambda item: -item[1]):
+        lines.append(f"• {handler}: {count}, {total / count * 1000:.1f} мс")
+
+    lines.append("\n🗄 БД (вызовы, среднее время):")
+    for (function,), count, total in sorted(DB_SECONDS.items(), key=lambda item: -item[2])[:10]:
+        lines.append(f"• {function}: {count}, {total / count * 1000:.2f} мс")
+
+    lines.append("\n📨 Рассылки:")
+    for (job, result), value in sorted(BROADCAST_MESSAGES.items()):
+        lines.append(f"• {job} {result}: {int(value)}")
+    for (job, reason), value in sorted(BROADCAST_RETRIES.items()):
+        lines.append(f"• {job} повторы ({reason}): {int(value)}")
+    for (job,), value in BROADCAST_SEND_RATE.items():
+        lines.append(f"• {job}: {value:.1f} сообщений/с")
+
+    cache = {stat: value for (stat,), value in PROFILE_CACHE.items()}
+    lookups = cache.get("hits", 0) + cache.get("misses", 0)
+    lines.append(
+        f"\n👤 Кэш профилей: {int(cache.get('size', 0))} записей, "
+        f"попаданий {cache.get('hits', 0) / lookups * 100 if lookups else 0:.0f}%"
+    )
+    return "\n".join(lines)
+
+
+# --- HTTP-эндпоинт для Prometheus ---
+
+
+async def _handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            body = registry.render().encode("utf-8")
+            status = "200 OK"
+        else:
+            body = b"not found\n"
+            status = "404 Not Found"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_http_server(host: str, port: int) -> asyncio.AbstractServer:
+    server = await asyncio.start_server(_handle_http, host, port)
+    logger.info("Метрики Prometheus: http://%s:%d/metrics", host, port)
+    return server
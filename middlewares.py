@@ -0,0 +1,31 @@
+import time
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from metrics import HANDLER_ERRORS, HANDLER_SECONDS
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Время работы каждого хэндлера и число исключений в нём (см. metrics.py).
+    Регистрируется как inner-middleware, поэтому хэндлер уже выбран.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
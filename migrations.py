@@ -0,0 +1,359 @@
+import argparse
+import logging
+import re
+import sqlite3
+import sys
+from datetime import datetime
+
+import db
+from config import TIMEZONE
+
+logger = logging.getLogger(__name__)
+
+# Миграции схемы по порядку: (версия, название, функция(conn)).
+# Применённые записываются в schema_version; каждая выполняется в своей транзакции.
+# Новую миграцию — только в конец списка, уже выпущенные не менять.
+MIGRATIONS: list[tuple[int, str, object]] = []
+
+
+def migration(version: int, name: str):
+    def decorator(fn):
+        assert not MIGRATIONS or MIGRATIONS[-1][0] < version, "миграции должны идти по возрастанию версии"
+        MIGRATIONS.append((version, name, fn))
+        return fn
+    return decorator
+
+
+@migration(1, "initial_schema")
+def _initial_schema(conn):
+    # Схема, которую раньше создавал db.create_tables; на существующей базе ничего не меняет
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        sign TEXT,
+        birth_data DATE,
+        subscription_status TEXT DEFAULT 'free',
+        last_gen_date TIMESTAMP,
+        used_phrases TEXT DEFAULT '[]',  -- JSON-строка
+        tarot_history TEXT DEFAULT '[]'  -- JSON-строка
+    );
+    """)
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS quotes (
+        quote_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        last_used TIMESTAMP
+    );
+    """)
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS tarot_cards (
+        card_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        meaning TEXT NOT NULL
+    );
+    """)
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS user_quote_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        quote TEXT,
+        used_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+
+    # История вытянутых карт Таро: одна строка на карту
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS tarot_draws (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id BIGINT NOT NULL,
+        card_id INTEGER NOT NULL,
+        drawn_at TIMESTAMP NOT NULL
+    );
+    """)
+    # Покрывающий индекс: "последние N карт пользователя" читаются только из индекса
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_tarot_draws_user_recent
+    ON tarot_draws (user_id, drawn_at DESC, card_id);
+    """)
+
+    # Курсоры колец цитат (см. quote_index.py)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS quote_cursors (
+        user_id BIGINT PRIMARY KEY,
+        cycle INTEGER NOT NULL DEFAULT 0,
+        position INTEGER NOT NULL DEFAULT 0,
+        recent TEXT DEFAULT '[]'  -- JSON: [[день, индекс цитаты], ...]
+    );
+    """)
+
+    # Outbox рассылок: одна строка на получателя в кампании (см. outbox.py).
+    # Время — unix-время в секундах
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        campaign TEXT NOT NULL,
+        user_id BIGINT NOT NULL,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',  -- pending / sending / sent / failed
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL,
+        sent_at REAL,
+        UNIQUE (campaign, user_id)
+    );
+    """)
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_outbox_claim
+    ON outbox (campaign, status, next_attempt_at);
+    """)
+
+    # Колонки, добавленные после первой версии схемы
+    db._add_column_if_missing(conn, "users", "selection_state", "BLOB")
+    db._add_column_if_missing(conn, "users", "timezone", "TEXT")  # NULL — TIMEZONE из config
+    # NULL — сообщения доставляются; иначе причина, по которой получатель недоступен
+    # (blocked, deactivated, not_found), и сколько раз это случалось
+    db._add_column_if_missing(conn, "users", "delivery_status", "TEXT")
+    db._add_column_if_missing(conn, "users", "delivery_failures", "INTEGER DEFAULT 0")
+
+    # Рассылки идут отдельно по каждому часовому поясу
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_timezone ON users (timezone);")
+
+
+@migration(2, "recipient_indexes")
+def _recipient_indexes(conn):
+    # Получатели рассылок читаются постранично по user_id (см. db.get_users_with_sign):
+    # частичные индексы содержат только тех, кому есть что отправлять и кому сообщения доходят.
+    # delivery_status в индексе всегда NULL, но без него SQLite читает строку таблицы,
+    # чтобы проверить условие, — с ним индексы покрывающие
+    for index in ("idx_users_signed", "idx_users_signed_timezone", "idx_users_subscription"):
+        # Прежние версии этих индексов — без условия на delivery_status
+        conn.execute(f"DROP INDEX IF EXISTS {index}")
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_users_recipients
+    ON users (user_id, sign, timezone, delivery_status) WHERE sign IS NOT NULL AND delivery_status IS NULL;
+    """)
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_users_recipients_timezone
+    ON users (timezone, user_id, sign, delivery_status) WHERE sign IS NOT NULL AND delivery_status IS NULL;
+    """)
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_users_recipients_subscription
+    ON users (subscription_status, user_id, delivery_status) WHERE delivery_status IS NULL;
+    """)
+
+
+@migration(3, "quote_history_index")
+def _quote_history_index(conn):
+    # Цитаты пользователя за последние дни — из индекса, без чтения таблицы
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_user_quote_history_recent
+    ON user_quote_history (user_id, used_at DESC, quote);
+    """)
+
+
+@migration(4, "tarot_history_to_table")
+def _tarot_history_to_table(conn):
+    # Имена карт из JSON сопоставляются с tarot_cards — колода должна быть записана
+    from tarot import sync_tarot_cards
+
+    sync_tarot_cards()
+    db.migrate_tarot_history()
+    # used_phrases не читается с тех пор, как фразы выбираются курсорами selection_state
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(users)")}
+        for column in ("used_phrases", "tarot_history"):
+            if column in columns:
+                conn.execute(f"ALTER TABLE users DROP COLUMN {column}")
+
+
+@migration(5, "outbox_due_index")
+def _outbox_due_index(conn):
+    # outbox_claim берёт самые ранние из готовых к отправке: по этому индексу — сразу
+    # в порядке next_attempt_at, без сортировки всех неотправленных сообщений кампании
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_outbox_due
+    ON outbox (campaign, next_attempt_at) WHERE status IN ('pending', 'sending');
+    """)
+
+
+@migration(6, "outbox_campaigns")
+def _outbox_campaigns(conn):
+    # Кампании, все получатели которых уже в outbox: повторный запуск в тот же день
+    # только досылает неотправленное, новых получателей не добавляет (см. jobs.send_daily_horoscope)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS outbox_campaigns (
+        campaign TEXT PRIMARY KEY,
+        generated_at REAL NOT NULL
+    );
+    """)
+
+
+@migration(7, "drop_user_quote_history")
+def _drop_user_quote_history(conn):
+    # Историю цитат заменили курсоры quote_cursors (см. quote_index.py): таблицу никто
+    # не читает и не пишет, а индекс миграции 3 только занимал место
+    conn.execute("DROP INDEX IF EXISTS idx_user_quote_history_recent")
+    conn.execute("DROP TABLE IF EXISTS user_quote_history")
+
+
+# --- Выполнение ---
+
+
+def _ensure_version_table(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TEXT NOT NULL
+    );
+    """)
+
+
+def current_version() -> int:
+    with db.transaction() as conn:
+        _ensure_version_table(conn)
+        return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+
+def pending_migrations() -> list[tuple[int, str]]:
+    with db.transaction() as conn:
+        _ensure_version_table(conn)
+        applied = {row[0] for row in conn.execute("SELECT version FROM schema_version")}
+    return [(version, name) for version, name, _ in MIGRATIONS if version not in applied]
+
+
+def migrate(target: int | None = None) -> list[int]:
+    """
+    Применяем недостающие миграции (до target включительно). Каждая — отдельной
+    транзакцией вместе с записью в schema_version: упавшая миграция не оставляет
+    схему наполовину изменённой. BEGIN IMMEDIATE — если несколько процессов
+    стартуют одновременно, миграцию выполнит один, остальные увидят её готовой.
+    """
+    applied = []
+    for version, name in pending_migrations():
+        if target is not None and version > target:
+            break
+        fn = next(fn for v, _, fn in MIGRATIONS if v == version)
+        with db.transaction() as conn:
+            if not conn.in_transaction:
+                # sqlite3 сам открывает транзакцию только перед DML, а здесь в основном DDL
+                conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,)).fetchone():
+                continue
+            fn(conn)
+            conn.execute(
+                "INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                (version, name, datetime.utcnow().isoformat(timespec="seconds")),
+            )
+        logger.info("Применена миграция %d: %s", version, name)
+        applied.append(version)
+    return applied
+
+
+# --- Проверка планов горячих запросов ---
+
+
+def _hot_queries():
+    """
+    Запросы, которые выполняются на каждый апдейт или на каждого получателя рассылки.
+    Вызываются настоящие функции db.py — проверяется ровно тот SQL, что выполняет бот.
+    """
+    page = {"after_user_id": 0, "limit": 500}
+    return [
+        ("profile", lambda: db.load_user_profile(1)),
+        ("selection_state", lambda: db.get_selection_state(1)),
+        ("tarot_recent", lambda: db.get_recent_tarot_card_ids(1)),
+        ("recipients", lambda: db.get_users_with_sign(**page)),
+        ("recipients_shard", lambda: db.get_users_with_sign(shard=(0, 4), **page)),
+        ("recipients_timezone", lambda: db.get_users_with_sign(not_in_campaign="c", timezone="Asia/Tokyo", **page)),
+        ("recipients_default_timezone", lambda: db.get_users_with_sign(not_in_campaign="c", timezone=TIMEZONE, **page)),
+        ("reminder_recipients", lambda: db.get_users_by_subscription("inactive", **page)),
+        ("outbox_claim", lambda: db.outbox_claim("c", 200, 300)),
+        ("outbox_extend_lease", lambda: db.outbox_extend_lease("c", [1], 300)),
+        ("outbox_next_attempt", lambda: db.outbox_next_attempt_in("c")),
+        ("outbox_generated", lambda: db.outbox_is_generated("c")),
+        ("timezones", db.get_timezones),
+    ]
+
+
+# Полный просмотр таблицы (без индекса) или сортировка всей выборки во временном B-дереве
+_BAD_PLAN = re.compile(r"^SCAN \w+$|TEMP B-TREE")
+
+
+def check_plans() -> list[tuple[str, str, list[str]]]:
+    """
+    EXPLAIN QUERY PLAN каждого горячего запроса на пустой базе в памяти со всеми миграциями.
+    Возвращает [(запрос, SQL, строки плана с полным просмотром или сортировкой)];
+    пустой список — все запросы идут по индексам.
+    """
+    previous = db.DB_PATH
+    db.close_db_connection()
+    db.DB_PATH = "memory://query-plans"
+    try:
+        migrate()
+        conn = db.get_db_connection()
+        problems = []
+        for name, call in _hot_queries():
+            statements = []
+            conn.set_trace_callback(statements.append)
+            try:
+                with db.transaction():
+                    call()
+                    raise _Rollback
+            except _Rollback:
+                pass
+            finally:
+                conn.set_trace_callback(None)
+            for sql in statements:
+                if not re.match(r"\s*(SELECT|UPDATE|DELETE)", sql, re.IGNORECASE):
+                    continue
+                plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+                bad = [detail for detail in plan if _BAD_PLAN.search(detail)]
+                logger.info("%s: %s", name, "; ".join(plan))
+                if bad:
+                    problems.append((name, " ".join(sql.split()), bad))
+        return problems
+    finally:
+        db.close_db_connection()
+        db.DB_PATH = previous
+
+
+class _Rollback(Exception):
+    pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Миграции схемы базы бота")
+    parser.add_argument("--db", help="база (путь или URL), по умолчанию DATABASE_URL из config")
+    parser.add_argument("--target", type=int, help="применить миграции только до этой версии")
+    parser.add_argument("--status", action="store_true", help="показать версию схемы и неприменённые миграции")
+    parser.add_argument(
+        "--check-plans", action="store_true",
+        help="проверить планы горячих запросов (код выхода 1, если какой-то идёт полным просмотром)",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if args.check_plans:
+        problems = check_plans()
+        for name, sql, bad in problems:
+            print(f"{name}: {', '.join(bad)}\n    {sql}", file=sys.stderr)
+        print("Планы запросов в порядке" if not problems else f"Запросов без индекса: {len(problems)}")
+        sys.exit(1 if problems else 0)
+
+    if args.db:
+        db.DB_PATH = args.db
+    if args.status:
+        print(f"Версия схемы: {current_version()}")
+        for version, name in pending_migrations():
+            print(f"Не применена: {version} {name}")
+        return
+    applied = migrate(args.target)
+    print(f"Применено миграций: {len(applied)}, версия схемы: {current_version()}")
+
+
+if __name__ == "__main__":
+    main()
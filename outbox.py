@@ -0,0 +1,151 @@
+import asyncio
+import logging
+from datetime import date
+
+from broadcast import Broadcaster, BroadcastStats, Sender
+from config import (
+    BROADCAST_PROGRESS_INTERVAL,
+    BROADCAST_RATE,
+    OUTBOX_CLAIM_BATCH,
+    OUTBOX_LEASE,
+    OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_RETRY_DELAY,
+)
+from repo import repo
+
+logger = logging.getLogger(__name__)
+
+# Пока продюсер наполняет outbox, а готовых сообщений нет — проверяем так часто (секунд)
+_PRODUCER_POLL = 0.1
+# Остались только сообщения, арендованные другими отправителями: они отметят их
+# задолго до конца аренды — проверяем так часто, а не ждём всю OUTBOX_LEASE
+_LEASE_POLL = 1.0
+
+
+def campaign_id(kind: str, day: date | None = None) -> str:
+    """
+    Кампания — одна рассылка одного вида за день: daily_horoscope@Europe/Moscow:2024-05-01.
+    """
+    return f"{kind}:{(day or date.today()).isoformat()}"
+
+
+def parse_campaign(campaign: str) -> tuple[str, date | None]:
+    kind, _, day = campaign.rpartition(":")
+    try:
+        return kind, date.fromisoformat(day)
+    except ValueError:
+        return kind, None
+
+
+def _claim_size(broadcast_options: dict) -> int:
+    """
+    Сколько сообщений забирать за раз: столько, сколько уйдёт за четверть
+    OUTBOX_LEASE при темпе рассылки, но не больше OUTBOX_CLAIM_BATCH.
+    """
+    bucket = broadcast_options.get("bucket")
+    rate = broadcast_options.get("rate", BROADCAST_RATE) if bucket is None else bucket.rate
+    while bucket is not None:
+        rate = min(rate, bucket.rate)
+        bucket = getattr(bucket, "parent", None)
+    return max(1, min(OUTBOX_CLAIM_BATCH, int(rate * OUTBOX_LEASE / 4)))
+
+
+async def run_campaign(
+    campaign: str,
+    sender: Sender,
+    name: str | None = None,
+    producer: asyncio.Task | None = None,
+    stats: BroadcastStats | None = None,
+    **broadcast_options,
+) -> BroadcastStats:
+    """
+    Отправляем сообщения кампании из outbox, пока в ней есть неотправленные.
+    Сообщения забираются пачками (outbox_claim), результат каждого сразу
+    записывается (sent — повторно не отправится, ошибка — повтор позже или failed).
+    Если процесс упадёт, новый вызов продолжит с того же места: забранные,
+    но не отмеченные сообщения вернутся в работу через OUTBOX_LEASE секунд.
+    Пока процесс жив, аренду забранных, но ещё не отправленных сообщений он
+    продлевает — иначе после долгой паузы (retry_after) их забрала бы следующая
+    пачка и они ушли бы дважды.
+    producer — задача, которая ещё дописывает сообщения в outbox.
+    stats — чтобы следить за прогрессом этого отправителя во время рассылки.
+    Несколько отправителей (процессов) могут работать с одной кампанией одновременно.
+    """
+    name = name or parse_campaign(campaign)[0]
+    claim_size = _claim_size(broadcast_options)
+    # Забранные и ещё не отмеченные: очередь Broadcaster, отправка, паузы перед повтором
+    in_flight: set[int] = set()
+    drained = asyncio.Event()
+    drained.set()
+    room = asyncio.Event()
+    room.set()
+
+    async def on_result(user_id: int, ok: bool, permanent: bool):
+        if ok:
+            await repo.outbox_mark_sent(campaign, user_id)
+        else:
+            # Недоставляемому получателю повтор не поможет — сразу failed
+            max_attempts = 0 if permanent else OUTBOX_MAX_ATTEMPTS
+            await repo.outbox_mark_failed(campaign, user_id, max_attempts, OUTBOX_RETRY_DELAY)
+        in_flight.discard(user_id)
+        if len(in_flight) <= claim_size:
+            room.set()
+        if not in_flight:
+            drained.set()
+
+    async def messages():
+        while True:
+            # Следующую пачку забираем, когда от предыдущей осталось не больше пачки:
+            # забранное успевает уйти примерно за половину OUTBOX_LEASE
+            await room.wait()
+            claimed = await repo.outbox_claim(campaign, claim_size, OUTBOX_LEASE)
+            if claimed:
+                in_flight.update(user_id for user_id, _ in claimed)
+                drained.clear()
+                if len(in_flight) > claim_size:
+                    room.clear()
+                for item in claimed:
+                    yield item
+                continue
+            if producer is not None and not producer.done():
+                await asyncio.sleep(_PRODUCER_POLL)
+                continue
+            # Новых нет — дожидаемся результатов уже забранных, потом повторов
+            await drained.wait()
+            wait = await repo.outbox_next_attempt_in(campaign)
+            if wait is None:
+                return
+            await asyncio.sleep(min(wait, _LEASE_POLL))
+
+    async def report():
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            progress = await repo.outbox_progress(campaign)
+            logger.info("Рассылка %s: %s", campaign, ", ".join(f"{k}={v}" for k, v in sorted(progress.items())))
+
+    async def renew():
+        while True:
+            await asyncio.sleep(OUTBOX_LEASE / 3)
+            if in_flight:
+                await repo.outbox_extend_lease(campaign, list(in_flight), OUTBOX_LEASE)
+
+    broadcast_options.setdefault("on_undeliverable", repo.mark_undeliverable)
+    reporter = asyncio.create_task(report())
+    renewer = asyncio.create_task(renew())
+    try:
+        broadcaster = Broadcaster(sender, name=name, on_result=on_result, **broadcast_options)
+        stats = await broadcaster.run(messages(), stats)
+        if producer is not None:
+            await producer
+    finally:
+        reporter.cancel()
+        renewer.cancel()
+        if producer is not None and not producer.done():
+            producer.cancel()
+
+    progress = await repo.outbox_progress(campaign)
+    logger.info(
+        "Рассылка %s завершена: отправлено за этот запуск %d, ошибок %d, всего в кампании %s",
+        campaign, stats.sent, stats.failed, ", ".join(f"{k}={v}" for k, v in sorted(progress.items())),
+    )
+    return stats
@@ -0,0 +1,42 @@
+import hashlib
+
+# Число раундов сети Фейстеля — достаточно, чтобы порядок выглядел случайным
+_ROUNDS = 4
+
+
+def make_key(*parts) -> bytes:
+    """
+    Ключ перестановки из произвольных частей (user_id, название набора, номер цикла...).
+    """
+    return "|".join(str(p) for p in parts).encode("utf-8")
+
+
+def _round(key: bytes, r: int, value: int) -> int:
+    digest = hashlib.blake2b(key + bytes((r,)) + value.to_bytes(8, "little"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def permute(index: int, n: int, key: bytes) -> int:
+    """
+    Псевдослучайная перестановка [0, n) -> [0, n), заданная ключом.
+
+    permute(0..n-1, n, key) перечисляет все элементы ровно по одному разу,
+    поэтому "курсор" (номер шага) даёт следующий неповторяющийся элемент за O(1),
+    без хранения самой перестановки. Сеть Фейстеля на ближайшей чётной степени
+    двойки + cycle walking для значений за пределами [0, n).
+    """
+    if n <= 1:
+        return 0
+    bits = max((n - 1).bit_length(), 2)
+    bits += bits % 2
+    half = bits // 2
+    mask = (1 << half) - 1
+
+    x = index % n
+    while True:
+        left, right = x >> half, x & mask
+        for r in range(_ROUNDS):
+            left, right = right, left ^ (_round(key, r, right) & mask)
+        x = (left << half) | right
+        if x < n:
+            return x
@@ -0,0 +1,164 @@
+import json
+import threading
+from datetime import date
+
+import content
+from cache import LRUCache
+from config import QUOTE_CURSOR_CACHE_SIZE, QUOTE_CURSOR_CACHE_TTL, QUOTE_REPEAT_DAYS, WRITE_BEHIND
+from db import defer_user_update, get_db_connection, on_rollback, transaction
+from permutation import make_key, permute
+from writebehind import QUOTE_CURSOR, write_behind
+
+DEFAULT_QUOTE = "Вселенная молчит... Но слушай внимательно."
+
+# Ограничение SQLite на число параметров в одном запросе
+_MAX_SQL_PARAMS = 900
+
+
+def load_quotes() -> list[str]:
+    """
+    Цитаты из таблицы quotes, а если она пуста — из data/quotes.json (см. content.py).
+    """
+    conn = get_db_connection()
+    rows = conn.execute("SELECT text FROM quotes ORDER BY quote_id").fetchall()
+    if rows:
+        return [row["text"] for row in rows]
+    return content.get("quotes")
+
+
+class QuoteIndex:
+    """
+    Выбор цитаты дня.
+
+    У каждого пользователя своё "кольцо" — псевдослучайная перестановка всех цитат
+    (permutation.permute по ключу user_id и номеру круга) и курсор в ней.
+    Цитата — следующая позиция кольца, пропуская те, что пользователь видел
+    за последние QUOTE_REPEAT_DAYS дней (это возможно только на стыке кругов).
+
+    Курсоры живут в памяти (LRU на QUOTE_CURSOR_CACHE_SIZE записей), выбор
+    цитаты — O(1) без SQL. Курсор, которого нет в памяти, берётся из ещё
+    не записанных изменений (write_behind) или из quote_cursors — одним
+    запросом на пачку. Новый курсор в режиме WRITE_BEHIND записывается
+    отложенно, вместе с остальным состоянием пользователя; без него —
+    в транзакции вызывающего, как и прочие изменения пользователя.
+    Запись живёт QUOTE_CURSOR_CACHE_TTL (меньше суток): копия в одном процессе
+    не переживает выбор в другом (см. config.py).
+    """
+
+    def __init__(
+        self,
+        quotes: list[str],
+        repeat_days: int = QUOTE_REPEAT_DAYS,
+        cache_size: int = QUOTE_CURSOR_CACHE_SIZE,
+        cache_ttl: float = QUOTE_CURSOR_CACHE_TTL,
+    ):
+        self.quotes = quotes
+        self.repeat_days = repeat_days
+        self._cursors = LRUCache(cache_size, cache_ttl)
+
+    @classmethod
+    def load(cls) -> "QuoteIndex":
+        return cls(load_quotes())
+
+    def draw(self, user_id: int, today: date | None = None) -> str:
+        return self.draw_many([user_id], today)[user_id]
+
+    def draw_many(self, user_ids, today: date | None = None) -> dict[int, str]:
+        """
+        По цитате каждому из user_ids: недостающие курсоры читаются одним запросом, новые пишутся пачкой.
+        """
+        user_ids = list(dict.fromkeys(user_ids))
+        n = len(self.quotes)
+        if n == 0 or not user_ids:
+            return {user_id: DEFAULT_QUOTE for user_id in user_ids}
+        day = (today or date.today()).toordinal()
+
+        cursors, missing = {}, []
+        for user_id in user_ids:
+            cursor = self._cursors.get(user_id)
+            if cursor is None:
+                missing.append(user_id)
+            else:
+                cursors[user_id] = cursor
+        if missing:
+            cursors.update(self._load(missing))
+
+        drawn = {}
+        for user_id in user_ids:
+            cursor = cursors[user_id] = self._next(user_id, *cursors.get(user_id, (0, 0, ())), day)
+            drawn[user_id] = self.quotes[cursor[2][-1][1]]
+        self._save(cursors)
+        return drawn
+
+    def _load(self, user_ids: list[int]) -> dict[int, tuple]:
+        cursors, unread = {}, []
+        for user_id in user_ids:
+            pending, value = write_behind.user_field(user_id, QUOTE_CURSOR) if WRITE_BEHIND else (False, None)
+            if pending:
+                cycle, position, recent = json.loads(value)
+                cursors[user_id] = (cycle, position, tuple(tuple(item) for item in recent))
+            else:
+                unread.append(user_id)
+        conn = get_db_connection()
+        for i in range(0, len(unread), _MAX_SQL_PARAMS):
+            chunk = unread[i:i + _MAX_SQL_PARAMS]
+            placeholders = ",".join("?" * len(chunk))
+            for row in conn.execute(
+                f"SELECT user_id, cycle, position, recent FROM quote_cursors WHERE user_id IN ({placeholders})",
+                chunk,
+            ):
+                recent = tuple(tuple(item) for item in json.loads(row["recent"] or "[]"))
+                cursors[row["user_id"]] = (row["cycle"], row["position"], recent)
+        return cursors
+
+    def _save(self, cursors: dict[int, tuple]):
+        for user_id, cursor in cursors.items():
+            self._cursors.set(user_id, cursor)
+        with transaction() as conn:
+            # Откат транзакции — курсоры в памяти больше не совпадают с записанными
+            on_rollback(lambda: self._forget(cursors))
+            if WRITE_BEHIND:
+                for user_id, (cycle, position, recent) in cursors.items():
+                    defer_user_update(user_id, **{QUOTE_CURSOR: json.dumps([cycle, position, recent])})
+                return
+            conn.executemany(
+                "INSERT OR REPLACE INTO quote_cursors (user_id, cycle, position, recent) VALUES (?, ?, ?, ?)",
+                [
+                    (user_id, cycle, position, json.dumps(recent))
+                    for user_id, (cycle, position, recent) in cursors.items()
+                ],
+            )
+
+    def _forget(self, user_ids):
+        for user_id in user_ids:
+            self._cursors.invalidate(user_id)
+
+    def _next(self, user_id: int, cycle: int, position: int, recent: tuple, day: int) -> tuple[int, int, tuple]:
+        n = len(self.quotes)
+        recent = tuple(item for item in recent if day - item[0] < self.repeat_days)
+        seen = {idx for _, idx in recent}
+
+        # Если цитат меньше, чем показов за окно, повтор неизбежен — не пропускаем
+        skips_left = 2 * n if len(seen) < n else 0
+        while True:
+            idx = permute(position, n, make_key("quote", user_id, cycle))
+            position += 1
+            if position >= n:
+                cycle, position = cycle + 1, 0
+            if idx not in seen or skips_left <= 0:
+                break
+            skips_left -= 1
+        return cycle, position, recent + ((day, idx),)
+
+
+_index: QuoteIndex | None = None
+_index_lock = threading.Lock()
+
+
+def get_quote_index() -> QuoteIndex:
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = QuoteIndex.load()
+    return _index
@@ -0,0 +1,329 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from datetime import date
+
+import db
+from cache import profile_cache
+from config import HOROSCOPE_BATCH_SIZE, TIMEZONE, WRITE_BEHIND
+from metrics import DB_BATCH_SIZE, DB_QUEUE_WAIT_SECONDS
+import horoscope
+import tarot
+from writebehind import write_behind
+
+logger = logging.getLogger(__name__)
+
+# Сколько запросов из очереди выполняется одной транзакцией
+DEFAULT_BATCH_SIZE = 64
+
+_STOP = object()
+
+
+def _resolve(fut: asyncio.Future, result):
+    if not fut.done():
+        fut.set_result(result)
+
+
+def _reject(fut: asyncio.Future, exc: BaseException):
+    if not fut.done():
+        fut.set_exception(exc)
+
+
+class Repository:
+    """
+    Асинхронный слой доступа к данным.
+
+    Все синхронные функции db.py / horoscope.py выполняются в одном выделенном
+    потоке: хэндлеры ставят запрос в очередь и ждут результат через await,
+    не блокируя event loop. Накопившиеся в очереди запросы поток выполняет
+    пачкой в одной транзакции — один commit (и один fsync) на пачку.
+    В режиме WRITE_BEHIND поток также сбрасывает отложенные записи
+    (см. writebehind.py) — по таймеру, по их числу и при остановке.
+    """
+
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.batch_size = batch_size
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._worker, name="db-executor", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float | None = None):
+        """
+        Дожидаемся выполнения уже поставленных запросов и останавливаем поток.
+        """
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is None:
+            return
+        self._queue.put(_STOP)
+        thread.join(timeout)
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Выполнить fn(*args, **kwargs) в потоке БД и вернуть результат.
+        """
+        if self._thread is None:
+            self.start()
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._queue.put((fn, args, kwargs, loop, fut, time.perf_counter()))
+        return await fut
+
+    # --- Поток БД ---
+
+    def _worker(self):
+        stopping = False
+        # Без отложенной записи потоку нечего делать, пока нет запросов
+        timeout = write_behind.interval if WRITE_BEHIND else None
+        while not stopping:
+            try:
+                job = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                self._flush_write_behind()
+                continue
+            if job is _STOP:
+                break
+            batch = [job]
+            while len(batch) < self.batch_size:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is _STOP:
+                    stopping = True
+                    break
+                batch.append(job)
+            self._run_batch(batch)
+            if WRITE_BEHIND and write_behind.due():
+                self._flush_write_behind()
+        if WRITE_BEHIND:
+            self._flush_write_behind(force=True)
+        db.close_db_connection()
+
+    @staticmethod
+    def _flush_write_behind(force: bool = False):
+        if not (force or write_behind.due()):
+            return
+        try:
+            db.flush_write_behind()
+        except Exception:
+            # Изменения вернулись в очередь — повторим на следующем тике
+            logger.exception("Не удалось записать отложенные изменения (%d)", len(write_behind))
+
+    def _run_batch(self, batch: list):
+        now = time.perf_counter()
+        for job in batch:
+            DB_QUEUE_WAIT_SECONDS.observe(now - job[5])
+        DB_BATCH_SIZE.observe(len(batch))
+
+        results = []
+        try:
+            with db.transaction():
+                for fn, args, kwargs, _, _, _ in batch:
+                    results.append(fn(*args, **kwargs))
+        except Exception:
+            # Один из запросов упал — пачка откатилась, выполняем запросы по одному,
+            # чтобы ошибка досталась только своему вызывающему
+            if len(batch) > 1:
+                logger.debug("Пачка из %d запросов откатилась, повторяем по одному", len(batch))
+            for job in batch:
+                self._run_single(job)
+            return
+
+        for (_, _, _, loop, fut, _), result in zip(batch, results):
+            loop.call_soon_threadsafe(_resolve, fut, result)
+
+    @staticmethod
+    def _run_single(job):
+        fn, args, kwargs, loop, fut, _ = job
+        try:
+            with db.transaction():
+                result = fn(*args, **kwargs)
+        except Exception as e:
+            loop.call_soon_threadsafe(_reject, fut, e)
+        else:
+            loop.call_soon_threadsafe(_resolve, fut, result)
+
+    # --- Пользователи ---
+
+    async def ensure_user(self, user_id: int, reactivate: bool = False):
+        if WRITE_BEHIND:
+            # Запись создаст поток БД при ближайшем сбросе, ждать её не нужно
+            fields = {"delivery_status": None} if reactivate else {}
+            if write_behind.journal:
+                # Но изменение дописывается в журнал (возможно, с fsync) — это файловый
+                # ввод-вывод, ему место в потоке БД, а не в цикле событий
+                await self.run(write_behind.update_user, user_id, **fields)
+            else:
+                write_behind.update_user(user_id, **fields)
+            return
+        return await self.run(db.ensure_user, user_id, reactivate)
+
+    async def set_user_sign(self, user_id: int, sign: str):
+        return await self.run(db.set_user_sign, user_id, sign)
+
+    async def get_user_profile(self, user_id: int):
+        # Попадание в кэш отдаём сразу, без похода в поток БД
+        profile = profile_cache.get(user_id)
+        if profile is not None:
+            return profile
+        return await self.run(db.load_user_profile, user_id)
+
+    async def get_user_sign(self, user_id: int) -> str | None:
+        return (await self.get_user_profile(user_id)).sign
+
+    async def update_subscription(self, user_id: int, status: str):
+        return await self.run(db.update_subscription, user_id, status)
+
+    async def get_subscription_status(self, user_id: int) -> str | None:
+        return (await self.get_user_profile(user_id)).subscription_status
+
+    async def get_users_with_sign(
+        self,
+        subscription_status: str | None = None,
+        shard: tuple[int, int] | None = None,
+        not_in_campaign: str | None = None,
+        timezone: str | None = None,
+        after_user_id: int | None = None,
+        limit: int | None = None,
+    ) -> list[tuple[int, str]]:
+        return await self.run(
+            db.get_users_with_sign, subscription_status, shard, not_in_campaign, timezone, after_user_id, limit
+        )
+
+    async def count_users_with_sign(
+        self,
+        subscription_status: str | None = None,
+        shard: tuple[int, int] | None = None,
+        not_in_campaign: str | None = None,
+        timezone: str | None = None,
+    ) -> int:
+        return await self.run(db.count_users_with_sign, subscription_status, shard, not_in_campaign, timezone)
+
+    async def iter_users_with_sign(
+        self,
+        subscription_status: str | None = None,
+        shard: tuple[int, int] | None = None,
+        not_in_campaign: str | None = None,
+        timezone: str | None = None,
+        page_size: int = HOROSCOPE_BATCH_SIZE,
+    ):
+        """
+        Получатели рассылки страницами по page_size (user_id, sign), по возрастанию user_id.
+        Следующая страница читается, только когда потребитель закончил с предыдущей,
+        поэтому в памяти не больше одной страницы при любом числе пользователей.
+        """
+        after = None
+        while True:
+            page = await self.get_users_with_sign(
+                subscription_status, shard, not_in_campaign, timezone, after_user_id=after, limit=page_size
+            )
+            if not page:
+                return
+            yield page
+            if len(page) < page_size:
+                return
+            after = page[-1][0]
+
+    async def set_user_timezone(self, user_id: int, timezone: str):
+        return await self.run(db.set_user_timezone, user_id, timezone)
+
+    async def get_user_timezone(self, user_id: int) -> str:
+        return await self.run(db.get_user_timezone, user_id)
+
+    async def mark_undeliverable(self, recipients: list[tuple[int, str]]):
+        return await self.run(db.mark_undeliverable, recipients)
+
+    async def get_timezones(self) -> list[str]:
+        return await self.run(db.get_timezones)
+
+    async def get_users_by_subscription(
+        self, status: str, after_user_id: int | None = None, limit: int | None = None
+    ) -> list[int]:
+        return await self.run(db.get_users_by_subscription, status, after_user_id, limit)
+
+    async def iter_users_by_subscription(self, status: str, page_size: int = HOROSCOPE_BATCH_SIZE):
+        """
+        id пользователей со статусом status страницами, как iter_users_with_sign.
+        """
+        after = None
+        while True:
+            page = await self.get_users_by_subscription(status, after_user_id=after, limit=page_size)
+            if not page:
+                return
+            yield page
+            if len(page) < page_size:
+                return
+            after = page[-1]
+
+    # --- Гороскопы ---
+
+    async def generate_horoscope(self, user_id: int, sign: str) -> str:
+        if horoscope.HOROSCOPE_DETERMINISTIC:
+            if not horoscope.day_quotes_loaded():
+                # Цитаты читаются из БД — в потоке БД, а не в цикле событий
+                await self.run(horoscope.load_day_quotes)
+            # Дальше БД не нужна — считаем сразу, без очереди потока БД
+            return horoscope.deterministic_horoscope(user_id, sign)
+        return await self.run(horoscope.generate_horoscope, user_id, sign)
+
+    async def generate_horoscopes(self, batch: list[tuple[int, str]]) -> list[str]:
+        return await self.run(horoscope.generate_horoscopes, batch)
+
+    async def generate_horoscopes_to_outbox(
+        self, campaign: str, batch: list[tuple[int, str]], day: date | None = None, timezone: str = TIMEZONE
+    ) -> int:
+        return await self.run(horoscope.generate_horoscopes_to_outbox, campaign, batch, day, timezone)
+
+    # --- Outbox рассылок ---
+
+    async def outbox_add(self, campaign: str, messages: list[tuple[int, str]]) -> int:
+        return await self.run(db.outbox_add, campaign, messages)
+
+    async def outbox_claim(self, campaign: str, limit: int, lease: float) -> list[tuple[int, str]]:
+        return await self.run(db.outbox_claim, campaign, limit, lease)
+
+    async def outbox_extend_lease(self, campaign: str, user_ids: list[int], lease: float):
+        return await self.run(db.outbox_extend_lease, campaign, user_ids, lease)
+
+    async def outbox_mark_sent(self, campaign: str, user_id: int):
+        return await self.run(db.outbox_mark_sent, campaign, user_id)
+
+    async def outbox_mark_failed(self, campaign: str, user_id: int, max_attempts: int, retry_delay: float):
+        return await self.run(db.outbox_mark_failed, campaign, user_id, max_attempts, retry_delay)
+
+    async def outbox_progress(self, campaign: str) -> dict[str, int]:
+        return await self.run(db.outbox_progress, campaign)
+
+    async def outbox_next_attempt_in(self, campaign: str) -> float | None:
+        return await self.run(db.outbox_next_attempt_in, campaign)
+
+    async def outbox_mark_generated(self, campaign: str):
+        return await self.run(db.outbox_mark_generated, campaign)
+
+    async def outbox_is_generated(self, campaign: str) -> bool:
+        return await self.run(db.outbox_is_generated, campaign)
+
+    async def outbox_unfinished_campaigns(self) -> list[str]:
+        return await self.run(db.outbox_unfinished_campaigns)
+
+    async def outbox_prune(self, keep_days: int) -> int:
+        return await self.run(db.outbox_prune, keep_days)
+
+    # --- Таро ---
+
+    async def generate_spread(self, user_id: int, topic: str, spread: str = "three", sign: str | None = None) -> str:
+        return await self.run(tarot.generate_spread, user_id, topic, spread, sign)
+
+
+repo = Repository()
@@ -1,61 +1,55 @@
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from datetime import datetime
-from config import TIMEZONE
-from main import bot
-from horoscope import generate_horoscope
-from db import get_db_connection
+from config import BROADCAST_RATE, TIMEZONE, DAILY_HOROSCOPE_HOUR
+from db import get_timezones
+from repo import repo
+from broadcast import TokenBucket, broadcast, bot_sender, telegram_bucket
+from jobs import horoscope_messages
 
 # === Ежедневная рассылка гороскопов ===
 
-async def send_daily_horoscope():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT user_id, sign FROM users WHERE subscription_status = 'active'")
-    users = cur.fetchall()
-    cur.close()
-    conn.close()
-
-    for user_id, sign in users:
-        horoscope = generate_horoscope(user_id, sign)
-        try:
-            await bot.send_message(user_id, horoscope)
-        except:
-            continue
+async def send_daily_horoscope(bot, timezone: str = TIMEZONE):
+    users = repo.iter_users_with_sign(subscription_status="active", timezone=timezone)
+    # Свой bucket — дочерний к общему на бота: одновременные рассылки делят лимит Telegram
+    await broadcast(
+        horoscope_messages(users), bot_sender(bot), name="daily_horoscope", on_undeliverable=repo.mark_undeliverable,
+        bucket=TokenBucket(BROADCAST_RATE, parent=telegram_bucket),
+    )
 
 # === Еженедельные напоминания о подписке ===
 
-async def send_subscription_reminder():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT user_id FROM users WHERE subscription_status = 'inactive'")
-    users = cur.fetchall()
-    cur.close()
-    conn.close()
-
-    for (user_id,) in users:
-        try:
-            await bot.send_message(
-                user_id,
-                "🔔 Напоминание: ваша премиум-подписка не активна. Хотите продлить?"
-            )
-        except:
-            continue
+async def send_subscription_reminder(bot):
+    text = "🔔 Напоминание: ваша премиум-подписка не активна. Хотите продлить?"
+
+    async def messages():
+        async for user_ids in repo.iter_users_by_subscription("inactive"):
+            for user_id in user_ids:
+                yield user_id, text
+
+    await broadcast(
+        messages(), bot_sender(bot), name="subscription_reminder", on_undeliverable=repo.mark_undeliverable,
+        bucket=TokenBucket(BROADCAST_RATE, parent=telegram_bucket),
+    )
 
 # === Планировщики ===
 
-def scheduler():
+def scheduler(bot):
     scheduler = AsyncIOScheduler()
-    scheduler.add_job(
-        send_daily_horoscope,
-        CronTrigger(hour=8, minute=0, second=0, timezone=TIMEZONE)
-    )
+    # По задаче на каждый часовой пояс пользователей — в 8:00 по местному времени
+    for timezone in get_timezones():
+        scheduler.add_job(
+            send_daily_horoscope,
+            CronTrigger(hour=DAILY_HOROSCOPE_HOUR, minute=0, second=0, timezone=timezone),
+            kwargs={"bot": bot, "timezone": timezone},
+        )
     scheduler.start()
 
-def subscription_reminder_scheduler():
+def subscription_reminder_scheduler(bot):
     scheduler = AsyncIOScheduler()
     scheduler.add_job(
         send_subscription_reminder,
-        CronTrigger(day_of_week="mon", hour=9, minute=0, timezone=TIMEZONE)
+        CronTrigger(day_of_week="mon", hour=9, minute=0, timezone=TIMEZONE),
+        kwargs={"bot": bot},
     )
     scheduler.start()
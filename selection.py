@@ -0,0 +1,74 @@
+import struct
+
+from permutation import make_key, permute
+
+# Наборы, из которых гороскоп выбирает элементы без повторов в пределах круга.
+# Порядок важен: по нему раскладывается BLOB в users.selection_state.
+DIMENSIONS = ("pair", "intro", "symbol", "ending")
+
+# Для каждого набора: размер пространства, номер круга, позиция в круге
+_SLOT = struct.Struct("<III")
+
+
+class SelectionState:
+    """
+    Курсоры пользователя по неповторяющимся перестановкам контента.
+
+    Каждый набор (пары тема|стиль, интро, символы, финалы) перечисляется в порядке
+    псевдослучайной перестановки, заданной (набор, user_id, номер круга).
+    next() отдаёт следующий элемент за O(1); за круг каждый элемент выпадает ровно
+    один раз, после последнего начинается новый круг с новой перестановкой.
+    Если размер набора изменился (обновили контент), круг начинается заново.
+    Всё состояние — 12 байт на набор.
+    """
+
+    __slots__ = ("user_id", "_slots")
+
+    def __init__(self, user_id: int, slots: dict[str, tuple[int, int, int]] | None = None):
+        self.user_id = user_id
+        self._slots = slots or {}
+
+    @classmethod
+    def from_blob(cls, user_id: int, blob: bytes | None) -> "SelectionState":
+        slots = {}
+        if blob and len(blob) == _SLOT.size * len(DIMENSIONS):
+            for i, dimension in enumerate(DIMENSIONS):
+                slots[dimension] = _SLOT.unpack_from(blob, i * _SLOT.size)
+        return cls(user_id, slots)
+
+    def to_blob(self) -> bytes:
+        return b"".join(_SLOT.pack(*self._slots.get(dimension, (0, 0, 0))) for dimension in DIMENSIONS)
+
+    def next(self, dimension: str, n: int) -> int:
+        size, cycle, position = self._slots.get(dimension, (n, 0, 0))
+        if size != n:
+            cycle, position = cycle + 1, 0
+        index = permute(position, n, make_key(dimension, self.user_id, cycle))
+        position += 1
+        if position >= n:
+            cycle, position = cycle + 1, 0
+        self._slots[dimension] = (n, cycle, position)
+        return index
+
+
+class DaySelection:
+    """
+    Выбор без состояния для детерминированного режима (см. horoscope.deterministic_horoscope).
+
+    Элемент набора размера n в день с номером day — позиция day % n в перестановке
+    круга day // n, заданной (salt, набор, user_id, номер круга). За n дней подряд
+    элемент не повторяется; состояние не хранится и не пишется в БД.
+    """
+
+    __slots__ = ("user_id", "day", "salt")
+
+    def __init__(self, user_id: int, day: int, salt: str = ""):
+        self.user_id = user_id
+        self.day = day
+        self.salt = salt
+
+    def next(self, dimension: str, n: int) -> int:
+        if n <= 1:
+            return 0
+        cycle, position = divmod(self.day, n)
+        return permute(position, n, make_key(self.salt, dimension, self.user_id, cycle))
@@ -0,0 +1,102 @@
+"""
+Выбор подключения к базе по DATABASE_URL: SQLite в файле или SQLite в памяти процесса.
+
+Модуль только открывает подключения (sqlite3.Connection) с нужными настройками.
+Это не слой хранилища: операций над данными здесь нет, весь SQL — в db.py
+(и в horoscope.py, quote_index.py) на диалекте SQLite, и другую СУБД через
+DATABASE_URL подключить нельзя.
+"""
+import sqlite3
+import threading
+import uuid
+from urllib.parse import urlsplit
+
+# Сколько подготовленных выражений sqlite3 держит в кэше на одно подключение
+STATEMENT_CACHE_SIZE = 256
+
+
+class SQLiteBackend:
+    """
+    База в файле SQLite. Подключения долгоживущие, по одному на поток (см. db.get_db_connection).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, cached_statements=STATEMENT_CACHE_SIZE)
+        conn.row_factory = sqlite3.Row  # Для удобства работы с результатами запросов (как с dict)
+        # WAL: читатели не блокируют писателя, а fsync делается на checkpoint, а не на каждый commit
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def __repr__(self):
+        return f"SQLiteBackend({self.path!r})"
+
+
+class MemoryBackend:
+    """
+    База в памяти процесса — для бенчмарков, нагрузочных прогонов и проверок:
+    те же запросы, что и у SQLite в файле, но без диска. Все потоки процесса
+    видят одну базу; живёт, пока жив процесс. Другим процессам (шардам рассылки,
+    обработчикам webhook) не видна.
+    """
+
+    def __init__(self, name: str | None = None):
+        self.name = name or uuid.uuid4().hex
+        self._uri = f"file:astro-{self.name}?mode=memory&cache=shared"
+        # База в памяти существует, пока открыто хотя бы одно подключение
+        self._anchor = self.connect()
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self._uri, uri=True, cached_statements=STATEMENT_CACHE_SIZE, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def __repr__(self):
+        return f"MemoryBackend({self.name!r})"
+
+
+def parse_database_url(url: str):
+    """
+    Источник подключений по DATABASE_URL:
+    - sqlite:///astro_bot.db (или просто путь к файлу) — SQLite в файле;
+    - memory:// или memory://имя — в памяти процесса (одно имя — одна база).
+    Оба варианта — SQLite и отдают только подключения, запросы остаются в db.py.
+    Что операции db.py одинаково работают на обоих, проверяет tests/test_storage.py.
+    """
+    if "://" not in url:
+        return SQLiteBackend(url)
+    parts = urlsplit(url)
+    if parts.scheme == "sqlite":
+        path = url[len("sqlite:///"):]
+        if path in ("", ":memory:"):
+            return MemoryBackend()
+        return SQLiteBackend(path)
+    if parts.scheme == "memory":
+        return MemoryBackend(parts.netloc or None)
+    if parts.scheme in ("postgres", "postgresql"):
+        raise ValueError(
+            "PostgreSQL не поддерживается: запросы db.py, horoscope.py и quote_index.py "
+            "написаны на диалекте SQLite. Используйте sqlite:///путь или memory://"
+        )
+    raise ValueError(f"Неизвестная база в DATABASE_URL: {url}")
+
+
+_backends: dict[str, object] = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(url: str):
+    """
+    Источник подключений для url; один на процесс — у базы в памяти так остаётся одно содержимое.
+    """
+    backend = _backends.get(url)
+    if backend is None:
+        with _backends_lock:
+            backend = _backends.get(url)
+            if backend is None:
+                backend = _backends[url] = parse_database_url(url)
+    return backend
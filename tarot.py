@@ -1,5 +1,9 @@
 import random
-from db import get_db_connection, get_tarot_history, save_tarot_history
+import threading
+from dataclasses import dataclass
+from typing import NamedTuple
+import content
+from db import transaction, get_recent_tarot_card_ids, save_tarot_draws
 
 TAROT_STYLES = [
     "мистический",
@@ -12,82 +16,270 @@ TAROT_STYLES = [
 POSITIONS = ["Прошлое", "Настоящее", "Будущее"]
 
 
-def load_tarot_deck() -> list[tuple]:
+_BRIDGES = {
+    "мистический": "Эта карта звучит как шёпот между мирами:",
+    "практичный": "Если говорить совсем по-деловому:",
+    "юмористический": "Если смотреть с лёгкой самоиронией:",
+    "поэтичный": "Если облечь всё это в образ:",
+    "терапевтический": "Если относиться к этому как к мягкой сессии с самим собой:",
+}
+_DEFAULT_BRIDGE = "Суть в том, что:"
+
+# Шаблоны ответа с одной картой: (текст до темы, текст после темы).
+# Имя карты и толкование подставляются один раз при сборке колоды.
+ONE_CARD_TEMPLATES = [
+    ("Твоя карта по теме '", "': **{name}**.\n\nЗначение: {meaning}"),
+    ("Для вопроса '", "' выпала карта: **{name}**.\n\nЕё толкование: {meaning}"),
+    ("Карта Таро: **{name}**.\n\nВ контексте '", "': {meaning}"),
+]
+
+class TarotCard:
     """
-    Загружаем колоду Таро из таблицы tarot_cards.
-    Ожидаемые поля: card_id, name, meaning (минимум).
+    Карта колоды с заранее собранными фрагментами текста.
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT card_id, name, meaning FROM tarot_cards")
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    return rows
 
+    __slots__ = ("card_id", "name", "light", "shadow", "keywords", "titles", "meaning_parts", "one_card_parts")
+
+    def __init__(self, card_id: int, name: str, light: str, shadow: str, keywords: tuple[str, ...]):
+        self.card_id = card_id
+        self.name = name
+        self.light = light
+        self.shadow = shadow
+        self.keywords = keywords
+        # заголовок позиции: прямая / перевёрнутая карта
+        self.titles = (name, f"{name} (перевёрнутая)")
+        # (стиль, перевёрнута ли) -> "мост" стиля + светлое или теневое значение
+        self.meaning_parts = {}
+        for style, bridge in [*_BRIDGES.items(), (None, _DEFAULT_BRIDGE)]:
+            self.meaning_parts[(style, False)] = f"{bridge} {light}"
+            self.meaning_parts[(style, True)] = f"{bridge} {shadow}"
+        # аспект -> [(до темы, после темы)] — для ответа с одной картой
+        self.one_card_parts = {
+            aspect: [
+                (
+                    before.replace("{name}", name).replace("{meaning}", text),
+                    after.replace("{name}", name).replace("{meaning}", text),
+                )
+                for before, after in ONE_CARD_TEMPLATES
+            ]
+            for aspect, text in (("light", light), ("shadow", shadow))
+        }
+
+    def meaning_part(self, style: str | None, reversed_: bool = False) -> str:
+        return self.meaning_parts.get((style, reversed_)) or self.meaning_parts[(None, reversed_)]
 
-def _build_card_interpretation(
-    card_name: str,
-    meaning: str,
-    position: str,
-    topic: str,
-    style: str,
-    sign: str | None,
-) -> str:
+
+class Deck:
     """
-    Генерация интерпретации карты без жёстких шаблонов.
+    Колода Таро, собранная один раз: поиск карты по id и по имени за O(1).
+    version — версия контента, из которого собрана колода.
     """
-    base = f"{position}: {card_name}."
 
-    bridges = {
-        "мистический": "Эта карта звучит как шёпот между мирами:",
-        "практичный": "Если говорить совсем по-деловому:",
-        "юмористический": "Если смотреть с лёгкой самоиронией:",
-        "поэтичный": "Если облечь всё это в образ:",
-        "терапевтический": "Если относиться к этому как к мягкой сессии с самим собой:",
-    }
+    __slots__ = ("cards", "by_id", "by_name", "version")
 
-    topic_line = f"Тема расклада — {topic.lower()}."
-    sign_line = f"Ты сейчас как {sign}, который учится видеть глубже привычного." if sign else ""
-    bridge = bridges.get(style, "Суть в том, что:")
-    meaning_part = f"{bridge} {meaning}"
+    def __init__(self, cards: list[TarotCard], version: str):
+        self.cards = cards
+        self.by_id = {card.card_id: card for card in cards}
+        self.by_name = {card.name: card for card in cards}
+        self.version = version
 
-    return "\n".join([base, topic_line, sign_line, meaning_part]).strip()
+    def __len__(self):
+        return len(self.cards)
 
+    def get(self, card_id: int) -> TarotCard | None:
+        return self.by_id.get(card_id)
 
-def generate_tarot(user_id: int, topic: str, sign: str | None = None) -> str:
+    def find(self, name: str) -> TarotCard | None:
+        return self.by_name.get(name)
+
+
+def build_deck() -> Deck:
     """
-    Генерация расклада из 3 карт:
-    - без повторения недавно использованных карт (по имени)
-    - с разными стилями интерпретации
+    Собираем колоду из data/tarot_interpretations.json (см. content.py).
+    card_id — порядковый номер карты в источнике, начиная с 1.
     """
-    deck = load_tarot_deck()
-    if not deck:
-        return "Колоде сегодня не до работы — в базе пока нет карт Таро. 🃏"
-
-    history = set(get_tarot_history(user_id))
-
-    # выбираем карты, которые не встречались недавно, если возможно
-    fresh_cards = [c for c in deck if c[1] not in history]
-    source = fresh_cards if len(fresh_cards) >= 3 else deck
-
-    selected = random.sample(source, 3)
-    styles_cycle = random.sample(TAROT_STYLES, k=3)
-
-    parts = []
-    for (card, pos, style) in zip(selected, POSITIONS, styles_cycle):
-        card_id, name, meaning = card
-        text = _build_card_interpretation(
-            card_name=name,
-            meaning=meaning,
-            position=pos,
-            topic=topic,
-            style=style,
-            sign=sign,
+    interpretations = content.get("tarot_interpretations")
+    cards = []
+    for card_id, (name, data) in enumerate(interpretations.items(), start=1):
+        cards.append(TarotCard(
+            card_id=card_id,
+            name=name,
+            light=data.get("light", "Интерпретация отсутствует."),
+            shadow=data.get("shadow", "Интерпретация отсутствует."),
+            keywords=tuple(data.get("keywords", ())),
+        ))
+    return Deck(cards, content.version())
+
+
+_deck: Deck | None = None
+_deck_lock = threading.Lock()
+
+
+def get_deck() -> Deck:
+    """
+    Колода в памяти. Пересобирается, если изменилась версия контента.
+    """
+    global _deck
+    deck = _deck
+    if deck is None or deck.version != content.version():
+        with _deck_lock:
+            if _deck is None or _deck.version != content.version():
+                _deck = build_deck()
+            deck = _deck
+    return deck
+
+
+def invalidate_deck():
+    global _deck
+    with _deck_lock:
+        _deck = None
+
+
+def sync_tarot_cards():
+    """
+    Записываем колоду в tarot_cards, чтобы id в tarot_draws ссылались на те же карты.
+    """
+    deck = get_deck()
+    with transaction() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO tarot_cards (card_id, name, meaning) VALUES (?, ?, ?)",
+            [(card.card_id, card.name, card.light) for card in deck.cards],
         )
-        parts.append(text)
+        conn.execute("DELETE FROM tarot_cards WHERE card_id > ?", (len(deck),))
+
+
+# --- Расклады ---
 
-    # сохраняем названия карт в историю
-    save_tarot_history(user_id, [c[1] for c in selected])
+# Вероятность, что карта выпадет перевёрнутой (теневое значение)
+REVERSED_PROBABILITY = 0.3
 
+
+@dataclass(frozen=True)
+class SpreadLayout:
+    """
+    Описание расклада: позиции по порядку. premium — только для подписчиков.
+    """
+    key: str
+    title: str
+    positions: tuple[str, ...]
+    premium: bool = False
+
+
+SPREADS: dict[str, SpreadLayout] = {}
+
+
+def register_spread(key: str, title: str, positions, premium: bool = False) -> SpreadLayout:
+    """
+    Регистрируем расклад (в том числе свой, нестандартный).
+    """
+    layout = SpreadLayout(key=key, title=title, positions=tuple(positions), premium=premium)
+    SPREADS[key] = layout
+    return layout
+
+
+register_spread("one", "Карта дня", ["Суть"])
+register_spread("three", "Прошлое, настоящее, будущее", POSITIONS)
+register_spread(
+    "celtic_cross",
+    "Кельтский крест",
+    [
+        "Ситуация",
+        "Препятствие",
+        "Основа",
+        "Прошлое",
+        "Возможное будущее",
+        "Ближайшее будущее",
+        "Ты сам",
+        "Окружение",
+        "Надежды и страхи",
+        "Итог",
+    ],
+    premium=True,
+)
+
+
+class DrawnCard(NamedTuple):
+    position: str
+    card: TarotCard
+    reversed: bool
+
+
+def sample_cards(deck: Deck, k: int, exclude=()) -> list[TarotCard]:
+    """
+    k разных карт без повторов, по возможности не из exclude (id недавних карт).
+    Выборка с отклонением по массиву колоды: O(k + len(exclude)) вместо
+    фильтрации всей колоды на каждый расклад.
+    """
+    cards = deck.cards
+    n = len(cards)
+    k = min(k, n)
+    taken = {card_id for card_id in exclude if card_id in deck.by_id}
+    if n - len(taken) < k:
+        # свежих карт не хватает — разрешаем повторы недавних
+        taken = set()
+
+    picked = []
+    while len(picked) < k:
+        card = cards[random.randrange(n)]
+        if card.card_id in taken:
+            continue
+        taken.add(card.card_id)
+        picked.append(card)
+    return picked
+
+
+def draw_spread(user_id: int, spread: str) -> list[DrawnCard]:
+    """
+    Вытягиваем карты для расклада, не повторяя недавние карты пользователя,
+    и записываем их в историю.
+    """
+    layout = SPREADS[spread]
+    deck = get_deck()
+    if not deck:
+        return []
+
+    cards = sample_cards(deck, len(layout.positions), get_recent_tarot_card_ids(user_id))
+    drawn = [
+        DrawnCard(position, card, random.random() < REVERSED_PROBABILITY)
+        for position, card in zip(layout.positions, cards)
+    ]
+    save_tarot_draws(user_id, [item.card.card_id for item in drawn])
+    return drawn
+
+
+def render_spread(layout: SpreadLayout, drawn: list[DrawnCard], topic: str, sign: str | None = None) -> str:
+    """
+    Текст расклада из заранее собранных фрагментов карт.
+    Стили интерпретации не повторяются, пока не закончатся.
+    """
+    styles = random.sample(TAROT_STYLES, k=len(TAROT_STYLES))
+    header = [f"🃏 {layout.title}", f"Тема расклада — {topic.lower()}."]
+    if sign:
+        header.append(f"Ты сейчас как {sign}, который учится видеть глубже привычного.")
+
+    parts = ["\n".join(header)]
+    for i, item in enumerate(drawn):
+        parts.append(
+            f"{item.position}: {item.card.titles[item.reversed]}.\n"
+            f"{item.card.meaning_part(styles[i % len(styles)], item.reversed)}"
+        )
     return "\n\n".join(parts)
+
+
+def generate_spread(user_id: int, topic: str, spread: str = "three", sign: str | None = None) -> str:
+    """
+    Расклад по одной из раскладок SPREADS.
+    """
+    drawn = draw_spread(user_id, spread)
+    if not drawn:
+        return "Колоде сегодня не до работы — карты Таро не загружены. 🃏"
+    return render_spread(SPREADS[spread], drawn, topic, sign)
+
+
+def generate_tarot(user_id: int, topic: str, sign: str | None = None) -> str:
+    """
+    Генерация расклада из 3 карт:
+    - без повторения недавно вытянутых карт (по card_id)
+    - с разными стилями интерпретации
+    """
+    return generate_spread(user_id, topic, "three", sign)
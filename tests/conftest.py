@@ -0,0 +1,55 @@
+import os
+import sys
+import uuid
+
+import pytest
+
+# Модули бота лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "slow: долгие или зависящие от скорости машины тесты (-m \"not slow\")")
+
+
+def _reset():
+    import db
+    import quote_index
+    from cache import profile_cache
+    from repo import repo
+
+    repo.stop()
+    db.close_all_connections()
+    profile_cache.clear()
+    quote_index._index = None
+
+
+def _new_memory_db() -> str:
+    import db
+
+    _reset()
+    db.DB_PATH = f"memory://test-{uuid.uuid4().hex}"
+    db.create_tables()
+    return db.DB_PATH
+
+
+@pytest.fixture
+def memory_db():
+    """
+    Пустая база в памяти со всеми миграциями; после теста бот возвращается к прежней базе.
+    """
+    import db
+
+    previous = db.DB_PATH
+    yield _new_memory_db()
+    _reset()
+    db.DB_PATH = previous
+
+
+@pytest.fixture
+def new_memory_db(memory_db):
+    """
+    Переключиться на ещё одну пустую базу (и сбросить кэши процесса), например
+    чтобы сравнить два прогона с одинакового состояния.
+    """
+    return _new_memory_db
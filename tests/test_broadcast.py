@@ -0,0 +1,213 @@
+import asyncio
+import math
+
+import pytest
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+import broadcast
+import db
+import fake_bot
+import outbox
+from broadcast import FLOOD, OTHER, PERMANENT, TRANSIENT, BroadcastStats, Broadcaster, TokenBucket, bot_sender, classify_error
+from fake_bot import FakeBot
+from repo import repo
+
+_sleep = asyncio.sleep
+
+
+class VirtualClock:
+    """
+    Время, которое идёт только во время пауз: тесты не зависят от скорости машины.
+    Пауза заканчивается, когда её срок — ближайший из ждущих и остальным задачам
+    больше нечего делать прямо сейчас.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self._wakeups = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float):
+        if seconds <= 0:
+            await _sleep(0)
+            return
+        # Настоящие часы всегда идут вперёд, даже если пауза меньше их точности
+        wakeup = max(self.now + seconds, math.nextafter(self.now, math.inf))
+        self._wakeups.append(wakeup)
+        try:
+            while self.now < wakeup:
+                # Сначала даём отработать всем задачам, которые не спят
+                for _ in range(20):
+                    await _sleep(0)
+                if wakeup <= min(self._wakeups):
+                    self.now = max(self.now, wakeup)
+        finally:
+            self._wakeups.remove(wakeup)
+
+
+class _Module:
+    def __init__(self, module, **overrides):
+        self._module = module
+        self.__dict__.update(overrides)
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    import random
+    import time
+
+    clock = VirtualClock()
+    monkeypatch.setattr(broadcast, "time", _Module(time, monotonic=clock.monotonic))
+    monkeypatch.setattr(broadcast, "asyncio", _Module(asyncio, sleep=clock.sleep))
+    monkeypatch.setattr(fake_bot, "time", _Module(time, monotonic=clock.monotonic))
+    # Без jitter: паузы перед повтором точно известны
+    monkeypatch.setattr(broadcast, "random", _Module(random, uniform=lambda a, b: a))
+    return clock
+
+
+def _run(broadcaster: Broadcaster, messages, clock: VirtualClock) -> BroadcastStats:
+    return asyncio.run(broadcaster.run(messages, BroadcastStats(started_at=clock.now)))
+
+
+def _sent_at(bot: FakeBot, chat_id: int) -> list[float]:
+    return [round(message.at - 1000.0, 6) for message in bot.sent if message.chat_id == chat_id]
+
+
+@pytest.mark.parametrize(
+    "error, expected",
+    [
+        (TelegramRetryAfter(method=None, message="flood", retry_after=3), (FLOOD, None)),
+        (TelegramNetworkError(method=None, message="timeout"), (TRANSIENT, None)),
+        (TelegramServerError(method=None, message="Bad Gateway"), (TRANSIENT, None)),
+        (TelegramForbiddenError(method=None, message="Forbidden: bot was blocked by the user"), (PERMANENT, "blocked")),
+        (TelegramForbiddenError(method=None, message="Forbidden: user is deactivated"), (PERMANENT, "deactivated")),
+        (TelegramForbiddenError(method=None, message="Forbidden: something new"), (PERMANENT, "blocked")),
+        (TelegramBadRequest(method=None, message="Bad Request: chat not found"), (PERMANENT, "not_found")),
+        (TelegramBadRequest(method=None, message="Bad Request: message is too long"), (OTHER, None)),
+        (ValueError("bug"), (OTHER, None)),
+    ],
+)
+def test_classify_error(error, expected):
+    assert classify_error(error) == expected
+
+
+def test_bucket_is_limited_by_parent(clock):
+    async def main():
+        bucket = TokenBucket(100, parent=TokenBucket(10))
+        for _ in range(5):
+            await bucket.acquire()
+
+    asyncio.run(main())
+    # Первый токен есть сразу, дальше — по одному на 1/10 с у родителя
+    assert clock.now - 1000.0 == pytest.approx(0.4)
+
+
+def test_siblings_share_parent_rate(clock):
+    async def main():
+        parent = TokenBucket(10)
+        children = [TokenBucket(10, parent=parent) for _ in range(2)]
+
+        async def drain(bucket):
+            for _ in range(5):
+                await bucket.acquire()
+
+        await asyncio.gather(*(drain(child) for child in children))
+
+    asyncio.run(main())
+    # 10 токенов на двоих по лимиту родителя, а не 5 на каждого по своему
+    assert clock.now - 1000.0 == pytest.approx(0.9)
+
+
+def test_per_chat_interval(clock):
+    bot = FakeBot()
+    messages = [(1, "a"), (1, "b"), (2, "c"), (1, "d")]
+    stats = _run(Broadcaster(bot_sender(bot), rate=1e6, concurrency=4, per_chat_interval=1.0), messages, clock)
+    assert stats.sent == 4
+    assert _sent_at(bot, 1) == pytest.approx([0.0, 1.0, 2.0], abs=1e-3)
+    # Другие чаты лимит одного чата не задерживает
+    assert _sent_at(bot, 2) == pytest.approx([0.0], abs=1e-3)
+
+
+def test_retry_after_pauses_whole_broadcast(clock):
+    bot = FakeBot(errors={1: [TelegramRetryAfter(method=None, message="flood", retry_after=2)]})
+    messages = [(1, "a"), (2, "b"), (3, "c")]
+    stats = _run(Broadcaster(bot_sender(bot), rate=1e6, concurrency=3, per_chat_interval=0), messages, clock)
+    assert (stats.sent, stats.failed, stats.retries) == (3, 0, 1)
+    assert bot.attempts == 4
+    # После flood control ничего не уходит никому, пока не пройдёт retry_after
+    assert min(message.at for message in bot.sent) - 1000.0 >= 2.0
+
+
+def test_transient_error_retried_with_backoff(clock):
+    bot = FakeBot(errors={1: [TelegramServerError(method=None, message="Bad Gateway")] * 2})
+    stats = _run(Broadcaster(bot_sender(bot), rate=1e6, per_chat_interval=0), [(1, "a")], clock)
+    assert (stats.sent, stats.retries, bot.attempts) == (1, 2, 3)
+    # Паузы 0.5 и 1 с (2 ** attempt * 0.5 без jitter)
+    assert _sent_at(bot, 1) == pytest.approx([1.5], abs=1e-3)
+
+
+def test_retries_are_limited(clock):
+    undeliverable = []
+
+    async def on_undeliverable(batch):
+        undeliverable.extend(batch)
+
+    bot = FakeBot(errors={1: [TelegramNetworkError(method=None, message="timeout")] * 5})
+    broadcaster = Broadcaster(
+        bot_sender(bot), rate=1e6, per_chat_interval=0, max_retries=2, on_undeliverable=on_undeliverable,
+    )
+    stats = _run(broadcaster, [(1, "a")], clock)
+    assert (stats.sent, stats.failed, bot.attempts) == (0, 1, 3)
+    # Сеть — не причина исключать получателя
+    assert undeliverable == []
+
+
+def test_blocked_recipient_is_not_retried(clock):
+    undeliverable = []
+    results = []
+
+    async def on_undeliverable(batch):
+        undeliverable.extend(batch)
+
+    async def on_result(chat_id, ok, permanent):
+        results.append((chat_id, ok, permanent))
+
+    bot = FakeBot(errors={1: [TelegramForbiddenError(method=None, message="Forbidden: bot was blocked by the user")]})
+    broadcaster = Broadcaster(
+        bot_sender(bot), rate=1e6, per_chat_interval=0, on_result=on_result, on_undeliverable=on_undeliverable,
+    )
+    stats = _run(broadcaster, [(1, "a"), (2, "b")], clock)
+    assert (stats.sent, stats.failed, stats.retries) == (1, 1, 0)
+    assert bot.attempts == 2
+    assert undeliverable == [(1, "blocked")]
+    assert sorted(results) == [(1, False, True), (2, True, False)]
+
+
+def test_blocked_recipient_leaves_campaigns(memory_db):
+    for user_id in (1, 2):
+        db.set_user_sign(user_id, "Лев")
+    db.outbox_add("c", [(1, "a"), (2, "b")])
+    bot = FakeBot(errors={1: [TelegramForbiddenError(method=None, message="Forbidden: bot was blocked by the user")]})
+
+    async def main():
+        try:
+            return await outbox.run_campaign("c", bot_sender(bot), rate=1e9, per_chat_interval=0)
+        finally:
+            repo.stop()
+
+    stats = asyncio.run(main())
+    assert (stats.sent, stats.failed, bot.attempts) == (1, 1, 2)
+    assert db.outbox_progress("c") == {"sent": 1, "failed": 1}
+    row = db.get_db_connection().execute("SELECT delivery_status FROM users WHERE user_id = 1").fetchone()
+    assert row["delivery_status"] == "blocked"
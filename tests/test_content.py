@@ -0,0 +1,71 @@
+import json
+import os
+import shutil
+import time
+
+import pytest
+
+import content
+import tarot
+from content import DATA_DIR, SOURCES, Content, _PackList, build_pack
+
+
+def test_pack_and_json_report_same_version(tmp_path):
+    pack_path = str(tmp_path / "content.pack")
+    from_json = Content(DATA_DIR, pack_path)
+    version = from_json.version()
+
+    assert build_pack(DATA_DIR, pack_path) == version
+    from_pack = Content(DATA_DIR, pack_path)
+    assert from_pack.version() == version
+    # Пакет свежее исходников — читается он, а не JSON
+    assert isinstance(from_pack.get("quotes"), _PackList)
+    assert list(from_pack.get("quotes")) == list(from_json.get("quotes"))
+
+
+def test_stale_pack_format_falls_back_to_json(tmp_path):
+    pack_path = tmp_path / "content.pack"
+    pack_path.write_bytes(b"ASTROPK\x01" + b"\0" * 64)
+    content = Content(DATA_DIR, str(pack_path))
+    assert content.version() == Content(DATA_DIR, os.devnull + ".missing").version()
+    assert content.get("quotes")
+
+
+def _copy_data(tmp_path):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    for name in SOURCES:
+        shutil.copy(os.path.join(DATA_DIR, f"{name}.json"), data_dir / f"{name}.json")
+    return data_dir
+
+
+def _edit_interpretations(data_dir, light):
+    path = data_dir / "tarot_interpretations.json"
+    cards = json.loads(path.read_text(encoding="utf-8"))
+    cards[next(iter(cards))]["light"] = light
+    path.write_text(json.dumps(cards, ensure_ascii=False), encoding="utf-8")
+
+
+def test_changed_files_are_reloaded(tmp_path, monkeypatch):
+    data_dir = _copy_data(tmp_path)
+    current = Content(str(data_dir), str(tmp_path / "content.pack"), check_interval=0.01)
+    monkeypatch.setattr(content, "content", current)
+    monkeypatch.setattr(tarot, "_deck", None)
+    deck = tarot.get_deck()
+    assert tarot.get_deck() is deck
+
+    _edit_interpretations(data_dir, "Новое толкование")
+    time.sleep(0.02)
+    assert content.version() != deck.version
+    rebuilt = tarot.get_deck()
+    assert rebuilt is not deck
+    assert rebuilt.cards[0].light == "Новое толкование"
+
+
+def test_unchanged_files_are_not_reread(tmp_path, monkeypatch):
+    data_dir = _copy_data(tmp_path)
+    current = Content(str(data_dir), str(tmp_path / "content.pack"), check_interval=0.01)
+    tables = current.get("quotes")
+    time.sleep(0.02)
+    monkeypatch.setattr(current, "_read", lambda: pytest.fail("контент перечитан без изменений"))
+    assert current.get("quotes") is tables
@@ -0,0 +1,86 @@
+import asyncio
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+from zoneinfo import ZoneInfo
+
+import pytest
+
+import db
+import jobs
+from config import DAILY_HOROSCOPE_HOUR, DAILY_SPREAD_WINDOW
+from repo import repo
+
+TIMEZONE = "Asia/Tokyo"
+
+
+def _utc(moment: datetime) -> str:
+    return moment.astimezone(dt_timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _set_last_gen(user_id: int, moment: datetime):
+    with db.transaction() as conn:
+        conn.execute("UPDATE users SET last_gen_date = ? WHERE user_id = ?", (_utc(moment), user_id))
+
+
+def test_daily_campaign_gates_on_local_date(memory_db):
+    zone = ZoneInfo(TIMEZONE)
+    now = datetime.now(zone)
+    midnight = datetime.combine(now.date(), time(), zone)
+    for user_id in (1, 2, 3):
+        db.set_user_sign(user_id, "Лев")
+        db.set_user_timezone(user_id, TIMEZONE)
+    # Вчерашняя рассылка за минуту до полуночи — меньше суток назад, но в другую дату
+    _set_last_gen(1, midnight - timedelta(minutes=1))
+    # Сегодня уже получил гороскоп сам
+    _set_last_gen(2, now)
+
+    campaign = jobs.daily_campaign(TIMEZONE)
+
+    async def fill():
+        async def pages():
+            yield [(1, "Лев"), (2, "Лев"), (3, "Лев")]
+
+        await jobs.fill_horoscope_outbox(campaign, pages())
+        return await repo.outbox_claim(campaign, 10, 300)
+
+    claimed = asyncio.run(fill())
+    assert sorted(user_id for user_id, _ in claimed) == [1, 3]
+    assert db.outbox_is_generated(campaign)
+
+
+def test_remaining_spread_counts_from_original_window():
+    zone = ZoneInfo(TIMEZONE)
+    day = datetime.now(zone).date()
+    start = datetime.combine(day, time(DAILY_HOROSCOPE_HOUR), zone).timestamp()
+    assert jobs.remaining_spread(TIMEZONE, day, start - 60) == DAILY_SPREAD_WINDOW
+    assert jobs.remaining_spread(TIMEZONE, day, start + 600) == DAILY_SPREAD_WINDOW - 600
+    assert jobs.remaining_spread(TIMEZONE, day, start + DAILY_SPREAD_WINDOW + 1) == 0
+
+
+def test_resume_runs_zones_concurrently(memory_db, monkeypatch):
+    zones = ["Asia/Tokyo", "Europe/Moscow"]
+    for user_id, zone in enumerate(zones, start=1):
+        db.outbox_add(jobs.daily_campaign(zone), [(user_id, "text")])
+    running = set()
+    overlapped = []
+    spreads = {}
+
+    async def send_daily_horoscope(bot, timezone=None, spread=0):
+        spreads[timezone] = spread
+        running.add(timezone)
+        await asyncio.sleep(0.01)
+        overlapped.append(set(running))
+        running.discard(timezone)
+
+    monkeypatch.setattr(jobs, "send_daily_horoscope", send_daily_horoscope)
+
+    async def main():
+        try:
+            await jobs.resume_broadcasts(bot=None)
+        finally:
+            repo.stop()
+
+    asyncio.run(main())
+    assert set(spreads) == set(zones)
+    assert set(zones) in overlapped
+    for zone in zones:
+        assert spreads[zone] == pytest.approx(jobs.remaining_spread(zone, jobs.local_today(zone)), abs=5)
@@ -0,0 +1,56 @@
+import random
+from datetime import datetime, timedelta
+
+import db
+import horoscope
+from horoscope import ALREADY_GENERATED_TEXT
+
+BATCH = [(1, "Лев"), (2, "Рак"), (1, "Лев"), (3, "Дева"), (4, "Овен")]
+
+
+def _prepare():
+    for user_id, sign in BATCH:
+        db.set_user_sign(user_id, sign)
+    # Пользователь 3 уже получил гороскоп меньше суток назад
+    recent = (datetime.utcnow() - timedelta(hours=1)).strftime("%Y-%m-%d %H:%M:%S")
+    with db.transaction() as conn:
+        conn.execute("UPDATE users SET last_gen_date = ? WHERE user_id = 3", (recent,))
+
+
+def _next_day():
+    # Сутки прошли у всех: следующий круг продолжает сохранённые курсоры
+    with db.transaction() as conn:
+        conn.execute("UPDATE users SET last_gen_date = datetime('now', '-2 days')")
+
+
+def _state():
+    rows = db.get_db_connection().execute(
+        "SELECT user_id, selection_state, last_gen_date IS NOT NULL AS generated FROM users ORDER BY user_id"
+    ).fetchall()
+    cursors = db.get_db_connection().execute("SELECT * FROM quote_cursors ORDER BY user_id").fetchall()
+    return [tuple(row) for row in rows], [tuple(row) for row in cursors]
+
+
+def _run(generate) -> tuple[list[list[str]], list]:
+    _prepare()
+    random.seed(2024)
+    rounds = [generate()]
+    _next_day()
+    rounds.append(generate())
+    return rounds, _state()
+
+
+def test_batch_matches_single(memory_db, new_memory_db):
+    batch_rounds, batch_state = _run(lambda: horoscope.generate_horoscopes(BATCH))
+    new_memory_db()
+    single_rounds, single_state = _run(
+        lambda: [horoscope.generate_horoscope(user_id, sign) for user_id, sign in BATCH]
+    )
+
+    assert batch_rounds == single_rounds
+    assert batch_state == single_state
+    first, second = batch_rounds
+    # Повтор в той же пачке и недавний получатель получают «уже был»
+    assert [text == ALREADY_GENERATED_TEXT for text in first] == [False, False, True, True, False]
+    assert [text == ALREADY_GENERATED_TEXT for text in second] == [False, False, True, False, False]
+    assert first[0] != second[0]
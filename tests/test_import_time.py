@@ -0,0 +1,19 @@
+import pytest
+
+from bench import IMPORT_BUDGETS, bench_import, check_imports
+
+
+# Замер по медиане нескольких запусков всё равно зависит от машины: pytest -m "not slow" его пропускает
+@pytest.mark.slow
+@pytest.mark.parametrize("module", sorted(IMPORT_BUDGETS))
+def test_cold_import_within_budget(module):
+    _, violations = check_imports({module: IMPORT_BUDGETS[module]})
+    assert violations == []
+
+
+def test_missing_measurement_is_reported():
+    # sys встроен в интерпретатор — в выводе -X importtime его нет
+    with pytest.raises(RuntimeError, match="нет замера"):
+        bench_import("sys", repeat=1)
+    _, violations = check_imports({"sys": (100, ())})
+    assert violations and violations[0].startswith("sys: импорт упал")
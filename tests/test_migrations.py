@@ -0,0 +1,18 @@
+import db
+import migrations
+
+
+def _objects() -> set[str]:
+    return {row["name"] for row in db.get_db_connection().execute("SELECT name FROM sqlite_master")}
+
+
+def test_all_migrations_applied(memory_db):
+    assert migrations.pending_migrations() == []
+    assert migrations.current_version() == migrations.MIGRATIONS[-1][0]
+
+
+def test_unused_quote_history_dropped(memory_db):
+    objects = _objects()
+    assert "user_quote_history" not in objects
+    assert "idx_user_quote_history_recent" not in objects
+    assert "quote_cursors" in objects
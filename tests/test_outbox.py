@@ -0,0 +1,133 @@
+import asyncio
+from collections import Counter
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+
+import db
+import horoscope
+import jobs
+import outbox
+from broadcast import bot_sender
+from fake_bot import FakeBot
+from repo import repo
+
+TIMEZONE = "Asia/Tokyo"
+FAST = {"rate": 1e9, "per_chat_interval": 0}
+
+
+def _run(coro):
+    async def main():
+        try:
+            return await coro
+        finally:
+            repo.stop()
+
+    return asyncio.run(main())
+
+
+def _sent(bot: FakeBot) -> Counter:
+    return Counter(message.chat_id for message in bot.sent)
+
+
+def _add_users(user_ids):
+    for user_id in user_ids:
+        db.set_user_sign(user_id, "Лев")
+        db.set_user_timezone(user_id, TIMEZONE)
+
+
+def test_resume_after_crash_sends_each_message_once(memory_db):
+    db.outbox_add("c", [(user_id, f"text {user_id}") for user_id in range(1, 11)])
+    # Упавший процесс забрал 4 сообщения и успел отправить 2 из них
+    claimed = db.outbox_claim("c", 4, lease=0)
+    for user_id, _ in claimed[:2]:
+        db.outbox_mark_sent("c", user_id)
+
+    bot = FakeBot()
+    _run(outbox.run_campaign("c", bot_sender(bot), **FAST))
+    sent = _sent(bot)
+    assert set(sent.values()) == {1}
+    assert set(sent) == set(range(1, 11)) - {user_id for user_id, _ in claimed[:2]}
+    assert db.outbox_progress("c") == {"sent": 10}
+
+
+def test_lease_expiry_and_renewal(memory_db):
+    db.outbox_add("c", [(1, "a")])
+    assert db.outbox_claim("c", 10, lease=0.2)
+    assert db.outbox_claim("c", 10, lease=0.2) == []
+    db.outbox_extend_lease("c", [1], 60)
+    asyncio.run(asyncio.sleep(0.3))
+    # Продлённая аренда не истекла — сообщение не отдаётся второму отправителю
+    assert db.outbox_claim("c", 10, lease=0.2) == []
+    db.outbox_extend_lease("c", [1], 0)
+    assert db.outbox_claim("c", 10, lease=0.2) == [(1, "a")]
+
+
+def test_idle_sender_does_not_wait_out_others_lease(memory_db):
+    db.outbox_add("c", [(user_id, "hi") for user_id in range(1, 5)])
+    slow, idle = FakeBot(latency=0.3), FakeBot()
+
+    async def two_senders():
+        first = asyncio.create_task(outbox.run_campaign("c", bot_sender(slow), **FAST))
+        # Первый отправитель забрал всё — второму остаётся ждать, пока тот отметит сообщения
+        await asyncio.sleep(0.1)
+        second = outbox.run_campaign("c", bot_sender(idle), **FAST)
+        return await asyncio.wait_for(asyncio.gather(first, second), timeout=5)
+
+    _run(two_senders())
+    assert _sent(slow) == {user_id: 1 for user_id in range(1, 5)}
+    assert not idle.sent
+
+
+def test_stall_longer_than_lease_does_not_duplicate(memory_db, monkeypatch):
+    monkeypatch.setattr(outbox, "OUTBOX_LEASE", 0.6)
+    db.outbox_add("c", [(user_id, "hi") for user_id in range(1, 31)])
+    # Первый же получатель отвечает retry_after дольше аренды
+    bot = FakeBot(errors={1: [TelegramRetryAfter(method=None, message="flood", retry_after=1)]})
+    sender = bot_sender(bot)
+
+    async def two_senders():
+        return await asyncio.gather(
+            outbox.run_campaign("c", sender, rate=50, per_chat_interval=0),
+            outbox.run_campaign("c", sender, rate=50, per_chat_interval=0),
+        )
+
+    _run(two_senders())
+    sent = _sent(bot)
+    assert set(sent) == set(range(1, 31))
+    assert set(sent.values()) == {1}
+
+
+def test_generated_campaign_skips_late_registrants(memory_db):
+    _add_users(range(1, 6))
+    bot = FakeBot()
+    _run(jobs.send_daily_horoscope(bot, timezone=TIMEZONE, **FAST))
+    assert set(_sent(bot)) == set(range(1, 6))
+
+    # Зарегистрировался после утренней рассылки; бот перезапустился
+    _add_users([99])
+    late = FakeBot()
+    _run(jobs.resume_broadcasts(late))
+    _run(jobs.send_daily_horoscope(late, timezone=TIMEZONE, **FAST))
+    assert late.sent == []
+
+
+def test_outbox_and_last_gen_date_are_atomic(memory_db, monkeypatch):
+    _add_users([1, 2])
+    campaign = jobs.daily_campaign(TIMEZONE)
+
+    def broken_outbox_add(*args, **kwargs):
+        raise RuntimeError("диск заполнен")
+
+    monkeypatch.setattr(horoscope, "outbox_add", broken_outbox_add)
+    with pytest.raises(RuntimeError):
+        horoscope.generate_horoscopes_to_outbox(campaign, [(1, "Лев"), (2, "Лев")], timezone=TIMEZONE)
+    rows = db.get_db_connection().execute("SELECT last_gen_date FROM users WHERE user_id IN (1, 2)").fetchall()
+    assert [row["last_gen_date"] for row in rows] == [None, None]
+    assert db.outbox_progress(campaign) == {}
+
+    monkeypatch.undo()
+    assert horoscope.generate_horoscopes_to_outbox(campaign, [(1, "Лев"), (2, "Лев")], timezone=TIMEZONE) == 2
+    rows = db.get_db_connection().execute("SELECT last_gen_date FROM users WHERE user_id IN (1, 2)").fetchall()
+    assert all(row["last_gen_date"] for row in rows)
+    assert db.outbox_progress(campaign) == {"pending": 2}
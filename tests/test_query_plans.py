@@ -0,0 +1,8 @@
+import db
+import migrations
+
+
+def test_hot_queries_use_indexes():
+    previous = db.DB_PATH
+    assert migrations.check_plans() == []
+    assert db.DB_PATH == previous
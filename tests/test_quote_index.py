@@ -0,0 +1,77 @@
+from datetime import date, timedelta
+
+import pytest
+
+import db
+import quote_index
+from quote_index import QuoteIndex
+from writebehind import write_behind
+
+QUOTES = [f"q{i}" for i in range(5)]
+DAY = date(2024, 5, 1)
+
+
+def _statements():
+    statements = []
+    db.get_db_connection().set_trace_callback(statements.append)
+    return statements
+
+
+def test_no_repeat_within_window(memory_db):
+    index = QuoteIndex(QUOTES, repeat_days=2)
+    drawn = [index.draw(1, DAY + timedelta(days=i)) for i in range(20)]
+    for i in range(1, len(drawn)):
+        assert drawn[i] != drawn[i - 1]
+    # Каждый круг — перестановка всех цитат
+    assert sorted(drawn[:5]) == QUOTES
+
+
+def test_cached_draw_runs_no_select(memory_db):
+    index = QuoteIndex(QUOTES)
+    index.draw(1, DAY)
+    statements = _statements()
+    index.draw(1, DAY + timedelta(days=1))
+    assert not [sql for sql in statements if sql.lstrip().upper().startswith("SELECT")]
+
+
+def test_cursor_survives_new_process(memory_db):
+    first = QuoteIndex(QUOTES)
+    for i in range(3):
+        first.draw(1, DAY + timedelta(days=i))
+    # Новый процесс — пустой кэш: курсор читается из quote_cursors
+    assert QuoteIndex(QUOTES)._load([1])[1] == first._cursors.get(1)
+
+
+def test_rollback_forgets_cached_cursor(memory_db):
+    index = QuoteIndex(QUOTES)
+    index.draw(1, DAY)
+    saved = index._cursors.get(1)
+
+    class Boom(Exception):
+        pass
+
+    with pytest.raises(Boom):
+        with db.transaction():
+            index.draw(1, DAY + timedelta(days=1))
+            raise Boom
+    # Откаченный выбор не сдвинул курсор ни в БД, ни в памяти
+    assert index._cursors.get(1) is None
+    assert index._load([1])[1] == saved
+
+
+def test_write_behind_defers_cursor(memory_db, monkeypatch):
+    monkeypatch.setattr(quote_index, "WRITE_BEHIND", True)
+    write_behind.take()
+    index = QuoteIndex(QUOTES)
+    index.draw(1, DAY)
+    statements = _statements()
+    second = index.draw(1, DAY + timedelta(days=1))
+    assert statements == []
+
+    # Ещё не записанный курсор видит и новый экземпляр (read-your-writes)
+    expected = QuoteIndex(QUOTES)
+    assert expected._load([1])[1] == index._cursors.get(1)
+    db.flush_write_behind()
+    row = db.get_db_connection().execute("SELECT position FROM quote_cursors WHERE user_id = 1").fetchone()
+    assert row["position"] == index._cursors.get(1)[1]
+    assert second in QUOTES
@@ -0,0 +1,80 @@
+import pytest
+
+from permutation import make_key, permute
+from selection import DIMENSIONS, DaySelection, SelectionState
+
+SIZES = (1, 2, 3, 5, 16, 17, 64, 100, 1000)
+KEYS = (make_key("quote", 1, 0), make_key("intro", 42, 7), make_key(""), b"\x00\xff")
+
+
+@pytest.mark.parametrize("n", SIZES)
+@pytest.mark.parametrize("key", KEYS)
+def test_permute_is_bijection(n, key):
+    assert sorted(permute(i, n, key) for i in range(n)) == list(range(n))
+
+
+def test_permute_depends_on_key():
+    n = 100
+    orders = {tuple(permute(i, n, key) for i in range(n)) for key in KEYS}
+    assert len(orders) == len(KEYS)
+
+
+def _round(state, dimension, n):
+    return [state.next(dimension, n) for _ in range(n)]
+
+
+@pytest.mark.parametrize("n", (1, 2, 7, 132))
+def test_selection_covers_each_element_once_per_round(n):
+    state = SelectionState(user_id=5)
+    rounds = [_round(state, "pair", n) for _ in range(3)]
+    for items in rounds:
+        assert sorted(items) == list(range(n))
+    if n > 2:
+        # Каждый круг — новая перестановка
+        assert rounds[0] != rounds[1]
+
+
+def test_selection_dimensions_are_independent():
+    state = SelectionState(user_id=5)
+    intros = []
+    for _ in range(10):
+        intros.append(state.next("intro", 10))
+        state.next("symbol", 3)
+    assert sorted(intros) == list(range(10))
+
+
+@pytest.mark.parametrize("old, new", ((10, 12), (12, 10), (5, 1), (1, 5)))
+def test_selection_restarts_round_when_size_changes(old, new):
+    state = SelectionState(user_id=9)
+    for _ in range(old // 2 + 1):
+        state.next("ending", old)
+    # Контент обновили: новый круг по новому размеру, без повторов внутри него
+    for _ in range(2):
+        assert sorted(_round(state, "ending", new)) == list(range(new))
+
+
+def test_blob_round_trip_continues_the_same_sequence():
+    state = SelectionState(user_id=77)
+    for dimension, n in zip(DIMENSIONS, (40, 9, 13, 6)):
+        for _ in range(n + 3):
+            state.next(dimension, n)
+    blob = state.to_blob()
+    restored = SelectionState.from_blob(77, blob)
+    assert restored.to_blob() == blob
+    for dimension, n in zip(DIMENSIONS, (40, 9, 13, 6)):
+        assert _round(restored, dimension, n) == _round(state, dimension, n)
+
+
+@pytest.mark.parametrize("blob", (None, b"", b"\x01" * 5))
+def test_blob_missing_or_damaged_starts_fresh(blob):
+    state = SelectionState.from_blob(3, blob)
+    assert state.to_blob() == SelectionState(3).to_blob()
+    assert sorted(_round(state, "symbol", 8)) == list(range(8))
+
+
+@pytest.mark.parametrize("n", (2, 7, 31))
+def test_day_selection_has_no_repeats_within_a_cycle(n):
+    for cycle in range(3):
+        days = range(cycle * n, (cycle + 1) * n)
+        items = [DaySelection(11, day, salt="s").next("quote", n) for day in days]
+        assert sorted(items) == list(range(n))
@@ -0,0 +1,73 @@
+import uuid
+
+import pytest
+
+import db
+from cache import profile_cache
+from storage import MemoryBackend, SQLiteBackend, parse_database_url
+
+
+@pytest.fixture(params=["sqlite", "memory"])
+def database(request, tmp_path):
+    """
+    Одни и те же операции db.py на каждом варианте подключения из storage.py.
+    """
+    if request.param == "sqlite":
+        url = f"sqlite:///{tmp_path / 'astro_bot.db'}"
+    else:
+        url = f"memory://test-{uuid.uuid4().hex}"
+    previous = db.DB_PATH
+    db.close_db_connection()
+    profile_cache.clear()
+    db.DB_PATH = url
+    db.create_tables()
+    yield url
+    db.close_db_connection()
+    profile_cache.clear()
+    db.DB_PATH = previous
+
+
+def test_parse_database_url(tmp_path):
+    assert isinstance(parse_database_url(str(tmp_path / "a.db")), SQLiteBackend)
+    assert parse_database_url("sqlite:///a.db").path == "a.db"
+    assert isinstance(parse_database_url("sqlite:///:memory:"), MemoryBackend)
+    assert parse_database_url("memory://x").name == "x"
+    with pytest.raises(ValueError):
+        parse_database_url("postgresql://localhost/astro")
+
+
+def test_users_and_recipients(database):
+    for user_id, sign in ((3, "Лев"), (1, "Овен"), (2, "Дева")):
+        db.set_user_sign(user_id, sign)
+    db.ensure_user(4)
+    assert db.get_users_with_sign() == [(1, "Овен"), (2, "Дева"), (3, "Лев")]
+    assert db.get_users_with_sign(after_user_id=1, limit=1) == [(2, "Дева")]
+
+    db.mark_undeliverable([(2, "blocked")])
+    assert db.get_users_with_sign() == [(1, "Овен"), (3, "Лев")]
+    db.ensure_user(2, reactivate=True)
+    assert db.count_users_with_sign() == 3
+
+
+def test_selection_state_blob(database):
+    db.ensure_user(1)
+    assert db.get_selection_state(1) is None
+    db.save_selection_state(1, b"\x00\x01\xff")
+    assert db.get_selection_state(1) == b"\x00\x01\xff"
+
+
+def test_outbox(database):
+    assert db.outbox_add("c", [(1, "a"), (2, "b")]) == 2
+    assert db.outbox_add("c", [(1, "a")]) == 0
+    claimed = db.outbox_claim("c", 10, 300)
+    assert sorted(claimed) == [(1, "a"), (2, "b")]
+    assert db.outbox_claim("c", 10, 300) == []
+
+    db.outbox_mark_sent("c", 1)
+    db.outbox_mark_failed("c", 2, max_attempts=0, retry_delay=0)
+    assert db.outbox_progress("c") == {"sent": 1, "failed": 1}
+    assert db.outbox_next_attempt_in("c") is None
+
+    assert not db.outbox_is_generated("c")
+    db.outbox_mark_generated("c")
+    assert db.outbox_is_generated("c")
@@ -0,0 +1,50 @@
+import asyncio
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import webhook
+from metrics import BROADCAST_MESSAGES, HANDLER_SECONDS, registry
+
+
+def _message(text: str, user_id: int = 7) -> dict:
+    return {"update_id": 1, "message": {"message_id": 1, "text": text, "from": {"id": user_id}, "chat": {"id": user_id}}}
+
+
+def test_stats_request():
+    assert webhook.stats_request(_message("/stats"), admin_ids=[7]) == 7
+    assert webhook.stats_request(_message("/stats@astro_bot"), admin_ids=[7]) == 7
+    assert webhook.stats_request(_message("/stats"), admin_ids=[8]) is None
+    assert webhook.stats_request(_message("/start"), admin_ids=[7]) is None
+    assert webhook.stats_request({"update_id": 1, "callback_query": {}}, admin_ids=[7]) is None
+
+
+class _Pool:
+    def __init__(self):
+        self.dispatched = []
+
+    def dispatch(self, user_id, raw):
+        self.dispatched.append(user_id)
+        return True
+
+
+def test_stats_answered_by_front_with_worker_metrics():
+    # Хэндлер отработал в процессе-обработчике, рассылка — в основном
+    buckets = [1] + [0] * len(HANDLER_SECONDS.buckets)
+    registry.update_remote("webhook-worker-test", {HANDLER_SECONDS.name: {("cmd_from_worker",): [buckets, 0.01, 1]}})
+    BROADCAST_MESSAGES.inc(job="daily_horoscope_test", result="sent")
+    pool = _Pool()
+
+    async def post(update):
+        async with TestClient(TestServer(webhook.make_app(pool, secret="s", admin_ids=[7]))) as client:
+            response = await client.post(webhook.WEBHOOK_PATH, json=update, headers={webhook.SECRET_HEADER: "s"})
+            return response.status, await response.json(content_type=None)
+
+    status, body = asyncio.run(post(_message("/stats")))
+    assert status == 200
+    assert body["method"] == "sendMessage" and body["chat_id"] == 7
+    assert "cmd_from_worker" in body["text"] and "daily_horoscope_test" in body["text"]
+    assert pool.dispatched == []
+
+    status, _ = asyncio.run(post(_message("/start")))
+    assert status == 200 and pool.dispatched == [7]
+    registry.update_remote("webhook-worker-test", {HANDLER_SECONDS.name: {}})
@@ -0,0 +1,108 @@
+import json
+import os
+
+import pytest
+
+import db
+from writebehind import WriteBehind
+
+
+@pytest.fixture
+def pending(memory_db, monkeypatch):
+    """
+    Отложенная запись без журнала, отдельная от общего экземпляра бота.
+    """
+    write_behind = WriteBehind(journal="")
+    monkeypatch.setattr(db, "WRITE_BEHIND", True)
+    monkeypatch.setattr(db, "write_behind", write_behind)
+    return write_behind
+
+
+def _stored_state(user_id):
+    row = db.get_db_connection().execute("SELECT selection_state FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    return row and row["selection_state"]
+
+
+def test_reads_see_pending_writes(pending):
+    db.save_selection_state(1, b"first")
+    db.save_selection_state(1, b"second")
+    assert pending.user_field(1, "selection_state") == (True, b"second")
+    assert db.get_selection_state(1) == b"second"
+    assert _stored_state(1) is None
+
+    # Повторные изменения слились в одну запись
+    assert db.flush_write_behind() == 1
+    assert pending.user_field(1, "selection_state") == (False, None)
+    assert _stored_state(1) == b"second"
+    assert db.get_selection_state(1) == b"second"
+
+
+def test_rollback_undoes_pending_write(pending):
+    db.save_selection_state(1, b"kept")
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            db.save_selection_state(1, b"lost")
+            db.save_selection_state(2, b"lost")
+            raise RuntimeError
+    assert db.get_selection_state(1) == b"kept"
+    assert pending.user_field(2, "selection_state") == (False, None)
+    assert len(pending) == 1
+
+
+def test_unknown_field_is_rejected():
+    with pytest.raises(ValueError):
+        WriteBehind(journal="").update_user(1, subscription_status="premium")
+
+
+def _write_journal(path, records, tail=""):
+    with open(path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+        f.write(tail)
+
+
+def test_recover_replays_crashed_journal(pending, tmp_path, monkeypatch):
+    journal = str(tmp_path / "journal")
+    write_behind = WriteBehind(journal=journal)
+    monkeypatch.setattr(db, "write_behind", write_behind)
+    crashed = f"{journal}.{os.getpid() + 1}"
+    _write_journal(
+        crashed,
+        [
+            {"op": "user", "id": 1, "fields": {"selection_state": {"hex": "0102"}}},
+            {"op": "user", "id": 1, "fields": {"last_gen_date": "2024-05-01 06:00:00"}},
+            {"op": "draws", "id": 2, "cards": [3, 4], "at": "2024-05-01 07:00:00", "window": 1},
+        ],
+        # Процесс упал посреди записи строки
+        tail='{"op": "user", "id": 3, "fi',
+    )
+
+    assert db.recover_write_behind() == 3
+    assert not os.path.exists(crashed)
+    assert len(write_behind) == 0
+    row = db.get_db_connection().execute("SELECT selection_state, last_gen_date FROM users WHERE user_id = 1").fetchone()
+    assert (row["selection_state"], row["last_gen_date"]) == (b"\x01\x02", "2024-05-01 06:00:00")
+    cards = db.get_db_connection().execute("SELECT card_id FROM tarot_draws WHERE user_id = 2 ORDER BY card_id").fetchall()
+    assert [card["card_id"] for card in cards] == [3, 4]
+    assert not db.get_db_connection().execute("SELECT 1 FROM users WHERE user_id = 3").fetchone()
+
+
+def test_recover_removes_only_other_processes_journals(tmp_path):
+    journal = str(tmp_path / "journal")
+    write_behind = WriteBehind(journal=journal)
+    write_behind.update_user(1, last_gen_date="2024-05-01 06:00:00")
+    own = f"{journal}.{os.getpid()}"
+    crashed = f"{journal}.{os.getpid() + 1}"
+    _write_journal(crashed, [{"op": "user", "id": 2, "fields": {"last_gen_date": "2024-05-02 06:00:00"}}])
+    for name in (f"{crashed}.tmp", f"{journal}.bak"):
+        _write_journal(name, [{"op": "user", "id": 3, "fields": {}}])
+
+    assert write_behind.recover() == 1
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(name) for name in (own, f"{crashed}.tmp", f"{journal}.bak"))
+    assert write_behind.user_field(1, "last_gen_date") == (True, "2024-05-01 06:00:00")
+    assert write_behind.user_field(2, "last_gen_date") == (True, "2024-05-02 06:00:00")
+    assert write_behind.user_field(3, "last_gen_date") == (False, None)
+
+    # Свой журнал теперь содержит и восстановленное: повторное падение его не потеряет
+    with open(own, encoding="utf-8") as f:
+        assert {json.loads(line)["id"] for line in f} == {1, 2}
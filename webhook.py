@@ -0,0 +1,339 @@
+import argparse
+import asyncio
+import hmac
+import json
+import logging
+import multiprocessing as mp
+import os
+import queue
+import sys
+import threading
+import urllib.error
+import urllib.request
+
+from aiogram import Bot
+from aiohttp import web
+
+from config import (
+    ADMIN_IDS,
+    METRICS_PUSH_INTERVAL,
+    WEBHOOK_HOST,
+    WEBHOOK_PATH,
+    WEBHOOK_PORT,
+    WEBHOOK_QUEUE_SIZE,
+    WEBHOOK_SECRET,
+    WEBHOOK_URL,
+    WEBHOOK_WORKER_CONCURRENCY,
+    WEBHOOK_WORKERS,
+)
+from metrics import registry, summary
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def update_user_id(update: dict) -> int | None:
+    """
+    Id пользователя (или чата), от которого пришёл апдейт: по нему выбирается процесс.
+    Апдейты без отправителя (например, poll) возвращают None.
+    """
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        sender = value.get("from") or value.get("user") or value.get("chat")
+        if isinstance(sender, dict) and "id" in sender:
+            return sender["id"]
+        message = value.get("message")
+        if isinstance(message, dict) and isinstance(message.get("chat"), dict):
+            return message["chat"]["id"]
+    return None
+
+
+def stats_request(update: dict, admin_ids=ADMIN_IDS) -> int | None:
+    """
+    Чат администратора, приславшего /stats (или /stats@имя_бота), иначе None.
+    На /stats отвечает основной процесс: только в его реестре собраны метрики
+    всех обработчиков и рассылок — обработчик видел бы лишь свои.
+    """
+    message = update.get("message")
+    if not isinstance(message, dict) or not isinstance(message.get("text"), str):
+        return None
+    words = message["text"].split(maxsplit=1)
+    if not words or words[0].partition("@")[0] != "/stats":
+        return None
+    sender, chat = message.get("from"), message.get("chat")
+    if not isinstance(sender, dict) or sender.get("id") not in admin_ids or not isinstance(chat, dict):
+        return None
+    return chat.get("id")
+
+
+def worker_for(user_id: int | None, workers: int) -> int:
+    """
+    Все апдейты одного пользователя попадают в один процесс — так сохраняется
+    их порядок, а кэши пользователя (профиль, курсоры) не расходятся между процессами.
+    """
+    if user_id is None:
+        return 0
+    return user_id % workers
+
+
+# --- Процессы-обработчики ---
+
+
+class _UserChains:
+    """
+    Апдейты одного пользователя обрабатываются строго по очереди,
+    апдейты разных пользователей — параллельно.
+    """
+
+    def __init__(self):
+        self._tails: dict[int | None, asyncio.Task] = {}
+
+    def submit(self, user_id: int | None, coro_factory, done):
+        previous = self._tails.get(user_id)
+        task = asyncio.create_task(self._run(user_id, previous, coro_factory, done))
+        self._tails[user_id] = task
+
+    async def _run(self, user_id, previous, coro_factory, done):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            await coro_factory()
+        except Exception:
+            logger.exception("Ошибка при обработке апдейта пользователя %s", user_id)
+        finally:
+            done()
+            if self._tails.get(user_id) is asyncio.current_task():
+                del self._tails[user_id]
+
+    async def join(self):
+        while self._tails:
+            await asyncio.wait(list(self._tails.values()))
+
+
+async def _push_metrics(index: int, metrics_queue: mp.Queue):
+    while True:
+        await asyncio.sleep(METRICS_PUSH_INTERVAL)
+        metrics_queue.put((index, registry.snapshot()))
+
+
+async def _worker_loop(index: int, updates: mp.Queue, metrics_queue: mp.Queue, concurrency: int):
+    # Импорт здесь: каждый процесс поднимает свой Bot, Dispatcher и поток БД
+    import main
+    from aiogram.types import Update
+
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(concurrency)
+    chains = _UserChains()
+
+    bot = main.get_bot()
+
+    async def process(raw: bytes):
+        await main.dp.feed_update(bot, Update.model_validate_json(raw))
+
+    logger.info("Обработчик webhook #%d (pid %d) запущен", index, os.getpid())
+    # Хэндлеры работают здесь, а /metrics отдаёт основной процесс — передаём ему свои метрики
+    pusher = asyncio.create_task(_push_metrics(index, metrics_queue))
+    try:
+        while True:
+            await slots.acquire()
+            item = await loop.run_in_executor(None, updates.get)
+            if item is None:
+                slots.release()
+                break
+            user_id, raw = item
+            chains.submit(user_id, lambda raw=raw: process(raw), slots.release)
+        await chains.join()
+    finally:
+        pusher.cancel()
+        main.repo.stop()
+        metrics_queue.put((index, registry.snapshot()))
+        await bot.session.close()
+
+
+def _worker_main(index: int, updates: mp.Queue, metrics_queue: mp.Queue, concurrency: int):
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(_worker_loop(index, updates, metrics_queue, concurrency))
+    except KeyboardInterrupt:
+        pass
+
+
+class WorkerPool:
+    """
+    Процессы, обрабатывающие апдейты. У каждого своя ограниченная очередь:
+    если процесс не успевает, новые апдейты для него отклоняются
+    (Telegram доставит их повторно). Метрики процессов собираются
+    в реестр этого процесса (metrics.registry) через общую очередь.
+    """
+
+    def __init__(
+        self,
+        workers: int = WEBHOOK_WORKERS,
+        queue_size: int = WEBHOOK_QUEUE_SIZE,
+        concurrency: int = WEBHOOK_WORKER_CONCURRENCY,
+    ):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.concurrency = concurrency
+        # spawn: процессы не наследуют открытые подключения к БД и event loop родителя
+        self._context = mp.get_context("spawn")
+        self._queues: list[mp.Queue] = []
+        self._processes: list[mp.Process] = []
+        self._metrics: mp.Queue | None = None
+        self._metrics_thread: threading.Thread | None = None
+
+    def start(self):
+        self._metrics = self._context.Queue()
+        self._metrics_thread = threading.Thread(target=self._collect_metrics, name="webhook-metrics", daemon=True)
+        self._metrics_thread.start()
+        for index in range(self.workers):
+            updates = self._context.Queue(self.queue_size)
+            process = self._context.Process(
+                target=_worker_main,
+                args=(index, updates, self._metrics, self.concurrency),
+                name=f"webhook-worker-{index}",
+                daemon=True,
+            )
+            process.start()
+            self._queues.append(updates)
+            self._processes.append(process)
+
+    def _collect_metrics(self):
+        while True:
+            item = self._metrics.get()
+            if item is None:
+                return
+            index, snapshot = item
+            registry.update_remote(f"webhook-worker-{index}", snapshot)
+
+    def dispatch(self, user_id: int | None, raw: bytes) -> bool:
+        try:
+            self._queues[worker_for(user_id, self.workers)].put_nowait((user_id, raw))
+        except queue.Full:
+            return False
+        return True
+
+    def stop(self, timeout: float = 30.0):
+        """
+        Процессы дорабатывают уже принятые апдейты и завершаются.
+        """
+        for updates in self._queues:
+            updates.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning("Обработчик %s не завершился за %.0f с", process.name, timeout)
+                process.terminate()
+        self._queues.clear()
+        self._processes.clear()
+        if self._metrics_thread is not None:
+            self._metrics.put(None)
+            self._metrics_thread.join()
+            self._metrics_thread = None
+
+
+# --- HTTP-сервер ---
+
+
+def make_app(
+    pool: WorkerPool, secret: str = WEBHOOK_SECRET, path: str = WEBHOOK_PATH, admin_ids=ADMIN_IDS
+) -> web.Application:
+    if not secret:
+        raise ValueError("Webhook без секрета принял бы поддельные апдейты (например, об оплате)")
+
+    async def handle(request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+            return web.Response(status=401)
+        raw = await request.read()
+        try:
+            update = json.loads(raw)
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(update, dict):
+            return web.Response(status=400)
+        chat_id = stats_request(update, admin_ids)
+        if chat_id is not None:
+            # Ответ прямо в ответе на webhook: Telegram выполнит этот метод сам
+            return web.json_response({"method": "sendMessage", "chat_id": chat_id, "text": summary()})
+        if not pool.dispatch(update_user_id(update), raw):
+            return web.Response(status=503)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle)
+    return app
+
+
+async def run_webhook(
+    bot: Bot,
+    host: str = WEBHOOK_HOST,
+    port: int = WEBHOOK_PORT,
+    workers: int = WEBHOOK_WORKERS,
+):
+    """
+    Принимаем апдейты по webhook и раздаём их процессам-обработчикам.
+    Работает до отмены (Ctrl+C).
+    """
+    if not WEBHOOK_SECRET:
+        # Сервер слушает внешний адрес: без секрета любой может прислать апдейт
+        # с successful_payment и получить подписку даром
+        raise RuntimeError("Задайте WEBHOOK_SECRET: без него режим webhook не запускается")
+    pool = WorkerPool(workers)
+    pool.start()
+    runner = web.AppRunner(make_app(pool))
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+        if WEBHOOK_URL:
+            await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+        logger.info(
+            "Webhook слушает http://%s:%d%s, процессов-обработчиков: %d", host, port, WEBHOOK_PATH, pool.workers
+        )
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await asyncio.get_running_loop().run_in_executor(None, pool.stop)
+
+
+# --- Локальная проверка: отправить записанные апдейты ---
+
+
+def replay(path: str, url: str, secret: str = WEBHOOK_SECRET) -> dict[int, int]:
+    """
+    POST каждого апдейта из файла (JSON Lines, один апдейт на строку) на url.
+    Возвращает число ответов по HTTP-статусам.
+    """
+    statuses: dict[int, int] = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            request = urllib.request.Request(url, data=line.encode("utf-8"), method="POST")
+            request.add_header("Content-Type", "application/json")
+            if secret:
+                request.add_header(SECRET_HEADER, secret)
+            try:
+                with urllib.request.urlopen(request) as response:
+                    status = response.status
+            except urllib.error.HTTPError as e:
+                status = e.code
+            statuses[status] = statuses.get(status, 0) + 1
+    return statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка webhook: отправить записанные апдейты")
+    parser.add_argument("updates", help="файл с апдейтами, JSON Lines")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    parser.add_argument("--secret", default=WEBHOOK_SECRET)
+    args = parser.parse_args()
+    statuses = replay(args.updates, args.url, args.secret)
+    print(json.dumps(statuses))
+    sys.exit(0 if set(statuses) <= {200} else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+import glob
+import json
+import os
+import threading
+import time
+
+from config import WRITE_BEHIND_FSYNC, WRITE_BEHIND_INTERVAL_MS, WRITE_BEHIND_JOURNAL, WRITE_BEHIND_MAX_RECORDS
+
+# Поля users, запись которых можно отложить
+USER_FIELDS = ("selection_state", "last_gen_date", "delivery_status")
+# Курсор цитат пользователя (JSON [cycle, position, recent], см. quote_index.py):
+# откладывается так же, но пишется в quote_cursors, а не в users
+QUOTE_CURSOR = "quote_cursor"
+
+
+def _encode(value):
+    if isinstance(value, bytes):
+        return {"hex": value.hex()}
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        return bytes.fromhex(value["hex"])
+    return value
+
+
+class PendingWrites:
+    """
+    Снимок накопленных записей, который сбрасывается в БД (см. db.flush_write_behind).
+    """
+
+    def __init__(self, users: dict, draws: dict):
+        # user_id -> {поле: значение}; пустой словарь — только создать пользователя
+        self.users = users
+        # user_id -> [(card_ids, drawn_at, window), ...] в порядке вытягивания
+        self.draws = draws
+
+    def __bool__(self):
+        return bool(self.users or self.draws)
+
+    def __len__(self):
+        return len(self.users) + sum(len(entries) for entries in self.draws.values())
+
+
+class WriteBehind:
+    """
+    Отложенная запись состояния пользователей.
+
+    Изменения (курсоры выбора контента, дата последнего гороскопа, новые
+    пользователи, расклады Таро) копятся в памяти; повторные изменения одного
+    пользователя сливаются в одну запись. Поток БД сбрасывает их одной
+    транзакцией через executemany раз в interval секунд или при накоплении
+    max_records записей (см. Repository), а также при остановке.
+    Чтения этого процесса сначала смотрят в накопленное — пользователь
+    всегда видит свои последние изменения.
+
+    Без журнала при падении процесса теряются изменения за последний interval.
+    С журналом каждое изменение сначала дописывается в файл journal.<pid>
+    (при fsync — с fsync), а после сброса в БД журнал сокращается до ещё
+    не записанного; recover() при старте переносит в БД журналы упавших процессов.
+    """
+
+    def __init__(
+        self,
+        interval: float = WRITE_BEHIND_INTERVAL_MS / 1000,
+        max_records: int = WRITE_BEHIND_MAX_RECORDS,
+        journal: str = WRITE_BEHIND_JOURNAL,
+        fsync: bool = WRITE_BEHIND_FSYNC,
+    ):
+        self.interval = interval
+        self.max_records = max_records
+        self.journal = journal
+        self.fsync = fsync
+        self._users: dict[int, dict] = {}
+        self._draws: dict[int, list[tuple]] = {}
+        self._records = 0
+        self._flushed_at = time.monotonic()
+        self._journal_file = None
+        self._journal_pid = None
+        self._lock = threading.Lock()
+
+    # --- Изменения ---
+
+    def update_user(self, user_id: int, **fields):
+        """
+        Запомнить новые значения полей пользователя (без полей — только создать его).
+        Возвращает функцию, отменяющую это изменение (для отката транзакции).
+        """
+        unknown = set(fields) - {*USER_FIELDS, QUOTE_CURSOR}
+        if unknown:
+            raise ValueError(f"Поля нельзя записывать отложенно: {', '.join(sorted(unknown))}")
+        with self._lock:
+            self._journal_append({"op": "user", "id": user_id, "fields": {k: _encode(v) for k, v in fields.items()}})
+            previous = self._users.get(user_id)
+            current = {**previous, **fields} if previous is not None else dict(fields)
+            self._users[user_id] = current
+            if previous is None:
+                self._records += 1
+
+        def undo():
+            with self._lock:
+                if self._users.get(user_id) is not current:
+                    return
+                if previous is None:
+                    del self._users[user_id]
+                    self._records -= 1
+                else:
+                    self._users[user_id] = previous
+                self._journal_rewrite()
+
+        return undo
+
+    def add_draws(self, user_id: int, card_ids: list[int], drawn_at: str, window: int):
+        """
+        Запомнить вытянутые карты. Возвращает функцию отмены, как update_user.
+        """
+        entry = (tuple(card_ids), drawn_at, window)
+        with self._lock:
+            self._journal_append({"op": "draws", "id": user_id, "cards": list(card_ids), "at": drawn_at, "window": window})
+            self._draws.setdefault(user_id, []).append(entry)
+            self._records += 1
+
+        def undo():
+            with self._lock:
+                entries = self._draws.get(user_id, [])
+                if not any(item is entry for item in entries):
+                    return
+                entries[:] = [item for item in entries if item is not entry]
+                if not entries:
+                    del self._draws[user_id]
+                self._records -= 1
+                self._journal_rewrite()
+
+        return undo
+
+    # --- Чтение своих изменений ---
+
+    def user_field(self, user_id: int, field: str) -> tuple[bool, object]:
+        """
+        (True, значение), если поле пользователя изменено и ещё не записано в БД.
+        """
+        with self._lock:
+            fields = self._users.get(user_id)
+            if fields is not None and field in fields:
+                return True, fields[field]
+        return False, None
+
+    def recent_card_ids(self, user_id: int) -> list[int]:
+        """
+        Ещё не записанные в БД карты пользователя, самые свежие — первыми.
+        """
+        with self._lock:
+            entries = list(self._draws.get(user_id, ()))
+        return [card_id for card_ids, _, _ in reversed(entries) for card_id in reversed(card_ids)]
+
+    # --- Сброс в БД ---
+
+    def due(self) -> bool:
+        with self._lock:
+            if not self._records:
+                return False
+            return self._records >= self.max_records or time.monotonic() - self._flushed_at >= self.interval
+
+    def take(self) -> PendingWrites:
+        """
+        Забрать всё накопленное для записи в БД.
+        """
+        with self._lock:
+            pending = PendingWrites(self._users, self._draws)
+            self._users, self._draws = {}, {}
+            self._records = 0
+            self._flushed_at = time.monotonic()
+        return pending
+
+    def restore(self, pending: PendingWrites):
+        """
+        Запись не удалась — возвращаем снимок; изменения, сделанные после take(), новее.
+        """
+        with self._lock:
+            for user_id, fields in pending.users.items():
+                current = self._users.get(user_id)
+                self._users[user_id] = fields if current is None else {**fields, **current}
+            for user_id, entries in pending.draws.items():
+                self._draws[user_id] = entries + self._draws.get(user_id, [])
+            self._records = len(self._users) + sum(len(entries) for entries in self._draws.values())
+
+    def committed(self):
+        """
+        Снимок записан в БД — в журнале остаётся только то, что накопилось после.
+        """
+        with self._lock:
+            self._journal_rewrite()
+
+    def __len__(self):
+        return self._records
+
+    # --- Журнал ---
+
+    def _journal_path(self) -> str:
+        return f"{self.journal}.{os.getpid()}"
+
+    def _journal_open(self, mode: str = "a"):
+        # После fork/spawn у процесса свой журнал
+        if self._journal_file is None or self._journal_pid != os.getpid():
+            self._journal_file = open(self._journal_path(), mode, encoding="utf-8")
+            self._journal_pid = os.getpid()
+        return self._journal_file
+
+    def _journal_sync(self, f):
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+    def _journal_append(self, record: dict):
+        if not self.journal:
+            return
+        f = self._journal_open()
+        f.write(json.dumps(record) + "\n")
+        self._journal_sync(f)
+
+    def _journal_rewrite(self):
+        if not self.journal or self._journal_file is None:
+            return
+        path = self._journal_path()
+        if not self._users and not self._draws:
+            # Всё записано в БД — журнал не нужен, пока не появятся новые изменения
+            self._journal_file.close()
+            self._journal_file = None
+            os.remove(path)
+            return
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for user_id, fields in self._users.items():
+                f.write(json.dumps({"op": "user", "id": user_id, "fields": {k: _encode(v) for k, v in fields.items()}}) + "\n")
+            for user_id, entries in self._draws.items():
+                for card_ids, drawn_at, window in entries:
+                    f.write(json.dumps({"op": "draws", "id": user_id, "cards": list(card_ids), "at": drawn_at, "window": window}) + "\n")
+            self._journal_sync(f)
+        self._journal_file.close()
+        os.replace(tmp, path)
+        self._journal_file = open(path, "a", encoding="utf-8")
+
+    def recover(self) -> int:
+        """
+        Переносим в накопленное записи из журналов других (упавших) процессов
+        и удаляем их файлы. Вызывать при старте бота, до запуска других процессов,
+        и затем сбросить накопленное в БД. Возвращает число восстановленных записей.
+        """
+        if not self.journal:
+            return 0
+        own = self._journal_path()
+        recovered = 0
+        for path in sorted(glob.glob(f"{glob.escape(self.journal)}.*")):
+            if path == own or path.endswith(".tmp") or not path.rpartition(".")[2].isdigit():
+                continue
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Недописанная последняя строка — процесс упал во время записи
+                        continue
+                    if record["op"] == "user":
+                        self.update_user(record["id"], **{k: _decode(v) for k, v in record["fields"].items()})
+                    else:
+                        self.add_draws(record["id"], record["cards"], record["at"], record["window"])
+                    recovered += 1
+            os.remove(path)
+        return recovered
+
+
+write_behind = WriteBehind()